@@ -250,6 +250,21 @@ cp captive_portal.py ${FAKE_ROOT}/usr/local/sbin
 cp captive-portal.sh ${FAKE_ROOT}/usr/local/sbin
 cp mop_up_dead_clients.py ${FAKE_ROOT}/usr/local/sbin
 cp fake_dns.py ${FAKE_ROOT}/usr/local/sbin
+cp async_portal.py ${FAKE_ROOT}/usr/local/sbin
+cp conntrack.py ${FAKE_ROOT}/usr/local/sbin
+cp dns_codec.py ${FAKE_ROOT}/usr/local/sbin
+cp event_loop.py ${FAKE_ROOT}/usr/local/sbin
+cp idle_reaper.py ${FAKE_ROOT}/usr/local/sbin
+cp language_negotiation.py ${FAKE_ROOT}/usr/local/sbin
+cp portal_redirect.py ${FAKE_ROOT}/usr/local/sbin
+cp probes.py ${FAKE_ROOT}/usr/local/sbin
+cp static_assets.py ${FAKE_ROOT}/usr/local/sbin
+cp template_cache.py ${FAKE_ROOT}/usr/local/sbin
+cp throttle.py ${FAKE_ROOT}/usr/local/sbin
+cp whitelist.py ${FAKE_ROOT}/usr/local/sbin
+cp whitelist_backends.py ${FAKE_ROOT}/usr/local/sbin
+cp whitelist_queue.py ${FAKE_ROOT}/usr/local/sbin
+cp whitelist_store.py ${FAKE_ROOT}/usr/local/sbin
 cp etc/captiveportal/captiveportal.conf ${FAKE_ROOT}/etc/captiveportal/
 cp srv/captiveportal/* ${FAKE_ROOT}/srv/captiveportal/
 
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# async_portal.py
+# The HTTP front end behind captive_portal.py --engine=async.  It serves the
+# same things as the CherryPy application (the index page, /whitelist, OS
+# probes, /metrics and the redirect for everything else) from one thread
+# running an EventLoop.  An idle keep-alive connection costs a socket and a
+# few hundred bytes instead of one of CherryPy's pool threads, and
+# connections that sit idle for longer than the timeout are closed.
+#
+# This is deliberately a small HTTP/1.1 server: no chunked request bodies, no
+# uploads, no Expect: 100-continue.  The captive portal doesn't need them.
+
+# Modules.
+import errno
+import httplib
+import logging
+import socket
+import ssl
+import time
+import urlparse
+
+# Reason phrases, including the ones Python 2's httplib doesn't know.
+REASONS = dict(httplib.responses)
+REASONS[429] = 'Too Many Requests'
+
+# Biggest request head and body that will be accepted.
+MAX_HEAD = 16384
+MAX_BODY = 16384
+
+# How much to read from a socket at once.
+RECV_SIZE = 65536
+
+
+class HTTPRequest(object):
+
+    def __init__(self, method, path, query, version, headers, body, clientip, localip):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.clientip = clientip
+        self.localip = localip
+
+    # keep_alive(): True if the connection can be reused after answering.
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+# PortalApp maps requests onto the captive portal.  portal is the same
+# CaptivePortal object CherryPy mounts; its engine-neutral methods do the
+# actual work.  handle() returns (status, headers, body).
+class PortalApp(object):
+
+    def __init__(self, portal):
+        self.portal = portal
+
+        # HTTPServers answering for this app, for /metrics.
+        self.servers = []
+
+    def handle(self, request):
+        portal = self.portal
+        redirect = portal.arrived(request.localip)
+        throttled = portal.throttled(request.clientip, request.path)
+        if throttled is not None:
+            return throttled
+
+        asset = portal.static(request.path, request.query,
+                              request.headers.get('if-none-match'),
+                              request.headers.get('accept-encoding'))
+        if asset is not None:
+            return asset
+
+        probe = portal.probes.match(request.headers.get('host'), request.path)
+        if probe is not None:
+            return portal.probes.respond(probe, request.clientip, redirect)
+
+        if request.path in ('/', '/index', '/index.html'):
+            body = portal.render_index(request.headers.get('accept-language'))
+            return 200, {'Content-Type': 'text/html;charset=utf-8'}, body.encode('utf-8')
+
+        if request.path == '/whitelist':
+            return 200, {'Content-Type': 'text/html'}, portal.accept(request.clientip, request.localip)
+
+        if request.path == '/metrics' and request.clientip in ('127.0.0.1', '::1'):
+            connections = sum(len(server.connections) for server in self.servers)
+            return 200, {'Content-Type': 'application/json'}, portal.metrics_json(
+                {'engine': 'async', 'connections': connections})
+
+        return portal.redirect(request.localip)
+
+
+# One client connection.  Reads requests, hands them to the app in order and
+# writes the responses back, for as long as the client keeps the connection
+# alive and doesn't go quiet for longer than the server's timeout.
+class Connection(object):
+
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.loop = server.loop
+        self.sock = sock
+        self.clientip = address[0]
+        self.localip = sock.getsockname()[0]
+        self.inbuf = ''
+        self.outbuf = ''
+        self.closing = False
+        self.handshaking = isinstance(sock, ssl.SSLSocket)
+        self.last_active = server.clock()
+        self.loop.add_reader(sock, self.on_readable)
+
+    def on_readable(self):
+        self.last_active = self.server.clock()
+        if self.handshaking:
+            self._handshake()
+            return
+        while True:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except ssl.SSLWantReadError:
+                break
+            except ssl.SSLWantWriteError:
+                self.loop.add_writer(self.sock, self.on_writable)
+                break
+            except (socket.error, ssl.SSLError), e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self.close()
+                return
+            if not data:
+                self.close()
+                return
+            self.inbuf += data
+
+            # SSL sockets can have decrypted data buffered that poll() won't
+            # tell us about.
+            if not isinstance(self.sock, ssl.SSLSocket) or not self.sock.pending():
+                break
+        self._process()
+
+    def _handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.loop.remove_writer(self.sock)
+            return
+        except ssl.SSLWantWriteError:
+            self.loop.add_writer(self.sock, self.on_writable)
+            return
+        except (socket.error, ssl.SSLError):
+            self.close()
+            return
+        self.handshaking = False
+        self.loop.remove_writer(self.sock)
+
+    # _process(): Answers every complete request in the input buffer.
+    def _process(self):
+        while not self.closing:
+            end = self.inbuf.find('\r\n\r\n')
+            if end < 0:
+                if len(self.inbuf) > MAX_HEAD:
+                    self._error(431)
+                return
+            request = self._parse(self.inbuf[:end], end + 4)
+            if request is None:
+                return
+            try:
+                status, headers, body = self.server.app.handle(request)
+            except Exception:
+                logging.exception("Error handling %s %s.", request.method, request.path)
+                status, headers, body = 500, {}, ''
+            keep_alive = request.keep_alive() and headers.get('Connection') != 'close'
+            self._respond(status, headers, body, keep_alive, request.version,
+                          request.method == 'HEAD')
+
+    # _parse(): Builds an HTTPRequest out of the head of a request, removing
+    # it (and its body) from the input buffer.  Returns None if the body
+    # hasn't all arrived yet, or if the request was rejected.
+    def _parse(self, head, body_start):
+        lines = head.split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            self._error(400)
+            return None
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            self._error(400)
+            return None
+        if length > MAX_BODY or 'transfer-encoding' in headers:
+            self._error(413)
+            return None
+        if len(self.inbuf) < body_start + length:
+            return None
+        body = self.inbuf[body_start:body_start + length]
+        self.inbuf = self.inbuf[body_start + length:]
+
+        url = urlparse.urlsplit(target)
+        return HTTPRequest(method, url.path or '/', url.query, version, headers, body,
+                           self.clientip, self.localip)
+
+    # _respond(): Queues a response.  HTTP/1.0 clients get an HTTP/1.0
+    # response, which has to say so if the connection is kept open, and the
+    # answer to a HEAD request is everything but the body.
+    def _respond(self, status, headers, body, keep_alive, version='HTTP/1.1', head=False):
+        if version != 'HTTP/1.0':
+            version = 'HTTP/1.1'
+        lines = ['%s %d %s' % (version, status, REASONS.get(status, ''))]
+        for name, value in headers.items():
+            if name not in ('Content-Length', 'Connection'):
+                lines.append('%s: %s' % (name, value))
+        lines.append('Content-Length: %d' % len(body))
+        if not keep_alive:
+            lines.append('Connection: close')
+            self.closing = True
+        elif version == 'HTTP/1.0':
+            lines.append('Connection: keep-alive')
+        if head:
+            body = ''
+        self.outbuf += '\r\n'.join(lines) + '\r\n\r\n' + body
+        self.on_writable()
+
+    def _error(self, status):
+        self._respond(status, {}, '', False)
+
+    def on_writable(self):
+        if self.handshaking:
+            self._handshake()
+            return
+        while self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except ssl.SSLWantWriteError:
+                break
+            except ssl.SSLWantReadError:
+                break
+            except (socket.error, ssl.SSLError), e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self.close()
+                return
+            self.outbuf = self.outbuf[sent:]
+        if self.outbuf:
+            self.loop.add_writer(self.sock, self.on_writable)
+            return
+        self.loop.remove_writer(self.sock)
+        if self.closing:
+            self.close()
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.loop.remove(self.sock)
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self.sock = None
+        self.server.forget(self)
+
+
+# Listens on one address/port (optionally with TLS) and hands accepted
+# connections to Connection objects on the loop.
+class HTTPServer(object):
+
+    def __init__(self, loop, app, host, port, ssl_context=None, timeout=30,
+                 max_connections=1024, clock=time.time):
+        self.loop = loop
+        self.app = app
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.clock = clock
+        self.connections = set()
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+        loop.add_reader(self.listener, self.on_accept)
+        self._sweeper = loop.call_every(1.0, self.close_idle)
+        logging.debug("Serving %s on %s:%d.", 'https' if ssl_context else 'http', host, port)
+
+    def on_accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    return
+                if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                    logging.error("Out of file descriptors, not accepting connections.")
+                    return
+                raise
+            if len(self.connections) >= self.max_connections:
+                sock.close()
+                continue
+            sock.setblocking(False)
+            if self.ssl_context is not None:
+                try:
+                    sock = self.ssl_context.wrap_socket(sock, server_side=True,
+                                                        do_handshake_on_connect=False)
+                except (socket.error, ssl.SSLError):
+                    sock.close()
+                    continue
+            self.connections.add(Connection(self, sock, address))
+
+    def forget(self, connection):
+        self.connections.discard(connection)
+
+    # close_idle(): Closes every connection that has been quiet for longer
+    # than the timeout.
+    def close_idle(self):
+        cutoff = self.clock() - self.timeout
+        for connection in [c for c in self.connections if c.last_active < cutoff]:
+            connection.close()
+
+    def close(self):
+        self._sweeper.cancel()
+        for connection in list(self.connections):
+            connection.close()
+        self.loop.remove(self.listener)
+        self.listener.close()
+
+    def metrics(self):
+        return {'connections': len(self.connections)}
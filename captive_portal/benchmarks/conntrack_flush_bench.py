@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# conntrack_flush_bench.py
+# Measures how long it takes a client to reach the network after clicking
+# accept, with and without the captive portal flushing its connections from
+# conntrack, and how many more requests the portal has to answer meanwhile.
+# Prints the results as JSON.
+#
+# The kernel is modelled by a small proxy in this process standing in for
+# the DNAT rules: a new connection from a client that isn't whitelisted goes
+# to the captive portal, any other one goes to an "internet" web server, and
+# a connection stays wherever it went first until it's closed, like a
+# conntrack entry.  Deleting a client's DNATed entries resets the connections
+# it has to the portal, which is what the client sees when its next packet
+# reaches a server that never heard of the connection.  The portal itself is
+# the real thing (the async engine, the whitelist queue, WhitelistManager and
+# ConntrackBackend), running in this process with a whitelist backend that
+# updates the model.
+#
+# Each trial is one browser with a keep-alive connection: it asks for a page,
+# gets redirected to the portal, clicks accept, and then asks for the page
+# again straight away and every --reload seconds until the internet server
+# answers (or --give-up seconds pass).  A failed request on a reused
+# connection is retried on a new one at once, as browsers do.
+
+# Modules.
+import argparse
+import BaseHTTPServer
+import httplib
+import json
+import os
+import socket
+import SocketServer
+import struct
+import sys
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from async_portal import HTTPServer, PortalApp
+from captive_portal import CaptivePortal
+from conntrack import ConntrackBackend
+from event_loop import EventLoop
+from portal_redirect import PortalInterfaces
+from probes import ProbeResponder
+from template_cache import TemplateCache
+from whitelist import ArpTable, WhitelistManager
+from whitelist_queue import WhitelistQueue
+import whitelist_backends
+
+from portal_engines_bench import PORTAL_DIR, percentile
+
+CLIENT_MAC = '02:00:00:00:00:01'
+ARP_CACHE = ('IP address       HW type     Flags       HW address            Mask     Device\n'
+             '127.0.0.1        0x1         0x2         %s     *        lo\n' % CLIENT_MAC)
+
+
+# The kernel's side: the whitelist and the connection tracking table.
+class NatModel(object):
+
+    def __init__(self, portal_port, internet_port):
+        self.portal_port = portal_port
+        self.internet_port = internet_port
+        self.whitelist = set()
+        self._lock = threading.Lock()
+
+        # client IP address: [(client socket, upstream socket)] of connections
+        # that were DNATed to the portal.
+        self.dnated = {}
+
+    # The whitelist backend's session.
+    def send(self, script):
+        for line in script.splitlines():
+            fields = line.split()
+            if fields[0] == 'add':
+                self.whitelist.add(fields[2])
+            elif fields[0] == 'del':
+                self.whitelist.discard(fields[2])
+        return 0
+
+    def close(self):
+        pass
+
+    # conntrack(): Runs 'conntrack -D --dst-nat -s <client>' for
+    # ConntrackBackend.
+    def conntrack(self, command):
+        clientip = command[command.index('-s') + 1]
+        with self._lock:
+            flows = self.dnated.pop(clientip, [])
+        deleted = 0
+        for client, upstream in flows:
+            # Reset, not close: the client's next packet reaches a server that
+            # doesn't know the connection.
+            try:
+                client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                client.shutdown(socket.SHUT_RDWR)
+                upstream.shutdown(socket.SHUT_RDWR)
+                deleted += 1
+            except socket.error:
+                # Already closed by one end or the other.
+                pass
+        return 0 if deleted else 1
+
+    def route(self, client, clientip):
+        dnat = CLIENT_MAC not in self.whitelist
+        port = self.portal_port if dnat else self.internet_port
+        upstream = socket.create_connection(('127.0.0.1', port))
+        if dnat:
+            with self._lock:
+                self.dnated.setdefault(clientip, []).append((client, upstream))
+        return upstream
+
+
+class ModelBackend(whitelist_backends.IpsetBackend):
+
+    def __init__(self, model):
+        whitelist_backends.IpsetBackend.__init__(self)
+        self.model = model
+
+    def open_session(self):
+        return self.model
+
+    def listed(self):
+        return set(self.model.whitelist)
+
+
+def pump(source, destination):
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            destination.sendall(data)
+    except socket.error:
+        pass
+    for sock in (source, destination):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+class Gateway(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, model):
+        SocketServer.TCPServer.__init__(self, address, None)
+        self.model = model
+
+    def finish_request(self, client, address):
+        upstream = self.model.route(client, address[0])
+        thread = threading.Thread(target=pump, args=(upstream, client))
+        thread.daemon = True
+        thread.start()
+        pump(client, upstream)
+        thread.join()
+        client.close()
+        upstream.close()
+
+
+class InternetHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = 'the internet\n'
+        self.send_response(200)
+        self.send_header('X-Upstream', 'internet')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Internet(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+# start_portal(): Runs the captive portal in this process.  Returns the
+# CaptivePortal and the event loop it's served from.
+def start_portal(args, model, flush):
+    conntrack = None
+    if flush:
+        conntrack = ConntrackBackend(runner=model.conntrack)
+    arptable = ArpTable(injected_open=lambda path, mode: StringIO(ARP_CACHE))
+    manager = WhitelistManager(ModelBackend(model), arptable, conntrack=conntrack)
+    queue = WhitelistQueue(manager)
+    interfaces = PortalInterfaces([('lo', '127.0.0.1')])
+    probes = ProbeResponder(interfaces.redirects[0], manager.is_client_whitelisted)
+    templates = TemplateCache(os.path.join(PORTAL_DIR, 'srv', 'captiveportal'), args.cachedir)
+    root = CaptivePortal(args, templates, manager, queue, interfaces, probes)
+
+    loop = EventLoop()
+    app = PortalApp(root)
+    app.servers.append(HTTPServer(loop, app, '127.0.0.1', args.port))
+    queue.start()
+    thread = threading.Thread(target=loop.run)
+    thread.daemon = True
+    thread.start()
+    return root, loop
+
+
+# Browser asks for pages over one keep-alive connection at a time.
+class Browser(object):
+
+    def __init__(self, gateway_port, timeout):
+        self.gateway_port = gateway_port
+        self.timeout = timeout
+        self.connection = None
+        self.portal_hits = 0
+        self.retries = 0
+
+    # get(): Returns the response to a request, retrying once on a fresh
+    # connection if the one it had was reset.
+    def get(self, path, host='example.com'):
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = httplib.HTTPConnection('127.0.0.1', self.gateway_port,
+                                                         timeout=self.timeout)
+            try:
+                self.connection.request('GET', path, headers={'Host': host})
+                response = self.connection.getresponse()
+                response.read()
+            except (httplib.HTTPException, socket.error):
+                self.connection.close()
+                self.connection = None
+                self.retries += 1
+                continue
+            if response.getheader('X-Upstream') != 'internet':
+                self.portal_hits += 1
+            return response
+        return None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+# trial(): One client clicking through.  Returns (seconds until the internet
+# answered or None, requests the portal answered after the click, retries).
+def trial(args, model, root):
+    browser = Browser(args.gateway_port, args.timeout)
+    browser.get('/news/today.html')
+    browser.get('/whitelist', host='127.0.0.1')
+    clicked = time.time()
+    browser.portal_hits = 0
+    reached = None
+    while time.time() - clicked < args.give_up:
+        response = browser.get('/news/today.html')
+        if response is not None and response.getheader('X-Upstream') == 'internet':
+            reached = time.time() - clicked
+            break
+        time.sleep(args.reload)
+    browser.close()
+
+    # Take the client back out for the next trial and wait for its old
+    # connections to be gone.
+    root.manager.remove(CLIENT_MAC)
+    model.conntrack(['-s', '127.0.0.1'])
+    time.sleep(0.1)
+    return reached, browser.portal_hits, browser.retries
+
+
+def rounded(value):
+    if value is None:
+        return None
+    return round(value, 1)
+
+
+def run(args, flush):
+    model = NatModel(args.port, args.internet_port)
+    internet = Internet(('127.0.0.1', args.internet_port), InternetHandler)
+    gateway = Gateway(('127.0.0.1', args.gateway_port), model)
+    serve(internet)
+    serve(gateway)
+    root, loop = start_portal(args, model, flush)
+    try:
+        reached, portal_hits, retries = [], [], 0
+        for _ in range(args.trials):
+            seconds, hits, retried = trial(args, model, root)
+            if seconds is not None:
+                reached.append(seconds * 1000)
+            portal_hits.append(hits)
+            retries += retried
+    finally:
+        loop.stop()
+        root.queue.stop()
+        gateway.shutdown()
+        gateway.server_close()
+        internet.shutdown()
+        internet.server_close()
+    reached.sort()
+    return {'trials': args.trials,
+            'reached': len(reached),
+            'gave_up': args.trials - len(reached),
+            'time_to_first_success_ms': {'p50': rounded(percentile(reached, 0.5)),
+                                         'p90': rounded(percentile(reached, 0.9)),
+                                         'max': rounded(reached[-1] if reached else None)},
+            'portal_requests_after_accept': sum(portal_hits),
+            'reconnects': retries}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time from clicking accept to reaching the network, with "
+                                     "and without flushing conntrack.")
+    parser.add_argument('--give-up', type=float, default=20.0,
+                        help="Seconds a browser keeps reloading before giving up.")
+    parser.add_argument('--reload', type=float, default=1.0,
+                        help="Seconds between reloads after clicking accept.")
+    parser.add_argument('--port', '-p', type=int, default=31437)
+    parser.add_argument('--gateway-port', type=int, default=31480)
+    parser.add_argument('--internet-port', type=int, default=31481)
+    parser.add_argument('--timeout', type=float, default=5.0)
+    parser.add_argument('--trials', '-n', type=int, default=10)
+    args = parser.parse_args()
+    args.cachedir = tempfile.mkdtemp()
+    args.throttle_close = False
+
+    results = {}
+    for flush in (False, True):
+        results['flush' if flush else 'no_flush'] = run(args, flush)
+        args.port += 1
+    print json.dumps(results, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# dns_builder_bench.py
+# Times fake_dns.py's two ways of building a reply: DNSQuery.respuesta()
+# (minidns_recipe.py, what it used to do), which concatenates strings and packs the address from its dotted quad for
+# every query, and ResponseBuilder.build(), which patches the query in its
+# receive buffer and copies a precomputed answer on the end, and how long it
+# takes DNSHijacker to answer the same query from its ReplyCache instead.
+# builder_hosts is build() looking the name up in an index of the 254 names
+# make_hosts() writes to /etc/hosts.mesh first, which it misses.
+# Prints microseconds per reply and replies per second for a few typical query
+# names as JSON.
+#
+# The query is copied into the buffer before each build(), standing in for
+# recvfrom_into(), while respuesta() is given the query as a string, the way
+# recvfrom() returns it, so neither side gets its input for free.
+
+# Modules.
+import argparse
+import json
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_dns import ReplyCache, ResponseBuilder, parse_hosts
+from minidns_recipe import DNSQuery
+
+IP = '192.168.1.1'
+
+NAMES = ['connectivitycheck.gstatic.com',
+         'www.msftconnecttest.com',
+         'captive.apple.com',
+         'a.very.long.name.with.many.labels.in.it.example.org']
+
+
+def query(name):
+    labels = ''.join(chr(len(label)) + label for label in name.split('.'))
+    return struct.pack('!HHHHHH', 0x1234, 0x0100, 1, 0, 0, 0) + labels + '\x00' + struct.pack('!HH', 1, 1)
+
+
+def old(data):
+    return lambda: DNSQuery(data).respuesta(IP)
+
+
+def new(data, hosts=None):
+    builder = ResponseBuilder(IP)
+    buf = bytearray(4096 + 16)
+    length = len(data)
+
+    def build():
+        buf[:length] = data
+        return builder.build(buf, length, hosts=hosts)
+    return build
+
+
+# mesh_hosts(): The index of what make_hosts() writes for a node.
+def mesh_hosts():
+    lines = ['10.1.2.1\tbyzantium.byzantium.mesh\n']
+    lines.extend('10.1.2.%d\tclient-10.1.2.%d.byzantium.mesh\n' % (i, i) for i in range(2, 255))
+    return parse_hosts(lines)
+
+
+# cached(): What DNSHijacker.on_readable() does with a query that's in its
+# cache.
+def cached(data):
+    cache = ReplyCache()
+    buf = bytearray(4096 + 16)
+    length = len(data)
+    buf[:length] = data
+    key = str(buf[2:length])
+    size = ResponseBuilder(IP).build(buf, length)
+    cache.put(key, str(buf[2:size]))
+
+    def hit():
+        buf[:length] = data
+        reply = cache.get(str(buf[2:length]))
+        size = len(reply) + 2
+        buf[2:size] = reply
+        return size
+    return hit
+
+
+def measure(function, number, repeat):
+    best = min(timeit.repeat(function, number=number, repeat=repeat))
+    return {'us_per_reply': round(best / number * 1e6, 3),
+            'replies_per_second': int(number / best)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DNSQuery.respuesta() against ResponseBuilder.build().")
+    parser.add_argument('--number', '-n', type=int, default=100000,
+                        help="Replies built per timing.")
+    parser.add_argument('--repeat', '-r', type=int, default=5,
+                        help="Timings taken; the best is reported.")
+    args = parser.parse_args()
+
+    results = {}
+    hosts = mesh_hosts()
+    for name in NAMES:
+        data = query(name)
+        buf = bytearray(data + '\x00' * 16)
+        size = ResponseBuilder(IP).build(buf, len(data))
+        assert str(buf[:size]) == DNSQuery(data).respuesta(IP)
+        before = measure(old(data), args.number, args.repeat)
+        after = measure(new(data), args.number, args.repeat)
+        hit = measure(cached(data), args.number, args.repeat)
+        with_hosts = measure(new(data, hosts), args.number, args.repeat)
+        results[name] = {'respuesta': before, 'builder': after, 'cache_hit': hit, 'builder_hosts': with_hosts,
+                         'speedup': round(before['us_per_reply'] / after['us_per_reply'], 2),
+                         'cache_speedup': round(before['us_per_reply'] / hit['us_per_reply'], 2)}
+    print json.dumps(results, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
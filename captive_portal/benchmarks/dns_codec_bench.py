@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# dns_codec_bench.py
+# Times dns_codec.py against the recipe fake_dns.py and distdns used to carry
+# (DNSQuery, in minidns_recipe.py): checking a query without reading its name
+# (check_query(), what fake_dns.py does), parsing it with the name
+# (parse_query(), what distdns does), reading a compressed name out of a
+# reply, and writing a reply with one and with five answers.  Prints
+# microseconds per operation as JSON.
+#
+# The recipe doesn't check anything, and only ever writes one answer
+# uncompressed, so it's timed on the operations it can do at all.
+
+# Modules.
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import dns_codec
+from minidns_recipe import DNSQuery
+
+IP = '192.168.1.1'
+NAME = 'connectivitycheck.gstatic.com'
+
+
+def query(name):
+    labels = ''.join(chr(len(label)) + label for label in name.split('.'))
+    return struct.pack('!HHHHHH', 0x1234, 0x0100, 1, 0, 0, 0) + labels + '\x00' + struct.pack('!HH', 1, 1)
+
+
+# reply(): A reply to data with answers A records for its name.
+def reply(data, answers):
+    query_ = dns_codec.parse_query(data)
+    encoder = dns_codec.response(query_)
+    for i in range(answers):
+        encoder.answer(query_.labels, dns_codec.TYPE_A, 60, socket.inet_aton('10.0.0.%d' % (i + 1)))
+    return encoder.tostring()
+
+
+def measure(function, number, repeat):
+    best = min(timeit.repeat(function, number=number, repeat=repeat))
+    return round(best / number * 1e6, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="dns_codec.py against the DNSQuery recipe.")
+    parser.add_argument('--number', '-n', type=int, default=100000,
+                        help="Operations per timing.")
+    parser.add_argument('--repeat', '-r', type=int, default=5,
+                        help="Timings taken; the best is reported.")
+    args = parser.parse_args()
+
+    data = query(NAME)
+    buf = bytearray(data)
+    length = len(data)
+    query_ = dns_codec.parse_query(data)
+    address = socket.inet_aton(IP)
+    five = reply(data, 5)
+
+    def encode(answers):
+        def encode_():
+            encoder = dns_codec.response(query_)
+            for i in range(answers):
+                encoder.answer(query_.labels, dns_codec.TYPE_A, 60, address)
+            return encoder.tostring()
+        return encode_
+
+    results = {
+        'recipe_parse': measure(lambda: DNSQuery(data), args.number, args.repeat),
+        'recipe_parse_and_reply': measure(lambda: DNSQuery(data).respuesta(IP), args.number, args.repeat),
+        'check_query': measure(lambda: dns_codec.check_query(buf, length), args.number, args.repeat),
+        'parse_query': measure(lambda: dns_codec.parse_query(buf, length), args.number, args.repeat),
+        'parse_query_str': measure(lambda: dns_codec.parse_query(data), args.number, args.repeat),
+        'read_compressed_name': measure(lambda: dns_codec.read_name(five, len(five) - 16),
+                                        args.number, args.repeat),
+        'encode_1_answer': measure(encode(1), args.number, args.repeat),
+        'encode_5_answers': measure(encode(5), args.number, args.repeat),
+    }
+    sizes = {'recipe_reply': len(DNSQuery(data).respuesta(IP)),
+             'reply_1_answer': len(reply(data, 1)),
+             'reply_5_answers': len(five)}
+    print json.dumps({'name': NAME, 'us': results, 'bytes': sizes}, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
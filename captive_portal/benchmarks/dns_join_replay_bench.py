@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# dns_join_replay_bench.py
+# Replays the lookups a client makes in its first --duration seconds on the
+# network, before it's been through the captive portal, against fake_dns.py's
+# old replies (DNSQuery.respuesta(), in minidns_recipe.py) and its current
+# ones (ResponseBuilder), and counts the queries that reach the hijacker.
+# Prints the totals per kind of client, and for all of them together, as JSON.
+#
+# The clients are modelled on what their operating systems and a few
+# background apps look up: A and AAAA for the captive portal probe hosts every
+# probe interval, HTTPS (SVCB) records on iOS, a PTR for the gateway, EDNS0 on
+# the resolvers that use it.  Each one has a stub resolver that
+#   - caches answers for their TTL, and NODATA for the SOA minimum if there
+#     is an SOA to go by, and nothing otherwise;
+#   - tries a query up to --attempts times when the reply is unusable: no
+#     reply, one it can't parse, or answers of a type it didn't ask for;
+#   - drops EDNS0 for the rest of a lookup once a try with it has failed.
+# Everything is built in this process, so no sockets or timing are involved.
+
+# Modules.
+import argparse
+import json
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_dns import ResponseBuilder, ROOM
+from minidns_recipe import DNSQuery
+
+IP = '192.168.1.1'
+
+A, PTR, AAAA, HTTPS = 1, 12, 28, 65
+
+# Kind of client: (interval, [(name, record types)], EDNS0).
+CLIENTS = {
+    'android': [(10, [('connectivitycheck.gstatic.com', (A, AAAA)), ('www.google.com', (A, AAAA))], True),
+                (5, [('mtalk.google.com', (A, AAAA)), ('play.googleapis.com', (A, AAAA))], True)],
+    'ios': [(10, [('captive.apple.com', (A, AAAA, HTTPS))], True),
+            (5, [('gateway.icloud.com', (A, AAAA, HTTPS)), ('init.push.apple.com', (A, AAAA))], True)],
+    'windows': [(15, [('www.msftconnecttest.com', (A, AAAA)), ('dns.msftncsi.com', (A, AAAA))], False),
+                (5, [('login.live.com', (A, AAAA))], False)],
+}
+
+# Everyone asks for the gateway's name once.
+GATEWAY_PTR = '1.1.168.192.in-addr.arpa'
+
+
+def query(name, qtype, edns, txid):
+    labels = ''.join(chr(len(label)) + label for label in name.split('.'))
+    data = (struct.pack('!HHHHHH', txid, 0x0100, 1, 0, 0, 1 if edns else 0) + labels + '\x00' +
+            struct.pack('!HH', qtype, 1))
+    if edns:
+        data += '\x00' + struct.pack('!HHIH', 41, 1232, 0, 0)
+    return data
+
+
+def old_server(data):
+    return DNSQuery(data).respuesta(IP) or None
+
+
+def new_server(data):
+    builder = ResponseBuilder(IP)
+    buf = bytearray(data + '\x00' * ROOM)
+    size = builder.build(buf, len(data))
+    if not size:
+        return None
+    return str(buf[:size])
+
+
+# skip_name(): Offset just past the name at offset in packet.
+def skip_name(packet, offset):
+    while True:
+        length = ord(packet[offset])
+        if length & 0xc0 == 0xc0:
+            return offset + 2
+        offset += length + 1
+        if not length:
+            return offset
+
+
+# parse(): What a stub resolver makes of a reply to a query for qtype:
+# ('answer', ttl), ('nodata', seconds to cache it, or 0), or None if it's no
+# use.
+def parse(reply, qtype):
+    if reply is None:
+        return None
+    try:
+        flags, qdcount, ancount, nscount, arcount = struct.unpack('!HHHHH', reply[2:12])
+        if not flags & 0x8000 or flags & 0xf or qdcount != 1:
+            return None
+        offset = skip_name(reply, 12) + 4
+        records = []
+        for i in range(ancount + nscount):
+            offset = skip_name(reply, offset)
+            rtype, rclass, ttl, rdlength = struct.unpack('!HHIH', reply[offset:offset + 10])
+            rdata = reply[offset + 10:offset + 10 + rdlength]
+            if len(rdata) != rdlength:
+                return None
+            records.append((i < ancount, rtype, ttl, rdata))
+            offset += 10 + rdlength
+    except (IndexError, struct.error):
+        return None
+    answers = [record for record in records if record[0]]
+    if answers:
+        matching = [ttl for answer, rtype, ttl, rdata in answers if rtype == qtype]
+        if not matching:
+            return None
+        return ('answer', min(matching))
+    for answer, rtype, ttl, rdata in records:
+        if rtype == 6:
+            return ('nodata', min(ttl, struct.unpack('!I', rdata[-4:])[0]))
+    return ('nodata', 0)
+
+
+class StubResolver(object):
+
+    def __init__(self, server, attempts):
+        self.server = server
+        self.attempts = attempts
+        self.cache = {}
+        self.queries = 0
+        self.failed = 0
+
+    def lookup(self, now, name, qtype, edns):
+        if self.cache.get((name, qtype), 0) > now:
+            return
+        for attempt in range(self.attempts):
+            self.queries += 1
+            result = parse(self.server(query(name, qtype, edns, self.queries & 0xffff)), qtype)
+            if result is not None:
+                self.cache[(name, qtype)] = now + result[1]
+                return
+            edns = False
+        self.failed += 1
+
+
+def replay(kind, server, args):
+    resolver = StubResolver(server, args.attempts)
+    resolver.lookup(0, GATEWAY_PTR, PTR, False)
+    for now in range(args.duration):
+        for interval, lookups, edns in CLIENTS[kind]:
+            if now % interval:
+                continue
+            for name, qtypes in lookups:
+                for qtype in qtypes:
+                    resolver.lookup(now, name, qtype, edns)
+    return resolver
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Queries per client join, with fake_dns.py's old and "
+                                     "current replies.")
+    parser.add_argument('--attempts', type=int, default=3,
+                        help="Tries a stub resolver makes per lookup.")
+    parser.add_argument('--duration', type=int, default=60,
+                        help="Seconds of lookups replayed per client.")
+    args = parser.parse_args()
+
+    results = {}
+    totals = {'old': 0, 'new': 0}
+    for kind in sorted(CLIENTS):
+        old = replay(kind, old_server, args)
+        new = replay(kind, new_server, args)
+        totals['old'] += old.queries
+        totals['new'] += new.queries
+        results[kind] = {'queries_old': old.queries, 'failed_lookups_old': old.failed,
+                         'queries_new': new.queries, 'failed_lookups_new': new.failed,
+                         'reduction': round(1 - float(new.queries) / old.queries, 3)}
+    results['all'] = {'queries_old': totals['old'], 'queries_new': totals['new'],
+                      'reduction': round(1 - float(totals['new']) / totals['old'], 3)}
+    print json.dumps(results, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# dns_load_bench.py
+# A dnsperf-style load generator for the DNS servers in this tree: the captive
+# portal's hijacker (fake_dns.py) and distdns/dnsserver.py.  Sends queries at
+# a fixed rate, whether or not the earlier ones have been answered, and prints
+# the rate actually answered, the loss and the latency percentiles as JSON, so
+# a regression shows up as a number.
+#
+# The queries are a mix of what a captive portal sees: A and AAAA for the
+# operating systems' connectivity check hosts, HTTPS (SVCB) records, A for
+# random names that were never asked for before, and malformed packets.
+# --mix changes the proportions.  A well-formed query that isn't answered
+# within --timeout seconds is lost; malformed ones aren't expected to be
+# answered, and only how many were is reported.  achieved_qps and the latency
+# percentiles only count well-formed queries that were answered in time.  If
+# the server was started here and died during the run, server_exited has its
+# exit code.
+#
+# With --server fake_dns or --server distdns the server is started on
+# 127.0.0.1:--port and stopped afterwards; otherwise --server is the address
+# of one that's already running.  The load comes from --processes processes,
+# each sending from --sockets source ports, because SO_REUSEPORT (fake_dns.py
+# --workers) spreads queries by source port.
+
+# Modules.
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import select
+import socket
+import string
+import struct
+import subprocess
+import sys
+import time
+
+from portal_engines_bench import PORTAL_DIR, percentile
+
+DISTDNS_DIR = os.path.join(os.path.dirname(PORTAL_DIR), 'distdns')
+
+A, AAAA, HTTPS = 1, 28, 65
+
+CHECK_NAMES = ['connectivitycheck.gstatic.com', 'clients3.google.com', 'captive.apple.com',
+               'www.msftconnecttest.com', 'dns.msftncsi.com', 'detectportal.firefox.com']
+
+DEFAULT_MIX = 'check=40,aaaa=25,https=5,random=20,malformed=10'
+
+
+def question(name, qtype):
+    labels = ''.join(chr(len(label)) + label for label in name.split('.'))
+    return labels + '\x00' + struct.pack('!HH', qtype, 1)
+
+
+# Everything in a query but its transaction ID, for each kind of query.
+def templates(count):
+    header = struct.pack('!HHHHH', 0x0100, 1, 0, 0, 0)
+    randoms = []
+    for i in range(count):
+        label = ''.join(random.choice(string.ascii_lowercase) for j in range(12))
+        randoms.append(header + question('%s.%s' % (label, random.choice(['com', 'net', 'org'])), A))
+    good = header + question('example.com', A)
+    malformed = [good[:9],  # Cut short in the header.
+                 good[:14],  # Cut short in the name.
+                 header + '\x50' + 'x' * 80 + '\x00\x00\x01\x00\x01',  # A label that's too long.
+                 struct.pack('!HHHHH', 0x8180, 1, 0, 0, 0) + question('example.com', A),  # A response.
+                 struct.pack('!HHHHH', 0x0100, 0, 0, 0, 0)]  # No question.
+    return {'check': [header + question(name, A) for name in CHECK_NAMES],
+            'aaaa': [header + question(name, AAAA) for name in CHECK_NAMES],
+            'https': [header + question(name, HTTPS) for name in CHECK_NAMES],
+            'random': randoms,
+            'malformed': malformed}
+
+
+def parse_mix(text):
+    mix = []
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in ('check', 'aaaa', 'https', 'random', 'malformed'):
+            raise argparse.ArgumentTypeError("Unknown kind of query: %s" % kind)
+        mix.append((kind, int(weight)))
+    return mix
+
+
+def start_server(args):
+    if args.server == 'fake_dns':
+        command = [sys.executable, os.path.join(PORTAL_DIR, 'fake_dns.py'),
+                   '--listen', '127.0.0.1:%d' % args.port, '10.0.0.1']
+        if args.workers:
+            command[2:2] = ['--workers', str(args.workers)]
+    else:
+        command = [sys.executable, os.path.join(DISTDNS_DIR, 'dnsserver.py'), str(args.port)]
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+
+    # Wait for it to answer.
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.settimeout(0.2)
+    query = struct.pack('!H', 0) + templates(0)['check'][0]
+    deadline = time.time() + 10
+    try:
+        while time.time() < deadline:
+            probe.sendto(query, ('127.0.0.1', args.port))
+            try:
+                probe.recv(512)
+                return server
+            except socket.error:
+                pass
+    finally:
+        probe.close()
+    server.kill()
+    raise RuntimeError("%s didn't start answering." % args.server)
+
+
+def stop_server(server):
+    if server.poll() is None:
+        server.terminate()
+    server.wait()
+
+
+# generate(): One load generating process.  Sends qps queries a second for
+# duration seconds, then waits timeout seconds for stragglers, and puts its
+# counts and latencies on results.
+def generate(args, address, qps, start, results):
+    random.seed(os.getpid())
+    kinds = templates(args.names)
+    weighted = []
+    for kind, weight in args.mix:
+        weighted.extend([kind] * weight)
+
+    sockets = []
+    poller = select.epoll()
+    for i in range(args.sockets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        sock.setblocking(0)
+        poller.register(sock.fileno(), select.EPOLLIN)
+        sockets.append(sock)
+    by_fd = dict((sock.fileno(), sock) for sock in sockets)
+
+    # (fd, transaction ID): (time sent, kind)
+    pending = {}
+    counts = dict((kind, {'sent': 0, 'answered': 0}) for kind in kinds)
+    latencies = []
+    late = sent = 0
+
+    while time.time() < start:
+        time.sleep(0.001)
+    stop = start + args.duration
+    while True:
+        now = time.time()
+        if now >= stop + args.timeout or (now >= stop and not pending):
+            break
+
+        # Catch up with the schedule, a few at a time so that replies are
+        # still read when the generator can't keep up.
+        if now < stop:
+            due = min(int((now - start) * qps) - sent, 256)
+            for i in range(due):
+                sock = sockets[sent % len(sockets)]
+                txid = (sent // len(sockets)) & 0xffff
+                kind = random.choice(weighted)
+                try:
+                    sock.sendto(struct.pack('!H', txid) + random.choice(kinds[kind]), address)
+                except socket.error:
+                    pass
+                pending[(sock.fileno(), txid)] = (now, kind)
+                counts[kind]['sent'] += 1
+                sent += 1
+
+        for fd, event in poller.poll(0.001):
+            sock = by_fd[fd]
+            while True:
+                try:
+                    reply = sock.recv(4096)
+                except socket.error:
+                    break
+                if len(reply) < 2:
+                    continue
+                entry = pending.pop((fd, struct.unpack('!H', reply[:2])[0]), None)
+                if entry is None:
+                    continue
+                latency = time.time() - entry[0]
+                if latency > args.timeout:
+                    late += 1
+                    continue
+                counts[entry[1]]['answered'] += 1
+                if entry[1] != 'malformed':
+                    latencies.append(latency * 1000)
+    results.put((sent, counts, latencies, late))
+
+
+def run(args):
+    server = None
+    if args.server in ('fake_dns', 'distdns'):
+        server = start_server(args)
+        address = ('127.0.0.1', args.port)
+    else:
+        host, _, port = args.server.partition(':')
+        address = (host, int(port or 53))
+    try:
+        results = multiprocessing.Queue()
+        start = time.time() + 0.5
+        processes = [multiprocessing.Process(target=generate,
+                                             args=(args, address, float(args.qps) / args.processes,
+                                                   start, results))
+                     for i in range(args.processes)]
+        for process in processes:
+            process.start()
+        totals = [results.get() for process in processes]
+        for process in processes:
+            process.join()
+        exited = server.poll() if server is not None else None
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    sent = sum(total[0] for total in totals)
+    late = sum(total[3] for total in totals)
+    latencies = sorted(latency for total in totals for latency in total[2])
+    kinds = {}
+    for total in totals:
+        for kind, count in total[1].items():
+            kinds.setdefault(kind, {'sent': 0, 'answered': 0})
+            kinds[kind]['sent'] += count['sent']
+            kinds[kind]['answered'] += count['answered']
+    wellformed = sum(count['sent'] for kind, count in kinds.items() if kind != 'malformed')
+    answered = len(latencies)
+
+    result = {'server': args.server,
+              'target_qps': args.qps,
+              'duration': args.duration,
+              'sent': sent,
+              'answered': answered,
+              'achieved_qps': int(answered / args.duration),
+              'lost': wellformed - answered,
+              'late': late,
+              'loss': round(1 - float(answered) / wellformed, 4) if wellformed else None,
+              'latency_ms': dict((name, round(percentile(latencies, fraction), 3) if latencies else None)
+                                 for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99),
+                                                        ('max', 1.0))),
+              'kinds': kinds}
+    if exited is not None:
+        result['server_exited'] = exited
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loads a DNS server with a captive portal's query mix and "
+                                     "reports the rate answered, loss and latency.")
+    parser.add_argument('--server', default='fake_dns',
+                        help="fake_dns or distdns to start one on --port, or HOST[:PORT] of a running "
+                        "server.  (Defaults to fake_dns.)")
+    parser.add_argument('--port', '-p', type=int, default=31440)
+    parser.add_argument('--workers', type=int, default=0,
+                        help="fake_dns.py --workers, when it's started here.")
+    parser.add_argument('--qps', '-q', type=int, nargs='+', default=[10000],
+                        help="Queries per second to send.  Several rates are run one after another.")
+    parser.add_argument('--duration', '-d', type=float, default=5.0,
+                        help="Seconds to send queries for at each rate.")
+    parser.add_argument('--timeout', type=float, default=1.0,
+                        help="Seconds after which an unanswered query is lost.")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help="Weights of each kind of query.  (Defaults to %s.)" % DEFAULT_MIX)
+    parser.add_argument('--names', type=int, default=1000,
+                        help="Random names each process picks from.")
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--sockets', type=int, default=64,
+                        help="Source ports each process sends from.")
+    args = parser.parse_args()
+
+    rates = args.qps
+    results = []
+    for qps in rates:
+        args.qps = qps
+        results.append(run(args))
+    print json.dumps(results if len(results) > 1 else results[0], indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
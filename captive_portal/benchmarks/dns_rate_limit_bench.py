@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# dns_rate_limit_bench.py
+# What fake_dns.py's RateLimiter costs and what it buys.  Prints as JSON:
+#   - overhead: microseconds allow() and check() add to every query, for one
+#     client asking for the same name, and for a flood from random sources
+#     that keeps the tables full and churning.
+#   - flood: one client of the node sending --flood-qps queries a second
+#     alongside --clients ordinary ones that each look up a few names a
+#     second, all in the node's client network, which isn't response rate
+#     limited.  How many of each are answered.
+#   - reflection: --flood-qps queries a second spoofed to come from random
+#     addresses in a victim's /24.  The replies and bytes sent at it each
+#     second, with and without the limiter.
+# The scenarios run in simulated time over --duration seconds, with the
+# queries built by ResponseBuilder as DNSHijacker would, so no sockets are
+# involved and a one core machine can play both sides.
+
+# Modules.
+import argparse
+import json
+import os
+import random
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_dns import RateLimiter, ResponseBuilder, ROOM, client_network
+
+IP = '10.0.0.1'
+
+
+def query(name, txid=0):
+    labels = ''.join(chr(len(label)) + label for label in name.split('.'))
+    return struct.pack('!HHHHHH', txid, 0x0100, 1, 0, 0, 0) + labels + '\x00' + struct.pack('!HH', 1, 1)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# Simulator answers queries the way DNSHijacker.on_readable() does, at the
+# time on its clock.
+class Simulator(object):
+
+    def __init__(self, limiter=None):
+        self.builder = ResponseBuilder(IP)
+        self.limiter = limiter
+        self.clients = client_network(IP)
+        self.buf = bytearray(512 + ROOM)
+
+    # send(): The size of the reply that goes to source, or 0 for none.
+    def send(self, source, data):
+        if self.limiter is not None and not self.limiter.allow(source):
+            return 0
+        self.buf[:len(data)] = data
+        size = self.builder.build(self.buf, len(data))
+        if size and self.limiter is not None and not source.startswith(self.clients):
+            size = self.limiter.check(source, self.buf, size)
+        return size
+
+
+def overhead(args):
+    data = query('connectivitycheck.gstatic.com')
+    buf = bytearray(data + '\x00' * ROOM)
+    size = ResponseBuilder(IP).build(buf, len(data))
+    sources = ['10.%d.%d.%d' % (random.randrange(256), random.randrange(256), random.randrange(256))
+               for i in range(65536)]
+
+    def one_client(limiter=RateLimiter(rate=1e9, burst=1e9, responses=1e9)):
+        limiter.allow('10.0.0.2')
+        limiter.check('10.0.0.2', buf, size)
+
+    def spoofed(limiter=RateLimiter(), counter=[0]):
+        counter[0] += 1
+        source = sources[counter[0] & 0xffff]
+        limiter.allow(source)
+        limiter.check(source, buf, size)
+
+    results = {}
+    for name, function in (('one_client', one_client), ('spoofed_sources', spoofed)):
+        best = min(timeit.repeat(function, number=args.number, repeat=args.repeat))
+        results[name] = round(best / args.number * 1e6, 3)
+    return {'us_per_query': results}
+
+
+def flood(args):
+    clock = Clock()
+    simulator = Simulator(RateLimiter(clock=clock))
+    names = ['connectivitycheck.gstatic.com', 'www.google.com', 'captive.apple.com', 'mtalk.google.com']
+    counts = {'flooder': [0, 0], 'clients': [0, 0]}
+
+    # (time, source, query) for every query, in order.
+    events = []
+    for i in range(int(args.flood_qps * args.duration)):
+        events.append((i / float(args.flood_qps), '10.0.0.66', query('example.com', i & 0xffff)))
+    for client in range(args.clients):
+        for i in range(int(args.client_qps * args.duration)):
+            events.append((random.uniform(0, args.duration), '10.0.0.%d' % (client + 100),
+                           query(random.choice(names), i & 0xffff)))
+    events.sort()
+    for when, source, data in events:
+        clock.now = when
+        who = 'flooder' if source == '10.0.0.66' else 'clients'
+        counts[who][0] += 1
+        if simulator.send(source, data):
+            counts[who][1] += 1
+    return dict((who, {'sent': sent, 'answered': answered,
+                       'answered_fraction': round(float(answered) / sent, 4)})
+                for who, (sent, answered) in counts.items())
+
+
+def reflection(args):
+    results = {}
+    for limited in (False, True):
+        clock = Clock()
+        simulator = Simulator(RateLimiter(clock=clock) if limited else None)
+        replies = sent_bytes = slipped = 0
+        total = int(args.flood_qps * args.duration)
+        for i in range(total):
+            clock.now = i / float(args.flood_qps)
+            source = '10.9.9.%d' % random.randrange(1, 255)
+            size = simulator.send(source, query('example.com', i & 0xffff))
+            if size:
+                replies += 1
+                sent_bytes += size
+        result = {'replies_per_second': int(replies / args.duration),
+                  'bytes_per_second': int(sent_bytes / args.duration)}
+        if limited:
+            result['slipped_per_second'] = int(simulator.limiter.slipped / args.duration)
+        results['limited' if limited else 'unlimited'] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="The cost and effect of fake_dns.py's rate limiting.")
+    parser.add_argument('--number', '-n', type=int, default=100000,
+                        help="Queries per timing of the overhead.")
+    parser.add_argument('--repeat', '-r', type=int, default=5,
+                        help="Timings taken; the best is reported.")
+    parser.add_argument('--duration', '-d', type=float, default=10.0,
+                        help="Simulated seconds of each scenario.")
+    parser.add_argument('--flood-qps', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=20,
+                        help="Ordinary clients alongside the flood.")
+    parser.add_argument('--client-qps', type=float, default=2.0,
+                        help="Queries a second from each ordinary client.")
+    args = parser.parse_args()
+
+    random.seed(24)
+    print json.dumps({'overhead': overhead(args), 'flood': flood(args), 'reflection': reflection(args)},
+                     indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
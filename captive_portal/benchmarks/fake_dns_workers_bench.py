@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# fake_dns_workers_bench.py
+# Runs fake_dns.py with --workers 1, 2 and 4 in turn and measures how many
+# queries a second it answers.  Prints the results as JSON, along with the
+# number of cores, since more workers than cores can't help.
+#
+# The load comes from --clients processes, each with --sockets UDP sockets of
+# its own, keeping --window queries in flight on every socket for --duration
+# seconds.  SO_REUSEPORT picks a worker by hashing the source address and
+# port, so the load has to come from many sockets to be spread at all, the
+# way queries from a room full of phones would be.  Queries that go
+# unanswered for a second are given up on and counted as lost.
+
+# Modules.
+import argparse
+import json
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+PORTAL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUESTION = '\x0cconnectivity\x05check\x07gstatic\x03com\x00\x00\x01\x00\x01'
+
+
+def query(txid):
+    return struct.pack('!HHHHHH', txid & 0xffff, 0x0100, 1, 0, 0, 0) + QUESTION
+
+
+def start_hijacker(args, workers):
+    command = [sys.executable, os.path.join(PORTAL_DIR, 'fake_dns.py'),
+               '--workers', str(workers), '--listen', '127.0.0.1:%d' % args.port, '10.0.0.1']
+    with open(os.devnull, 'w') as devnull:
+        hijacker = subprocess.Popen(command, stdout=devnull)
+
+    # Wait for it to answer.
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.settimeout(0.2)
+    deadline = time.time() + 10
+    try:
+        while time.time() < deadline:
+            probe.sendto(query(0), ('127.0.0.1', args.port))
+            try:
+                probe.recv(512)
+                return hijacker
+            except socket.error:
+                pass
+    finally:
+        probe.close()
+    hijacker.kill()
+    raise RuntimeError("fake_dns.py --workers %d didn't start answering." % workers)
+
+
+def stop_hijacker(hijacker):
+    hijacker.send_signal(signal.SIGTERM)
+    hijacker.wait()
+
+
+# client(): One load generating process.  Puts (answered, sent) on results.
+def client(args, start, results):
+    address = ('127.0.0.1', args.port)
+    sockets = []
+    for i in range(args.sockets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        sockets.append(sock)
+    poller = select.epoll()
+    for sock in sockets:
+        poller.register(sock.fileno(), select.EPOLLIN)
+    by_fd = dict((sock.fileno(), sock) for sock in sockets)
+
+    # fd: [queries in flight, time of the last answer]
+    flight = dict((sock.fileno(), [0, 0]) for sock in sockets)
+    sent = answered = txid = 0
+
+    while time.time() < start:
+        time.sleep(0.01)
+    deadline = start + args.duration
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        for fd, state in flight.iteritems():
+            # Give up on queries that have gone unanswered for a second.
+            if state[0] and now - state[1] > 1.0:
+                state[0] = 0
+            while state[0] < args.window:
+                txid += 1
+                try:
+                    by_fd[fd].sendto(query(txid), address)
+                except socket.error:
+                    break
+                sent += 1
+                if not state[0]:
+                    state[1] = now
+                state[0] += 1
+        for fd, event in poller.poll(0.1):
+            sock = by_fd[fd]
+            while True:
+                try:
+                    sock.recv(512)
+                except socket.error:
+                    break
+                answered += 1
+                flight[fd][0] = max(flight[fd][0] - 1, 0)
+                flight[fd][1] = now
+    results.put((answered, sent))
+
+
+def run(args, workers):
+    hijacker = start_hijacker(args, workers)
+    try:
+        results = multiprocessing.Queue()
+        start = time.time() + 0.5
+        clients = [multiprocessing.Process(target=client, args=(args, start, results))
+                   for i in range(args.clients)]
+        for process in clients:
+            process.start()
+        totals = [results.get() for process in clients]
+        for process in clients:
+            process.join()
+    finally:
+        stop_hijacker(hijacker)
+    answered = sum(total[0] for total in totals)
+    sent = sum(total[1] for total in totals)
+    return {'answered': answered,
+            'sent': sent,
+            'lost': sent - answered,
+            'qps': int(answered / args.duration)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Queries per second answered by fake_dns.py at 1, 2 and 4 "
+                                     "workers.")
+    parser.add_argument('--clients', type=int, default=2,
+                        help="Load generating processes.")
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help="Seconds of load for each number of workers.")
+    parser.add_argument('--port', '-p', type=int, default=31439)
+    parser.add_argument('--sockets', type=int, default=32,
+                        help="Client sockets in each load generating process.")
+    parser.add_argument('--window', type=int, default=8,
+                        help="Queries in flight on each client socket.")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    results = {'cores': multiprocessing.cpu_count()}
+    for workers in args.workers:
+        results['workers_%d' % workers] = run(args, workers)
+    print json.dumps(results, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# minidns_recipe.py
+# The reply builder fake_dns.py used before dns_codec.py, from
+# http://code.activestate.com/recipes/491264-mini-fake-dns-server/, kept for
+# the benchmarks to compare against.  It answers every standard query with an
+# A record and raises IndexError on queries that are cut short.
+
+
+# DNSQuery class from http://code.activestate.com/recipes/491264-mini-fake-dns-server/
+class DNSQuery:
+    # 'data' is the actual DNS resolution request from the client.
+    def __init__(self, data):
+        self.data = data
+        self.domain = ''
+
+        tipo = (ord(data[2]) >> 3) & 15   # Opcode bits
+
+        # Determine if the client is making a standard resolution request.
+        # Otherwise, don't do anything because it's not a resolution request.
+        if tipo == 0:
+            ini = 12
+            lon = ord(data[ini])
+            while lon != 0:
+                self.domain += data[ini + 1:ini + lon + 1] + '.'
+                ini += lon + 1
+                lon = ord(data[ini])
+
+    # Build a reply packet for the client.
+    def respuesta(self, ip):
+        packet = ''
+        if self.domain:
+            packet += self.data[:2] + "\x81\x80"
+
+            # Question and answer counts.
+            packet += self.data[4:6] + self.data[4:6] + '\x00\x00\x00\x00'
+
+            # A copy of the original resolution query from the client.
+            packet += self.data[12:]
+
+            # Pointer to the domain name.
+            packet += '\xc0\x0c'
+
+            # Response type, TTL of the reply, and length of data in reply.
+            packet += '\x00\x01'  # TYPE: A record
+            packet += '\x00\x01'  # CLASS: IN (Internet)
+            packet += '\x00\x00\x00\x0f'  # TTL: 15 sec
+            packet += '\x00\x04'  # Length of data: 4 bytes
+
+            # The IP address of the server the DNS is running on.
+            packet += str.join('', map(lambda x: chr(int(x)), ip.split('.')))
+        return packet
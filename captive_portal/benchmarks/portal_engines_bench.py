@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# portal_engines_bench.py
+# Runs captive_portal.py --test with each web server engine in turn, holds 10,
+# 100 and 500 keep-alive connections open against it the way a room full of
+# phones does, and measures the daemon's resident memory and the latency of
+# requests sent over those connections.  Prints the results as JSON.
+#
+# Requests go out one at a time, round robin across the open connections, so
+# latency is what a client sees when it comes back to a connection it has been
+# holding.  A request that doesn't get an answer within --timeout seconds
+# counts as an error rather than a latency.
+#
+# The daemon only listens on localhost and doesn't touch the firewall, so this
+# can be run anywhere the portal's dependencies are installed.  CherryPy wants
+# a certificate for its HTTPS listener even in test mode; pass one with
+# --certificate and --key if /etc/httpd doesn't have one.
+
+# Modules.
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+PORTAL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+REQUEST = 'GET /some/unknown/url HTTP/1.1\r\nHost: example.com\r\n\r\n'
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+# rss_kb(): Resident set size of a process in kB, from /proc.
+def rss_kb(pid):
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return None
+
+
+def start_portal(args, engine, extra=()):
+    command = [sys.executable, os.path.join(PORTAL_DIR, 'captive_portal.py'),
+               '--test', '-i', 'lo', '-a', '127.0.0.1', '-p', str(args.port),
+               '--engine', engine, '--pidfile', '/tmp/portal_engines_bench.',
+               '--filedir', os.path.join(PORTAL_DIR, 'srv/captiveportal'),
+               '--appconfig', os.path.join(PORTAL_DIR, 'etc/captiveportal/captiveportal.conf'),
+               '-c', args.certificate, '-k', args.key]
+
+    # Every simulated client comes from 127.0.0.1, so per-client rate limiting
+    # would throttle the lot of them as one.
+    command.extend(['--rate-limit', '0'])
+    command.extend(extra)
+    with open(os.devnull, 'w') as devnull:
+        portal = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+
+    # Wait for it to start listening.
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', args.port), 1).close()
+            return portal
+        except socket.error:
+            time.sleep(0.2)
+    portal.kill()
+    raise RuntimeError("captive_portal.py --engine %s didn't start listening." % engine)
+
+
+# stop_portal(): Interrupts the daemon the way ^C would, which both engines
+# treat as a clean shutdown that removes the PID file.
+def stop_portal(portal):
+    portal.send_signal(signal.SIGINT)
+    deadline = time.time() + 10
+    while portal.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    if portal.poll() is None:
+        portal.kill()
+        portal.wait()
+
+
+# request(): Sends one request over sock and reads the whole response.
+# Returns the time it took, or None if it failed.
+def request(sock, timeout):
+    started = time.time()
+    try:
+        sock.settimeout(timeout)
+        sock.sendall(REQUEST)
+        response = ''
+        while '\r\n\r\n' not in response:
+            data = sock.recv(65536)
+            if not data:
+                return None
+            response += data
+        head, body = response.split('\r\n\r\n', 1)
+        length = 0
+        for line in head.split('\r\n'):
+            if line.lower().startswith('content-length:'):
+                length = int(line.split(':', 1)[1])
+        while len(body) < length:
+            data = sock.recv(65536)
+            if not data:
+                return None
+            body += data
+    except socket.error:
+        return None
+    return time.time() - started
+
+
+def bench(args, engine, connections):
+    portal = start_portal(args, engine)
+    sockets = []
+    errors = 0
+    try:
+        baseline = rss_kb(portal.pid)
+        for _ in range(connections):
+            try:
+                sockets.append(socket.create_connection(('127.0.0.1', args.port), args.timeout))
+            except socket.error:
+                errors += 1
+
+        latencies = []
+        for i in range(max(args.requests, len(sockets))):
+            if not sockets:
+                break
+            latency = request(sockets[i % len(sockets)], args.timeout)
+            if latency is None:
+                errors += 1
+            else:
+                latencies.append(latency)
+        rss = rss_kb(portal.pid)
+    finally:
+        for sock in sockets:
+            sock.close()
+        stop_portal(portal)
+
+    return {'engine': engine,
+            'connections': connections,
+            'rss_kb': {'idle': baseline, 'loaded': rss},
+            'requests': len(latencies),
+            'errors': errors,
+            'latency_ms': {'p50': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+                           'p99': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the captive portal's web server engines.")
+    parser.add_argument('--certificate', '-c', default='/etc/httpd/server.crt')
+    parser.add_argument('--key', '-k', default='/etc/httpd/server.key')
+    parser.add_argument('--connections', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--engines', nargs='+', default=['cherrypy', 'async'])
+    parser.add_argument('--port', '-p', type=int, default=31437)
+    parser.add_argument('--requests', type=int, default=1000,
+                        help="Requests to send at each connection count.  (Defaults to 1000.)")
+    parser.add_argument('--timeout', type=float, default=5.0)
+    args = parser.parse_args()
+
+    results = []
+    for engine in args.engines:
+        for connections in args.connections:
+            results.append(bench(args, engine, connections))
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
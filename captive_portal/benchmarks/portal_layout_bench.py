@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# portal_layout_bench.py
+# Measures how much memory one interface's captive portal costs laid out the
+# usual way (captive_portal.py plus fake_dns.py and mop_up_dead_clients.py, a
+# Python interpreter each) and with captive_portal.py --in-process, which runs
+# the DNS hijacker and the reaper inside the web server's process.  Prints the
+# RSS and PSS of every process and the totals as JSON.
+#
+# RSS counts shared pages (libpython and friends) once per process, which is
+# what it costs if nothing is shared; PSS splits shared pages between the
+# processes sharing them, which is closer to what the node actually loses.
+# Everything runs in test mode on localhost, so this can run anywhere; the
+# fake DNS server wants UDP port 31339 to be free.
+
+# Modules.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from portal_engines_bench import PORTAL_DIR, rss_kb, start_portal, stop_portal
+
+
+# pss_kb(): Proportional set size of a process in kB, or None if the kernel
+# doesn't say.
+def pss_kb(pid):
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as smaps:
+            for line in smaps:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def memory(name, pid):
+    return {'process': name, 'rss_kb': rss_kb(pid), 'pss_kb': pss_kb(pid)}
+
+
+def total(processes, key):
+    values = [process[key] for process in processes]
+    if None in values:
+        return None
+    return sum(values)
+
+
+def measure(args, engine, in_process):
+    extra = ['--in-process'] if in_process else []
+    portal = start_portal(args, engine, extra)
+    helpers = []
+    try:
+        if not in_process:
+            with open(os.devnull, 'w') as devnull:
+                helpers.append(('fake_dns.py', subprocess.Popen(
+                    [sys.executable, os.path.join(PORTAL_DIR, 'fake_dns.py'), '127.0.0.1'],
+                    stdout=devnull, stderr=devnull)))
+                helpers.append(('mop_up_dead_clients.py', subprocess.Popen(
+                    [sys.executable, os.path.join(PORTAL_DIR, 'mop_up_dead_clients.py'),
+                     '-m', '600', '-i', '60'], stdout=devnull, stderr=devnull)))
+        time.sleep(args.settle)
+        processes = [memory('captive_portal.py', portal.pid)]
+        processes.extend(memory(name, helper.pid) for name, helper in helpers)
+    finally:
+        for name, helper in helpers:
+            helper.kill()
+            helper.wait()
+        stop_portal(portal)
+
+    return {'engine': engine,
+            'layout': 'in-process' if in_process else 'three processes',
+            'processes': processes,
+            'rss_kb': total(processes, 'rss_kb'),
+            'pss_kb': total(processes, 'pss_kb')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the memory used by the captive portal's process layouts.")
+    parser.add_argument('--certificate', '-c', default='/etc/httpd/server.crt')
+    parser.add_argument('--key', '-k', default='/etc/httpd/server.key')
+    parser.add_argument('--engines', nargs='+', default=['cherrypy', 'async'])
+    parser.add_argument('--port', '-p', type=int, default=31437)
+    parser.add_argument('--settle', type=float, default=3.0,
+                        help="Seconds to let everything start up before measuring.  (Defaults to 3.)")
+    args = parser.parse_args()
+
+    results = []
+    for engine in args.engines:
+        separate = measure(args, engine, False)
+        combined = measure(args, engine, True)
+        results.append({'engine': engine,
+                        'layouts': [separate, combined],
+                        'rss_saved_kb': separate['rss_kb'] - combined['rss_kb'],
+                        'pss_saved_kb': (separate['pss_kb'] - combined['pss_kb']
+                                         if separate['pss_kb'] and combined['pss_kb'] else None)})
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# portal_load_bench.py
+# Load test for the captive portal.  Starts captive_portal.py --test on
+# localhost and throws a simulated population of clients at it for a while.
+# Each client holds a keep-alive connection and loops over a mix of what real
+# clients send a portal: OS captive portal probes, requests for random URLs
+# that get redirected, front page fetches in various languages and clicks on
+# the accept button.  Reports throughput, latency percentiles (overall and per
+# kind of request) and the daemon's RSS over time as JSON, so releases can be
+# compared against each other.
+#
+# Clients are threads in this process, so on a slow machine the load
+# generator can run out of CPU before the portal does.  Run it on a different
+# core count or compare with fewer clients if the numbers look flat.  Like
+# portal_engines_bench.py it needs a certificate for CherryPy's HTTPS listener
+# (--certificate and --key) if /etc/httpd doesn't have one.
+
+# Modules.
+import argparse
+import httplib
+import json
+import random
+import threading
+import time
+
+from portal_engines_bench import percentile, rss_kb, start_portal, stop_portal
+
+# Host, path pairs of the probes clients send.
+PROBES = [('connectivitycheck.gstatic.com', '/generate_204'),
+          ('www.msftconnecttest.com', '/connecttest.txt'),
+          ('www.msftncsi.com', '/ncsi.txt'),
+          ('detectportal.firefox.com', '/success.txt'),
+          ('captive.apple.com', '/hotspot-detect.html')]
+
+LANGUAGES = ['en-US,en;q=0.9', 'fr-FR,fr;q=0.8,en;q=0.5', 'fr-CA', 'de-DE,de;q=0.9',
+             'es-419,es;q=0.8', None]
+
+# kind: relative weight in the mix.  Can be changed with --mix.
+MIX = {'probe': 40, '404': 30, 'index': 20, 'whitelist': 10}
+
+
+# next_request(): Picks a (kind, method, path, headers, body) out of the mix.
+def next_request(rng, mix):
+    kind = rng.choice(mix)
+    if kind == 'probe':
+        host, path = rng.choice(PROBES)
+        return kind, 'GET', path, {'Host': host}, None
+    if kind == '404':
+        return kind, 'GET', '/%08x/index.php' % rng.getrandbits(32), {'Host': 'example.com'}, None
+    if kind == 'index':
+        headers = {'Host': '127.0.0.1'}
+        language = rng.choice(LANGUAGES)
+        if language:
+            headers['Accept-Language'] = language
+        return kind, 'GET', '/', headers, None
+    return kind, 'POST', '/whitelist', {'Host': '127.0.0.1', 'Content-Type':
+                                        'application/x-www-form-urlencoded'}, 'accepted=1'
+
+
+class Client(threading.Thread):
+
+    def __init__(self, args, mix, deadline, seed):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.args = args
+        self.mix = mix
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+
+        # kind: [latencies]
+        self.latencies = dict((kind, []) for kind in MIX)
+        self.errors = 0
+
+    def run(self):
+        connection = None
+        while time.time() < self.deadline:
+            if connection is None:
+                connection = httplib.HTTPConnection('127.0.0.1', self.args.port,
+                                                    timeout=self.args.timeout)
+            kind, method, path, headers, body = next_request(self.rng, self.mix)
+            started = time.time()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                response.read()
+            except (httplib.HTTPException, IOError):
+                self.errors += 1
+                connection.close()
+                connection = None
+                continue
+            self.latencies[kind].append(time.time() - started)
+            if response.getheader('connection', '').lower() == 'close':
+                connection.close()
+                connection = None
+        if connection is not None:
+            connection.close()
+
+
+def summarize(latencies, elapsed):
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {'requests': len(latencies),
+            'throughput_rps': round(len(latencies) / elapsed, 1),
+            'latency_ms': {'p50': ms(percentile(latencies, 0.50)),
+                           'p95': ms(percentile(latencies, 0.95)),
+                           'p99': ms(percentile(latencies, 0.99))}}
+
+
+def run(args, mix, clients):
+    portal = start_portal(args, args.engine)
+    rss = []
+    try:
+        started = time.time()
+        deadline = started + args.duration
+        population = [Client(args, mix, deadline, args.seed + i) for i in range(clients)]
+        for client in population:
+            client.start()
+
+        # Sample the daemon's memory while the clients run.
+        while time.time() < deadline:
+            rss.append({'t': round(time.time() - started, 1), 'rss_kb': rss_kb(portal.pid)})
+            time.sleep(args.interval)
+        for client in population:
+            client.join(args.timeout + 1)
+        elapsed = time.time() - started
+        rss.append({'t': round(elapsed, 1), 'rss_kb': rss_kb(portal.pid)})
+    finally:
+        stop_portal(portal)
+
+    everything = []
+    kinds = {}
+    for kind in MIX:
+        latencies = sum((client.latencies[kind] for client in population), [])
+        everything.extend(latencies)
+        kinds[kind] = summarize(latencies, elapsed)
+    result = summarize(everything, elapsed)
+    result.update({'engine': args.engine,
+                   'clients': clients,
+                   'duration_s': round(elapsed, 1),
+                   'errors': sum(client.errors for client in population),
+                   'kinds': kinds,
+                   'rss': rss})
+    return result
+
+
+def parse_mix(text):
+    mix = dict(MIX)
+    for part in filter(None, text.split(',')):
+        kind, _, weight = part.partition('=')
+        if kind not in MIX:
+            raise SystemExit("Unknown kind of request in --mix: %s" % kind)
+        mix[kind] = int(weight)
+    return sum(([kind] * weight for kind, weight in mix.items()), [])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the captive portal with simulated clients.")
+    parser.add_argument('--certificate', '-c', default='/etc/httpd/server.crt')
+    parser.add_argument('--key', '-k', default='/etc/httpd/server.key')
+    parser.add_argument('--clients', '-n', type=int, nargs='+', default=[10, 50, 200],
+                        help="Sizes of client population to run, one after the other.")
+    parser.add_argument('--duration', '-d', type=float, default=30.0,
+                        help="Seconds to run each population for.  (Defaults to 30.)")
+    parser.add_argument('--engine', '-e', default='cherrypy', choices=['async', 'cherrypy'])
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help="Seconds between RSS samples.  (Defaults to 1.)")
+    parser.add_argument('--mix', default='',
+                        help="Weights of each kind of request, e.g. probe=40,404=30,index=20,whitelist=10.")
+    parser.add_argument('--port', '-p', type=int, default=31437)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=10.0)
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    print json.dumps([run(args, mix, clients) for clients in args.clients], indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# whitelist_backends_bench.py
+# Measures what adding, removing and looking up a client costs with each of
+# the captive portal's whitelist backends at 10, 100 and 1000 clients, and
+# prints the results as JSON.
+#
+# By default this runs a model of what the kernel does for every packet from
+# the client network: the shell backend's chain is walked rule by rule, the
+# ipset and nftables backends do one hash lookup.  That runs anywhere.
+#
+# With --live the real commands are run against the node's firewall, so it
+# has to be run as root on a node where captive-portal.sh initialize has
+# already set up the 'internet' chain.  Lookups are then timed with the
+# backend's contains() (iptables -C, ipset test, nft get element), which is
+# the closest thing userspace has to asking the kernel to match a packet.
+# Don't run it on a node with live clients: --live removes everything it
+# adds, but it shares the chain and sets with the daemon.
+
+# Modules.
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import whitelist_backends
+
+
+# fake_macs(): Returns count distinct, locally administered MAC addresses.
+def fake_macs(count):
+    return ['02:00:%02x:%02x:%02x:%02x' % ((i >> 24) & 255, (i >> 16) & 255,
+                                           (i >> 8) & 255, i & 255)
+            for i in range(count)]
+
+
+def mean_usec(started, operations):
+    return round((time.time() - started) * 1000000.0 / max(operations, 1), 3)
+
+
+# A stand-in for the kernel's side of each backend.  rules is what the packet
+# has to be matched against, in order.
+class ChainModel(object):
+    def __init__(self):
+        self.rules = []
+
+    def add(self, mac):
+        self.rules.insert(0, mac)
+
+    def remove(self, mac):
+        self.rules.remove(mac)
+
+    def contains(self, mac):
+        for rule in self.rules:
+            if rule == mac:
+                return True
+        return False
+
+
+class SetModel(object):
+    def __init__(self):
+        self.members = set()
+
+    def add(self, mac):
+        self.members.add(mac)
+
+    def remove(self, mac):
+        self.members.discard(mac)
+
+    def contains(self, mac):
+        return mac in self.members
+
+
+MODELS = {'shell': ChainModel, 'ipset': SetModel, 'nftables': SetModel}
+
+
+def bench(whitelist, size, lookups):
+    macs = fake_macs(size)
+
+    started = time.time()
+    for mac in macs:
+        whitelist.add(mac)
+    add = mean_usec(started, size)
+
+    # Look up whitelisted clients at random spots in the list, and clients
+    # that aren't whitelisted at all (the worst case for a chain of rules).
+    probes = [random.choice(macs) for _ in range(lookups // 2)]
+    probes += fake_macs(size + lookups // 2)[size:]
+    started = time.time()
+    for mac in probes:
+        whitelist.contains(mac)
+    lookup = mean_usec(started, len(probes))
+
+    started = time.time()
+    for mac in macs:
+        whitelist.remove(mac)
+    remove = mean_usec(started, size)
+
+    return {'clients': size, 'add_usec': add, 'lookup_usec': lookup,
+            'remove_usec': remove}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the captive portal's whitelist backends.")
+    parser.add_argument("--backends", action="store", default="shell,ipset,nftables",
+                        help="Comma separated list of backends to benchmark.")
+    parser.add_argument("--sizes", action="store", default="10,100,1000",
+                        help="Comma separated list of whitelist sizes.")
+    parser.add_argument("--lookups", action="store", default=1000, type=int,
+                        help="Number of lookups per run. (Defaults to 1000.)")
+    parser.add_argument("--live", action="store_true", default=False,
+                        help="Run the real commands against the firewall.  Needs root.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.live and os.geteuid() != 0:
+        print "--live needs to be run as root."
+        sys.exit(1)
+
+    results = {'mode': 'live' if args.live else 'model', 'backends': {}}
+    for name in args.backends.split(','):
+        runs = []
+        if args.live:
+            whitelist = whitelist_backends.make_backend(name)
+            whitelist.setup()
+        for size in [int(size) for size in args.sizes.split(',')]:
+            if args.live:
+                lookups = min(args.lookups, 100)
+            else:
+                whitelist = MODELS[name]()
+                lookups = args.lookups
+            runs.append(bench(whitelist, size, lookups))
+        results['backends'][name] = runs
+    print json.dumps(results, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,44 +8,106 @@
 # License: GPLv3
 
 IPTABLES=/usr/sbin/iptables
+IPSET=/usr/sbin/ipset
+NFT=/usr/sbin/nft
 ARP=/sbin/arp
 
+# Name of the IP set or nftables set holding whitelisted MAC addresses when
+# the captive portal daemon runs with --whitelist-backend ipset or nftables.
+WHITELIST=byzantium-whitelist
+
+# Figure out which whitelist backend the captive portal daemon set up: the
+# one-rule-per-client iptables chain (the default), an IP set or an nftables
+# set.
+whitelist_backend() {
+    if [ -x $IPSET ] && $IPSET -q -n list $WHITELIST >/dev/null 2>&1; then
+        echo ipset
+    elif [ -x $NFT ] && $NFT list chain inet byzantium prerouting >/dev/null 2>&1; then
+        echo nftables
+    else
+        echo iptables
+    fi
+}
+
+# Turn the argument into a MAC address.  It's either already a MAC address or
+# the IP address of a client, in which case it's looked up in the ARP cache.
+client_mac() {
+    case "$1" in
+        *:*:*:*:*:*)
+            echo $1
+            ;;
+        *)
+            $ARP -n | grep ':' | grep $1 | awk '{print $3}'
+            ;;
+    esac
+}
+
+# Append a rule to a chain in a table unless it's already there, so running
+# initialize again for an interface doesn't stack up copies of its rules.
+# $1: The table.  The rest is the chain and the rule, as passed to -A.
+append_rule() {
+    TABLE=$1
+    shift
+    $IPTABLES -t $TABLE -C "$@" 2>/dev/null || $IPTABLES -t $TABLE -A "$@"
+}
+
 # Set up the choice tree of options that can be passed to this script.
 case "$1" in
     'initialize')
         # $2: IP address of the client interface.  Assumes final octet is .1.
+        # $3: The client interface.  A daemon serving several client
+        #     interfaces runs this once for each of them.
 
         # Initialize the IP tables ruleset by creating a new chain for captive
-        # portal users.
-        $IPTABLES -N internet -t mangle
+        # portal users.  If it's already there another client interface has
+        # been set up, and only the rules for this one are added.
+        FIRST=no
+        if $IPTABLES -N internet -t mangle 2>/dev/null; then
+            FIRST=yes
+        fi
+
+        # Only match traffic coming in on this interface (without any alias
+        # suffix like :1, which iptables doesn't know about).
+        INTERFACE=""
+        if [ -n "$3" ]; then
+            INTERFACE="-i ${3%%:*}"
+        fi
 
         # Convert the IP address of the client interface into a netblock.
         CLIENTNET=`echo $2 | sed 's/1$/0\/24/'`
 
         # Exempt traffic which does not originate from the client network.
-        $IPTABLES -t mangle -A PREROUTING -p tcp ! -s $CLIENTNET -j RETURN
-        $IPTABLES -t mangle -A PREROUTING -p udp ! -s $CLIENTNET -j RETURN
+        append_rule mangle PREROUTING $INTERFACE -p tcp ! -s $CLIENTNET -j RETURN
+        append_rule mangle PREROUTING $INTERFACE -p udp ! -s $CLIENTNET -j RETURN
 
         # Traffic not exempted by the above rules gets kicked to the captive
         # portal chain.  When a use clicks through a rule is inserted above
         # this one that matches them with a RETURN.
-        $IPTABLES -t mangle -A PREROUTING -j internet
-
-        # Traffic not coming from an accepted user gets marked 99.
-        $IPTABLES -t mangle -A internet -j MARK --set-mark 99
+        append_rule mangle PREROUTING $INTERFACE -j internet
 
         # $2 is actually the IP address of the client interface, so let's make
         # it a bit more clear.
         CLIENTIP=$2
 
         # Traffic which has been marked 99 and is headed for 80/TCP or 443/TCP
-        # should be redirected to the captive portal web server.
-        $IPTABLES -t nat -A PREROUTING -m mark --mark 99 -p tcp --dport 80 \
+        # should be redirected to the captive portal web server on this
+        # interface's address.
+        append_rule nat PREROUTING $INTERFACE -m mark --mark 99 -p tcp --dport 80 \
 	    -j DNAT --to-destination $CLIENTIP:31337
-        $IPTABLES -t nat -A PREROUTING -m mark --mark 99 -p tcp --dport 443 \
+        append_rule nat PREROUTING $INTERFACE -m mark --mark 99 -p tcp --dport 443 \
 	    -j DNAT --to-destination $CLIENTIP:31338
-        $IPTABLES -t nat -A PREROUTING -m mark --mark 99 -p udp --dport 53 \
+        append_rule nat PREROUTING $INTERFACE -m mark --mark 99 -p udp --dport 53 \
 	    -j DNAT --to-destination $CLIENTIP:31339
+        append_rule nat PREROUTING $INTERFACE -m mark --mark 99 -p tcp --dport 53 \
+	    -j DNAT --to-destination $CLIENTIP:31339
+
+        # The rest of the ruleset is the same for every client interface.
+        if [ $FIRST = no ]; then
+            exit 0
+        fi
+
+        # Traffic not coming from an accepted user gets marked 99.
+        $IPTABLES -t mangle -A internet -j MARK --set-mark 99
 
         # All other traffic which is marked 99 is just dropped
         $IPTABLES -t filter -A FORWARD -m mark --mark 99 -j DROP
@@ -57,6 +119,7 @@ case "$1" in
         $IPTABLES -t filter -A INPUT -p tcp --dport 9001 -j ACCEPT
         $IPTABLES -t filter -A INPUT -p tcp --dport 31337 -j ACCEPT
         $IPTABLES -t filter -A INPUT -p tcp --dport 31338 -j ACCEPT
+        $IPTABLES -t filter -A INPUT -p tcp --dport 31339 -j ACCEPT
         $IPTABLES -t filter -A INPUT -p udp --dport 53 -j ACCEPT
         $IPTABLES -t filter -A INPUT -p udp --dport 67 -j ACCEPT
         $IPTABLES -t filter -A INPUT -p udp --dport 5353 -j ACCEPT
@@ -70,29 +133,49 @@ case "$1" in
 	exit 0
         ;;
     'add')
-        # $2: IP address of client.
+        # $2: IP or MAC address of client.
         CLIENT=$2
 
         # Isolate the MAC address of the client in question.
-        CLIENTMAC=`$ARP -n | grep ':' | grep $CLIENT | awk '{print $3}'`
+        CLIENTMAC=`client_mac $CLIENT`
 
         # Add the MAC address of the client to the whitelist, so it'll be able
         # to access the mesh even if its IP address changes.
-        $IPTABLES -t mangle -I internet -m mac --mac-source \
-            $CLIENTMAC -j RETURN
+        case `whitelist_backend` in
+            ipset)
+                $IPSET add $WHITELIST $CLIENTMAC -exist
+                ;;
+            nftables)
+                $NFT add element inet byzantium $WHITELIST "{ $CLIENTMAC }"
+                ;;
+            *)
+                $IPTABLES -t mangle -I internet -m mac --mac-source \
+                    $CLIENTMAC -j RETURN
+                ;;
+        esac
 
 	exit 0
         ;;
     'remove')
-        # $2: IP address of client.
+        # $2: IP or MAC address of client.
         CLIENT=$2
 
         # Isolate the MAC address of the client in question.
-        CLIENTMAC=`$ARP -n | grep ':' | grep $CLIENT | awk '{print $3}'`
+        CLIENTMAC=`client_mac $CLIENT`
 
         # Delete the MAC address of the client from the whitelist.
-        $IPTABLES -t mangle -D internet -m mac --mac-source \
-            $CLIENTMAC -j RETURN
+        case `whitelist_backend` in
+            ipset)
+                $IPSET del $WHITELIST $CLIENTMAC -exist
+                ;;
+            nftables)
+                $NFT delete element inet byzantium $WHITELIST "{ $CLIENTMAC }"
+                ;;
+            *)
+                $IPTABLES -t mangle -D internet -m mac --mac-source \
+                    $CLIENTMAC -j RETURN
+                ;;
+        esac
 
 	exit 0
         ;;
@@ -106,6 +189,12 @@ case "$1" in
         $IPTABLES -t mangle -X
         $IPTABLES -t filter -F
         $IPTABLES -t filter -X
+        if [ -x $IPSET ]; then
+            $IPSET -q destroy $WHITELIST
+        fi
+        if [ -x $NFT ]; then
+            $NFT delete table inet byzantium 2>/dev/null
+        fi
 
 	exit 0
         ;;
@@ -119,6 +208,6 @@ case "$1" in
 	exit 0
 	;;
     *)
-        echo "USAGE: $0 {initialize <IP> <interface>|add <IP> <interface>|remove <IP> <interface>|purge|list}"
+        echo "USAGE: $0 {initialize <IP> <interface>|add <IP or MAC> <interface>|remove <IP or MAC> <interface>|purge|list}"
         exit 0
     esac
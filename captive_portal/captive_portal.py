@@ -21,7 +21,7 @@
 #    2: Bad CLI args.
 #    3: Bad IP tables commands during initialization.
 #    4: Bad parameters passed to IP tables during initialization.
-#    5: Daemon already running on this network interface.
+#    5: Daemon already running on one of these network interfaces.
 
 # v0.1 - Initial release.
 # v0.2 - Added a --test option that doesn't actually do anything to the system
@@ -38,27 +38,147 @@
 #      - Added code that starts the idle client reaper daemon that Haxwithaxe
 #        wrote.
 #      - Added a second listener for HTTPS connections.
+# v0.4 - Templates are compiled once at startup and cached for the life of the
+#        process (template_cache.py) instead of building a new TemplateLookup
+#        for every hit on /.
+#      - Accept-Language is negotiated properly (q-values, regional fallbacks)
+#        against an index of the templates on disk (language_negotiation.py).
+#      - Added --whitelist-backend to keep whitelisted MACs in an IP set or an
+#        nftables set matched by a single rule (whitelist_backends.py).
+#      - Clients are whitelisted in-process (whitelist.py): MACs come from an
+#        index of /proc/net/arp and rules go through one long-lived backend
+#        process instead of forking captive-portal.sh for every click.
+#      - Whitelisting happens on a background queue (whitelist_queue.py) so
+#        the accept click never waits on the firewall.  Its counters can be
+#        read from /metrics on localhost.
+#      - Unknown URLs get a prebuilt 302 to the portal (portal_redirect.py)
+#        instead of an HTML refresh built around a fresh SIOCGIFADDR ioctl
+#        on wlan0:1 for every 404.
+#      - OS captive portal probes (Android, Windows, Firefox, iOS) are answered
+#        from a table (probes.py) by ProbeDispatcher before the URL tree is
+#        walked.
+#      - Added --engine=async, which serves the same pages from one thread
+#        running an event loop (event_loop.py, async_portal.py) with idle
+#        connections closed after --idle-timeout seconds.  CherryPy is still
+#        the default.
+#      - Whitelisted clients are kept on disk (whitelist_store.py) and put
+#        back with one backend script when the daemon restarts, so they
+#        don't land on the splash page again.
+#      - Each client IP address gets a token bucket (throttle.py).  Clients
+#        over --rate-limit get a canned 429 (and optionally have their
+#        connection closed) instead of a rendered page or redirect.
+#      - Static files in --filedir are served from memory with strong ETags,
+#        304s and gzipped copies (static_assets.py).
+#      - Added --in-process, which runs the DNS hijacker (fake_dns.py) and
+#        the idle client reaper (idle_reaper.py) on an event loop in this
+#        process instead of in two more Python interpreters.
+#      - One daemon can serve several client interfaces (-i and -a can be
+#        given more than once).  Requests are sent to the portal address of
+#        the interface they came in on (PortalInterfaces in
+#        portal_redirect.py), everything else is shared, and /metrics counts
+#        each interface separately.
+#      - Clients' DNATed connections are flushed from conntrack when they're
+#        whitelisted (conntrack.py), so open flows stop landing on the portal.
+#        --no-conntrack-flush turns it off.
+#      - Added --dns-workers, which has fake_dns.py answer from that many
+#        processes sharing its socket (SO_REUSEPORT).
+#      - The DNS hijacker answers over TCP as well as UDP, and
+#        captive-portal.sh hijacks DNS over TCP too.
+#      - The DNS hijacker answers the mesh's own names (--dns-hosts,
+#        /etc/hosts.mesh by default) with their real addresses.
 
 # TODO:
 
 # Modules.
 import cherrypy
-from cherrypy.process.plugins import PIDFile
-from mako.lookup import TemplateLookup
+from cherrypy.process.plugins import Monitor, PIDFile
 
 import argparse
-import fcntl
+import json
 import logging
 import os
-import socket
-import struct
+import signal
+import ssl
 import subprocess
+import threading
+
+from async_portal import HTTPServer, PortalApp
+from conntrack import ConntrackBackend
+from event_loop import EventLoop
+from fake_dns import HOSTS_FILE, DNSHijacker, MeshHosts
+from idle_reaper import IdleReaper
+from language_negotiation import LanguageNegotiator
+from portal_redirect import PortalInterfaces
+from probes import ProbeResponder
+from static_assets import StaticIndex
+from template_cache import TemplateCache
+from throttle import THROTTLED, ThrottleTable
+from whitelist import WhitelistManager
+from whitelist_queue import WhitelistQueue
+from whitelist_store import WhitelistStore
+import whitelist_backends
+
+# local_address(): The address the current CherryPy request came in on.
+# CherryPy doesn't pass the connection's own address on to the application,
+# only the address its listener is bound to, as the server name.  That's
+# 0.0.0.0 with a single interface, which routes to it, and the interface's own
+# address with several of them, since check_args() won't let the CherryPy
+# engine serve several interfaces unless each has an -a.
+def local_address():
+    return cherrypy.serving.request.local.name
+
+
+# ProbeDispatcher answers the URLs operating systems use to detect captive
+# portals straight out of the table in probes.py, serves static files from
+# memory, and turns away clients that are over their rate limit before any of
+# the portal's own code runs.
+# Anything else goes through CherryPy's usual dispatcher.
+class ProbeDispatcher(cherrypy.dispatch.Dispatcher):
+
+    def __init__(self, portal):
+        cherrypy.dispatch.Dispatcher.__init__(self)
+        self.portal = portal
+        self.responder = portal.probes
+        self._config = None
+
+    def __call__(self, path_info):
+        request = cherrypy.serving.request
+        redirect = self.portal.arrived(local_address())
+        throttled = self.portal.throttled(request.remote.ip, path_info)
+        if throttled is not None:
+            self._answer(request, lambda: throttled)
+            return
+
+        asset = self.portal.static(path_info, request.query_string,
+                                   request.headers.get('If-None-Match'),
+                                   request.headers.get('Accept-Encoding'))
+        if asset is not None:
+            self._answer(request, lambda: asset)
+            return
+
+        probe = self.responder.match(request.headers.get('Host'), path_info)
+        if probe is None:
+            return cherrypy.dispatch.Dispatcher.__call__(self, path_info)
+        self._answer(request, lambda: self.responder.respond(probe, request.remote.ip, redirect))
+
+    # _answer(): Makes respond(), which returns (status, headers, body), the
+    # request's handler.
+    def _answer(self, request, respond):
+        # These requests get the application's root config without walking
+        # the tree for it every time.
+        if self._config is None:
+            cherrypy.dispatch.Dispatcher.__call__(self, '/')
+            self._config = request.config
+        request.config = dict(self._config)
+        request.is_index = False
+
+        def handler():
+            status, headers, body = respond()
+            cherrypy.serving.response.status = status
+            cherrypy.serving.response.headers.update(headers)
+            return body
+        request.handler = handler
 
-# Need this for the 404 method.
-def get_ip_address(interface):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    return socket.inet_ntoa(fcntl.ioctl(sock.fileno(), 0x8915,
-                            struct.pack('256s', interface[:15]))[20:24])
 
 # The CaptivePortalDetector class implements a fix for an undocumented bit of
 # fail in Apple iOS.  iProducts attempt to access a particular file hidden in
@@ -105,58 +225,112 @@ class Library(object):
 # HTML front-end and the IP tables interface.
 class CaptivePortal(object):
 
-    def __init__(self, args):
+    def __init__(self, args, templatecache, manager, queue, interfaces, probes,
+                 throttle=None, assets=None):
         self.args = args
+        self.throttle = throttle
+        self.assets = assets
+
+        # name: object with a metrics() method, for whatever else runs in this
+        # process (the DNS hijacker and reaper with --in-process).
+        self.components = {}
+        self.manager = manager
+        self.queue = queue
+        self.interfaces = interfaces
+        self.probes = probes
+        self.templatecache = templatecache
+        self.negotiator = LanguageNegotiator(templatecache.languages())
+        self.generation = templatecache.generation
+
+        # Over-limit clients can also be told to go away.
+        status, headers, body = THROTTLED
+        if getattr(args, 'throttle_close', False):
+            headers = dict(headers, Connection='close')
+        self._throttled_response = (status, headers, body)
 
         logging.debug("Mounting Library() from CaptivePortal().")
         self.library = Library()
 
-    # index(): Pretends to be / and /index.html.
-    def index(self):
-        # Identify the primary language the client's web browser supports.
-        try:
-            clientlang = cherrypy.request.headers['Accept-Language']
-            clientlang = clientlang.split(',')[0].lower()
-        except:
-            logging.debug("Client language not found.  Defaulting to en-us.")
-            clientlang = 'en-us'
-        logging.debug("Current browser language: %s", clientlang)
-
-        # Piece together the filename of the /index.html file to return based
-        # on the primary language.
-        indexhtml = "index.html." + clientlang
-        templatelookup = build_templatelookup(self.args)
-        try:
-            page = templatelookup.get_template(indexhtml)
-        except:
-            page = templatelookup.get_template('index.html.en-us')
+    # arrived(): Counts a request that came in on localip and returns the
+    # PortalRedirect of its interface.
+    def arrived(self, localip):
+        redirect = self.interfaces.route(localip)
+        self.interfaces.count(redirect, 'requests')
+        return redirect
+
+    # redirect(): Returns (status, headers, body) sending the client to the
+    # portal on the interface the request came in on.
+    def redirect(self, localip):
+        redirect = self.interfaces.route(localip)
+        self.interfaces.count(redirect, 'redirects')
+        headers, body = redirect.response
+        return 302, headers, body
+
+    # throttled(): Takes a token from the client's bucket.  Returns None if the
+    # request can go ahead, or the cached (status, headers, body) to send
+    # instead.  Clicking through and the node asking for /metrics are never
+    # throttled.
+    def throttled(self, clientip, path):
+        if self.throttle is None or path == '/whitelist':
+            return None
+        if path == '/metrics' and clientip in ('127.0.0.1', '::1'):
+            return None
+        if self.throttle.allow(clientip):
+            return None
+        return self._throttled_response
+
+    # static(): Returns (status, headers, body) for a static file in --filedir,
+    # or None if path isn't one.
+    def static(self, path, query, if_none_match, accept_encoding):
+        if self.assets is None:
+            return None
+        asset = self.assets.lookup(path)
+        if asset is None:
+            return None
+        return self.assets.respond(asset, query, if_none_match, accept_encoding)
+
+    # render_index(): Renders the front page in the language that best matches
+    # an Accept-Language header.  Shared by both web server engines.
+    def render_index(self, accept_language):
+        # If templates were added or removed since the last request, reindex
+        # the languages that can be negotiated.  The cache looks at the disk
+        # first, so that this request already sees them.
+        self.templatecache.check()
+        if self.generation != self.templatecache.generation:
+            self.generation = self.templatecache.generation
+            self.negotiator.reindex(self.templatecache.languages())
+
+        # Identify the language of the client's web browser that we have a
+        # page for.
+        clientlang = self.negotiator.negotiate(accept_language)
+        logging.debug("Negotiated browser language: %s", clientlang)
+
+        # Pick the precompiled /index.html template for that language.
+        page = self.templatecache.get(clientlang)
+        if page is None:
+            page = self.templatecache.get('en-us')
             logging.debug("Unable to find HTML template for language %s!", clientlang)
             logging.debug("\tDefaulting to /srv/captiveportal/index.html.en-us.")
         return page.render()
-    index.exposed = True
 
-    # whitelist(): Takes the form input from /index.html.*, adds the IP address
-    # of the client to IP tables, and then flips the browser to the node's
-    # frontpage.  Takes one argument, a value for the variable 'accepted'.
-    # Returns an HTML page with an HTTP refresh as its sole content to the
-    # client.
-    def whitelist(self, accepted=None):
-        # Extract the client's IP address from the client headers.
-        clientip = cherrypy.request.headers['Remote-Addr']
+    # accept(): Queues clientip to be added to the whitelist and returns an
+    # HTML page with an HTTP refresh to the node's frontpage (on the interface
+    # the request came in on) as its sole content.  Shared by both web server
+    # engines.
+    def accept(self, clientip, localip=None):
         logging.debug("Client's IP address: %s", clientip)
+        portal = self.interfaces.route(localip)
+        self.interfaces.count(portal, 'accepted')
 
-        # Set up the command string to add the client to the IP tables ruleset.
-        addclient = ['/usr/local/sbin/captive-portal.sh', 'add', clientip]
-        if self.args.test:
-            logging.debug("Command that would be executed:\n%s", addclient)
-        else:
-            subprocess.call(addclient)
+        # Queue the client to be added to the whitelist.  The redirect goes
+        # out without waiting for that to happen.
+        self.queue.put(clientip)
 
         # Assemble some HTML to redirect the client to the node's frontpage.
         redirect = """
                    <html>
                    <head>
-                   <meta http-equiv="refresh" content="0; url=http://""" + self.args.address + """/" />
+                   <meta http-equiv="refresh" content="0; url=http://""" + (portal.address or '') + """/" />
                    </head>
                    <body>
                    </body>
@@ -164,72 +338,152 @@ class CaptivePortal(object):
 
         logging.debug("Generated HTML refresh is:")
         logging.debug(redirect)
-
-        # Fire the redirect at the client.
         return redirect
-    whitelist.exposed = True
 
-    # error_page_404(): Registered with CherryPy as the default handler for
-    # HTTP 404 errors (file or resource not found).  Takes four arguments (this
-    # is required by CherryPy), returns some HTML generated at runtime that
-    # redirects the client to http://<IP address>/, where it'll be caught by
-    # CaptivePortal.index().  I wish there was an easier way to do this (like
-    # calling self.index() directly) but the stable's fresh out of ponies.
-    # We don't use any of the arguments passed to this method so I reference
-    # a few of them in debug mode.
-    def error_page_404(self, status, message, traceback):
-        # Extract the client's IP address from the client headers.
-        clientip = cherrypy.request.headers['Remote-Addr']
-        logging.debug("Client's IP address: %s", clientip)
-        logging.debug("Value of status is: %s", status)
-        logging.debug("Value of message is: %s", message)
+    # metrics_json(): The daemon's counters as JSON, plus whatever the web
+    # server engine has to add.
+    def metrics_json(self, extra=None):
+        metrics = {'whitelisted': len(self.manager.whitelisted()),
+                   'whitelist_queue': self.queue.metrics(),
+                   'probes': self.probes.metrics(),
+                   'interfaces': self.interfaces.metrics()}
+        if self.throttle is not None:
+            metrics['throttle'] = self.throttle.metrics()
+        if self.assets is not None:
+            metrics['static'] = self.assets.metrics()
+        for name, component in self.components.items():
+            metrics[name] = component.metrics()
+        if extra:
+            metrics.update(extra)
+        return json.dumps(metrics)
 
-        # Assemble some HTML to redirect the client to the captive portal's
-        # /index.html-* page.
-        #
-        # We are using wlan0:1 here for the address - this may or may not be
-        # right, but since we can't get at self.args.address it's the best we
-        # can do.
-        redirect = """<html><head><meta http-equiv="refresh" content="0; url=http://""" + get_ip_address("wlan0:1") + """/" /></head> <body></body> </html>"""
+    # index(): Pretends to be / and /index.html.
+    def index(self):
+        return self.render_index(cherrypy.request.headers.get('Accept-Language'))
+    index.exposed = True
 
-        logging.debug("Generated HTML refresh is:")
-        logging.debug(redirect)
-        logging.debug("Redirecting client to /.")
+    # whitelist(): Takes the form input from /index.html.*, adds the IP address
+    # of the client to IP tables, and then flips the browser to the node's
+    # frontpage.  Takes one argument, a value for the variable 'accepted'.
+    # Returns an HTML page with an HTTP refresh as its sole content to the
+    # client.
+    def whitelist(self, accepted=None):
+        # Extract the client's IP address from the client headers.
+        return self.accept(cherrypy.request.headers['Remote-Addr'], local_address())
+    whitelist.exposed = True
 
-        # Fire the redirect at the client.
-        return redirect
-    cherrypy.config.update({'error_page.404':error_page_404})
+    # metrics(): Dumps the daemon's counters as JSON.  Only answers requests
+    # from the node itself; anyone else gets the 404 redirect.
+    def metrics(self):
+        if cherrypy.request.remote.ip not in ('127.0.0.1', '::1'):
+            raise cherrypy.NotFound()
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return self.metrics_json({'engine': 'cherrypy'})
+    metrics.exposed = True
+
+    # default(): CherryPy calls this for any URL nothing else in the tree
+    # matches.  Sends the client a 302 to http://<IP address>/, where it'll be
+    # caught by CaptivePortal.index().  The whole response is built ahead of
+    # time by PortalRedirect, so this doesn't do any work of its own.
+    def default(self, *args, **kwargs):
+        status, headers, body = self.redirect(local_address())
+        cherrypy.response.status = status
+        cherrypy.response.headers.update(headers)
+        return body
+    default.exposed = True
+
+    # error_page_404(): Registered with CherryPy as the handler for HTTP 404
+    # errors that are raised on purpose (see metrics()).  Takes the arguments
+    # CherryPy passes to error pages and sends the same redirect as default().
+    def error_page_404(self, status, message, traceback, version):
+        logging.debug("Value of status is: %s", status)
+        logging.debug("Value of message is: %s", message)
+        return self.default()
 
 
 def parse_args():
     parser = argparse.ArgumentParser(conflict_handler='resolve', description="This daemon implements the captive "
                                      "portal functionality of Byzantium Linux. pecifically, it acts as the front end "
                                      "to IP tables and automates the addition of mesh clients to the whitelist.")
-    parser.add_argument("-a", "--address", action="store",
-                        help="The IP address of the interface the daemon listens on.")
+    parser.add_argument("-a", "--address", action="append", default=[],
+                        help="The IP address of the interface the daemon listens on.  Give it once for every -i, in "
+                        "the same order; the CherryPy engine needs every one of them to serve several interfaces.")
     parser.add_argument("--appconfig", action="store", default="/etc/captiveportal/captiveportal.conf")
     parser.add_argument("--cachedir", action="store", default="/tmp/portalcache")
+    parser.add_argument("--burst", action="store", default=40, type=int,
+                        help="Requests a client can make in a burst before --rate-limit applies.  (Defaults to 40.)")
     parser.add_argument("-c", "--certificate", action="store", default="/etc/httpd/server.crt",
                         help="Path to an SSL certificate. (Defaults to /etc/httpd/server.crt)")
     parser.add_argument("--configdir", action="store", default="/etc/captiveportal")
+    parser.add_argument("--no-conntrack-flush", action="store_false", dest="conntrack_flush", default=True,
+                        help="Don't flush a client's hijacked connections from conntrack when it's whitelisted.")
     parser.add_argument("-d", "--debug", action="store_true", default=False, help="Enable debugging mode.")
+    parser.add_argument("--dns-hosts", action="store", default=HOSTS_FILE,
+                        help="Hosts file whose names the DNS hijacker answers with their real addresses instead of "
+                        "the portal's; '' for none.  (Defaults to %s.)" % HOSTS_FILE)
+    parser.add_argument("--dns-port", action="store", default=31339, type=int,
+                        help="UDP and TCP port the in-process DNS hijacker listens on.  (Defaults to 31339.)")
+    parser.add_argument("--dns-workers", action="store", default=0, type=int,
+                        help="Number of worker processes each fake_dns.py answers from, to use more than one "
+                        "core.  Ignored with --in-process.  (Defaults to one process.)")
+    parser.add_argument("-e", "--engine", action="store", default="cherrypy", choices=["async", "cherrypy"],
+                        help="Web server to run: CherryPy's thread pool, or a single-threaded event loop that holds "
+                        "idle connections more cheaply.  (Defaults to cherrypy.)")
     parser.add_argument("--filedir", action="store", default="/srv/captiveportal")
-    parser.add_argument("-i", "--interface", action="store", required=True,
-                        help="The name of the interface the daemon listens on.")
+    parser.add_argument("-i", "--interface", action="append", required=True,
+                        help="The name of an interface the daemon listens on.  Can be given more than once to serve "
+                        "several client interfaces from one daemon.")
     parser.add_argument("-k", "--key", action="store", default="/etc/httpd/server.key",
                         help="Path to an SSL private key file. (Defaults to /etc/httpd/server.key)")
+    parser.add_argument("--in-process", action="store_true", default=False,
+                        help="Run the DNS hijacker and idle client reaper inside this process instead of starting "
+                        "fake_dns.py and mop_up_dead_clients.py.")
+    parser.add_argument("--idle-timeout", action="store", default=30, type=int,
+                        help="Seconds an idle connection is kept open by the async engine.  (Defaults to 30.)")
     parser.add_argument("--pidfile", action="store")
     parser.add_argument("-p", "--port", action="store", default=31337, type=int,
                         help="Port to listen on.  Defaults to 31337/TCP.")
+    parser.add_argument("-r", "--rate-limit", action="store", default=10.0, type=float,
+                        help="Requests per second each client IP address is allowed; 0 turns rate limiting off.  "
+                        "(Defaults to 10.)")
     parser.add_argument("-s", "--sslport", action="store", default=31338, type=int,
                         help="Port to listen for HTTPS connections on. (Defaults to HTTP port +1.")
     parser.add_argument("-t", "--test", action="store_true", default=False,
                         help="Disables actually doing anything, it just prints what would be done.  Used for testing "
                         "commands without altering the test system.")
+    parser.add_argument("--whitelist-state", action="store",
+                        help="Prefix of the file whitelisted clients are kept in across restarts; the (first) interface "
+                        "name is appended.  (Defaults to /var/lib/captiveportal/whitelist.)")
+    parser.add_argument("--throttle-close", action="store_true", default=False,
+                        help="Close the connection of clients that are over the rate limit.")
+    parser.add_argument("-w", "--whitelist-backend", action="store", default="shell",
+                        choices=sorted(whitelist_backends.BACKENDS.keys()),
+                        help="How whitelisted clients are matched: one iptables rule per client (shell), or an ipset "
+                        "or nftables set matched by a single rule.  (Defaults to shell.)")
     return parser.parse_args()
 
 
 def check_args(args):
+    # Pair every interface with its address.  Interfaces without one have it
+    # looked up.
+    if len(args.address) > len(args.interface):
+        logging.error("More addresses than interfaces given.")
+        exit(2)
+    if len(set(args.interface)) != len(args.interface):
+        logging.error("An interface was given more than once.")
+        exit(2)
+    args.address += [None] * (len(args.interface) - len(args.address))
+    args.interfaces = zip(args.interface, args.address)
+
+    # With several interfaces, CherryPy can only tell which one a request is
+    # for by the listener it came in on, and every interface only gets one of
+    # those when all of their addresses are given.  The async engine asks
+    # each connection's socket instead.
+    if args.engine == 'cherrypy' and len(args.interfaces) > 1 and not all(args.address):
+        logging.error("Give an -a for every -i to serve several interfaces with the CherryPy engine, "
+                      "or use --engine=async.")
+        exit(2)
+
     if not args.port == 31337 and args.sslport == 31338:
         args.sslport = args.port + 1
         logging.debug("Setting ssl port to %d/TCP", args.sslport)
@@ -261,70 +515,178 @@ def check_args(args):
 
 
 def create_pidfile(args):
-    # Create the filename for this instance's PID file.
+    # Create the filenames for this instance's PID files, one for every
+    # network interface it serves, so the control panel finds the daemon by
+    # whichever interface it asks about.
     if not args.pidfile:
         if args.test:
             args.pidfile = '/tmp/captive_portal.'
         else:
             args.pidfile = '/var/run/captive_portal.'
-    full_pidfile = args.pidfile + args.interface
-    logging.debug("Name of PID file is: %s", full_pidfile)
-
-    # If a PID file already exists for this network interface, ABEND.
-    if os.path.exists(full_pidfile):
-        logging.error("A pidfile already exists for network interface %s.", full_pidfile)
-        logging.error("Is a daemon already running on this interface?")
-        exit(5)
-
-    # Write the PID file of this instance to the PID file.
-    logging.debug("Creating pidfile for network interface %s.", str(args.interface))
+    pidfiles = [args.pidfile + interface for interface in args.interface]
+    logging.debug("Names of PID files are: %s", pidfiles)
+
+    # If a PID file already exists for any of the network interfaces, ABEND.
+    for full_pidfile in pidfiles:
+        if os.path.exists(full_pidfile):
+            logging.error("A pidfile already exists for network interface %s.", full_pidfile)
+            logging.error("Is a daemon already running on this interface?")
+            exit(5)
+
+    # Write the PID file of this instance to the PID files.  The async engine
+    # writes them itself when it starts.
+    logging.debug("Creating pidfiles for network interfaces %s.", ', '.join(args.interface))
     logging.debug("PID of process is %s.", str(os.getpid()))
-    pid = PIDFile(cherrypy.engine, full_pidfile)
-    pid.subscribe()
-
-
-def update_cherrypy_config(port):
+    if args.engine == 'cherrypy':
+        for full_pidfile in pidfiles:
+            pid = PIDFile(cherrypy.engine, full_pidfile)
+            pid.subscribe()
+    return pidfiles
+
+
+def listen_addresses(args):
+    # One interface keeps listening everywhere, as the daemon always has.
+    # Several interfaces, all with their addresses given on the command line,
+    # get a listener on each of those addresses (and on localhost, for
+    # /metrics) so the portal isn't reachable from anywhere else.
+    if len(args.interfaces) == 1 or not all(args.address):
+        return ['0.0.0.0']
+    hosts = list(args.address)
+    if '127.0.0.1' not in hosts:
+        hosts.append('127.0.0.1')
+    return hosts
+
+
+def update_cherrypy_config(args):
     # Configure a few things about the web server so we don't have to fuss
     # with an extra config file, namely, the port and IP address to listen on.
-    cherrypy.config.update({'server.socket_host':'0.0.0.0', })
-    cherrypy.config.update({'server.socket_port':port, })
+    # Any more addresses get listeners of their own.
+    hosts = listen_addresses(args)
+    cherrypy.config.update({'server.socket_host':hosts[0], })
+    cherrypy.config.update({'server.socket_port':args.port, })
+    for host in hosts[1:]:
+        listener = cherrypy._cpserver.Server()
+        listener.socket_host = host
+        listener.socket_port = args.port
+        listener.subscribe()
 
 
 def start_ssl_listener(args):
-    # Set up an SSL listener running in parallel.
-    ssl_listener = cherrypy._cpserver.Server()
-    ssl_listener.socket_host = '0.0.0.0'
-    ssl_listener.socket_port = args.sslport
-    ssl_listener.ssl_certificate = args.certificate
-    ssl_listener.ssl_private_key = args.key
-    ssl_listener.subscribe()
-
-
-def build_templatelookup(args):
-    # Set up the location the templates will be served out of.
-    return TemplateLookup(directories=[args.filedir], module_directory=args.cachedir, collection_size=100)
-
-
-def setup_url_tree(args):
+    # Set up SSL listeners running in parallel.
+    for host in listen_addresses(args):
+        ssl_listener = cherrypy._cpserver.Server()
+        ssl_listener.socket_host = host
+        ssl_listener.socket_port = args.sslport
+        ssl_listener.ssl_certificate = args.certificate
+        ssl_listener.ssl_private_key = args.key
+        ssl_listener.subscribe()
+
+
+def build_templatecache(args):
+    # Set up the location the templates will be served out of, and compile
+    # all of them once for the lifetime of the daemon.
+    templatecache = TemplateCache(args.filedir, args.cachedir)
+    logging.debug("Compiled templates for languages: %s", templatecache.languages())
+    return templatecache
+
+
+def setup_interfaces(args):
+    # Work out where to send clients that ask for URLs we don't serve, for
+    # every interface.  If an address wasn't given on the command line, ask
+    # the interface for it now.  The web server engine asks again every 30
+    # seconds, so the redirects follow them if they change.
+    interfaces = PortalInterfaces(args.interfaces)
+    for redirect in interfaces:
+        if not redirect.address:
+            logging.error("Unable to find the address of interface %s.", redirect.interface)
+    return interfaces
+
+
+def build_portal(args, interfaces, manager, queue):
+    # Build the captive portal object both web server engines serve.  All of
+    # the interfaces share it, and with it the template cache, the static
+    # files and the whitelist.
+    probes = ProbeResponder(interfaces.redirects[0], manager.is_client_whitelisted)
+    throttle = None
+    if args.rate_limit > 0:
+        throttle = ThrottleTable(args.rate_limit, max(args.burst, 1))
+    root = CaptivePortal(args, build_templatecache(args), manager, queue,
+                         interfaces, probes, throttle, StaticIndex(args.filedir))
+    if manager.conntrack is not None:
+        root.components['conntrack'] = manager.conntrack
+    return root
+
+
+def setup_url_tree(args, root):
     # Attach the captive portal object to the URL tree.
-    root = CaptivePortal(args)
+    cherrypy.config.update({'error_page.404': root.error_page_404})
+    if not all(args.address):
+        Monitor(cherrypy.engine, root.interfaces.refresh, frequency=30,
+                name='PortalRedirect').subscribe()
 
     # Mount the object for the root of the URL tree, which happens to be the
     # system status page.  Use the application config file to set it up.
     logging.debug("Mounting web app in %s to /.", args.appconfig)
-    cherrypy.tree.mount(root, "/", args.appconfig)
+    app = cherrypy.tree.mount(root, "/", args.appconfig)
 
+    # Answer captive portal probes and throttle clients before the URL tree
+    # is walked.
+    app.merge({'/': {'request.dispatch': ProbeDispatcher(root)}})
 
-def setup_iptables(args):
-    # Initialize the IP tables ruleset for the node.
-    initialize_iptables = ['/usr/local/sbin/captive-portal.sh', 'initialize',
-                           args.address, args.interface]
-    iptables = 0
-    if args.test:
-        logging.debug("Command that would be executed:\n%s", ' '.join(initialize_iptables))
-    else:
+
+def setup_iptables(args, interfaces):
+    # Initialize the IP tables ruleset for the node, one client interface at a
+    # time.  Stops at the first one that fails.
+    for redirect in interfaces:
+        initialize_iptables = ['/usr/local/sbin/captive-portal.sh', 'initialize',
+                               redirect.address or '', redirect.interface]
+        if args.test:
+            logging.debug("Command that would be executed:\n%s", ' '.join(initialize_iptables))
+            continue
         iptables = subprocess.call(initialize_iptables)
-    return iptables
+        if iptables:
+            return iptables
+    return 0
+
+
+def setup_whitelist_backend(args):
+    # Set up the whitelist backend on top of the chain captive-portal.sh just
+    # created.  The shell backend doesn't need anything more.
+    backend = whitelist_backends.make_backend(args.whitelist_backend, args.test)
+    logging.debug("Using the %s whitelist backend.", backend.name)
+    return backend, backend.setup()
+
+
+def setup_whitelist_manager(args, backend):
+    # Keep the backend's session around for as long as the web server runs,
+    # and run the whitelist queue's worker alongside it.  The engine starts
+    # and stops them; the queue is emptied before the backend goes away.
+    if not args.whitelist_state:
+        if args.test:
+            args.whitelist_state = '/tmp/captive_portal.whitelist.'
+        else:
+            args.whitelist_state = '/var/lib/captiveportal/whitelist.'
+    store = WhitelistStore(args.whitelist_state + args.interface[0])
+
+    # Flush clients' connections that were DNATed to the portal when they're
+    # whitelisted, so they don't keep landing on it.
+    conntrack = None
+    if args.conntrack_flush:
+        conntrack = ConntrackBackend(args.test)
+    manager = WhitelistManager(backend, store=store, conntrack=conntrack)
+    queue = WhitelistQueue(manager)
+
+    # Put back everyone who was whitelisted before the daemon was restarted,
+    # all in one go, before the web server starts answering.
+    restored = manager.restore()
+    logging.debug("Restored %d clients to the whitelist.", restored)
+    return manager, queue
+
+
+def subscribe_whitelist_manager(manager, queue):
+    cherrypy.engine.subscribe('start', queue.start)
+    cherrypy.engine.subscribe('stop', queue.stop, priority=40)
+    cherrypy.engine.subscribe('stop', manager.close, priority=60)
 
 
 def setup_reaper(test):
@@ -343,16 +705,33 @@ def setup_reaper(test):
 
 def setup_hijacker(args):
     # Start the fake DNS server that hijacks every resolution request with the
-    # IP address of the client interface.
-    dns_hijacker = ['/usr/local/sbin/fake_dns.py', args.address]
-    hijacker = 0
-    if args.test:
-        logging.debug("Command that would start the fake DNS server:\n%s", ' '.join(dns_hijacker))
+    # IP address of the client interface.  With several interfaces, one is
+    # started for each of them, listening on that interface's address.
+    commands = []
+    if len(args.interfaces) == 1:
+        interface, address = args.interfaces[0]
+        commands.append(['/usr/local/sbin/fake_dns.py', address or interface])
     else:
-        logging.debug("Starting fake_dns.py.")
-        hijacker = subprocess.Popen(dns_hijacker)
-    if not hijacker:
-        logging.error("fake_dns.py did not start.")
+        for interface, address in args.interfaces:
+            if not address:
+                logging.error("Not hijacking DNS on %s without its address (-a).", interface)
+                continue
+            commands.append(['/usr/local/sbin/fake_dns.py', '--listen', address, address])
+    if args.dns_workers:
+        for command in commands:
+            command[1:1] = ['--workers', str(args.dns_workers)]
+    if args.dns_hosts != HOSTS_FILE:
+        for command in commands:
+            command[1:1] = ['--hosts', args.dns_hosts]
+    for dns_hijacker in commands:
+        hijacker = 0
+        if args.test:
+            logging.debug("Command that would start the fake DNS server:\n%s", ' '.join(dns_hijacker))
+        else:
+            logging.debug("Starting fake_dns.py.")
+            hijacker = subprocess.Popen(dns_hijacker)
+        if not hijacker:
+            logging.error("fake_dns.py did not start.")
 
 
 def check_ip_tables(iptables, args):
@@ -367,7 +746,7 @@ def check_ip_tables(iptables, args):
     if iptables == 2:
         logging.error("Invalid or incorrect options passed to iptables in captive-portal.sh")
         logging.error("Packet filters NOT configured.  Examine the rules in captive-portal.sh.")
-        logging.error("Parameters passed to captive-portal.sh: initialize, %s, %s" % args.address, args.interface)
+        logging.error("Interfaces passed to captive-portal.sh initialize: %s", ', '.join(args.interface))
         exit(4)
 
 
@@ -380,20 +759,128 @@ def start_web_server():
     # Fin.
 
 
+def setup_in_process(args, loop, root):
+    # Run the DNS hijacker and the idle client reaper on the event loop instead
+    # of starting fake_dns.py and mop_up_dead_clients.py, which each cost a
+    # Python interpreter.  The reaper goes through the same whitelist manager
+    # as the web server, on a thread of its own for every check.
+    reaper = IdleReaper(root.manager, max_idle=600)
+    reaper.start(loop, 60)
+    root.components['reaper'] = reaper
+
+    # The mesh's names are looked up in one index, shared by every hijacker.
+    hosts = None
+    if args.dns_hosts:
+        hosts = MeshHosts(args.dns_hosts)
+        hosts.start(loop)
+
+    # With one interface the hijacker listens on every address.  With more,
+    # each interface's hijacker listens on that interface's address and
+    # answers with it.
+    if len(root.interfaces) == 1:
+        redirect = root.interfaces.redirects[0]
+        hijackers = {'dns': (DNSHijacker(loop, redirect.address, args.dns_port, hosts=hosts), redirect)}
+    else:
+        hijackers = {}
+        for redirect in root.interfaces:
+            if not redirect.address:
+                logging.error("Not hijacking DNS on %s, it has no address.", redirect.interface)
+                continue
+            hijacker = DNSHijacker(loop, redirect.address, args.dns_port, redirect.address, hosts=hosts)
+            hijackers['dns.' + redirect.interface] = (hijacker, redirect)
+    for name, (hijacker, redirect) in hijackers.items():
+        root.components[name] = hijacker
+    logging.debug("DNS hijacker and idle client reaper running in-process.")
+
+    # Keep the DNS answers pointed at the portal if an interface's address
+    # changes.
+    if not all(args.address):
+        def follow_redirects():
+            for hijacker, redirect in hijackers.values():
+                hijacker.ip = redirect.address
+        loop.call_every(30, follow_redirects)
+
+
+def start_event_loop_thread(loop):
+    # With the CherryPy engine the event loop gets a thread of its own, started
+    # and stopped along with the web server.
+    thread = threading.Thread(target=loop.run, name='event-loop')
+    thread.daemon = True
+    cherrypy.engine.subscribe('start', thread.start)
+    cherrypy.engine.subscribe('stop', loop.stop, priority=30)
+
+
+def start_async_server(args, root, pidfiles, loop):
+    # Serve the same captive portal from a single thread running an event
+    # loop.  Blocks until SIGTERM or SIGINT, then shuts down the same way the
+    # CherryPy engine does.
+    logging.debug("Starting async web server.")
+    app = PortalApp(root)
+    context = None
+    if os.path.exists(args.certificate) and os.path.exists(args.key):
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.load_cert_chain(args.certificate, args.key)
+    for host in listen_addresses(args):
+        app.servers.append(HTTPServer(loop, app, host, args.port,
+                                      timeout=args.idle_timeout))
+        if context is not None:
+            app.servers.append(HTTPServer(loop, app, host, args.sslport, context,
+                                          timeout=args.idle_timeout))
+    if not all(args.address):
+        loop.call_every(30, root.interfaces.refresh)
+
+    def shutdown(signum, frame):
+        logging.debug("Caught signal %d, shutting down.", signum)
+        loop.stop()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for pidfile in pidfiles:
+        with open(pidfile, 'w') as pid:
+            pid.write(str(os.getpid()))
+    root.queue.start()
+    try:
+        loop.run()
+    finally:
+        for server in app.servers:
+            server.close()
+        root.queue.stop()
+        root.manager.close()
+        loop.close()
+        for pidfile in pidfiles:
+            os.remove(pidfile)
+
+
 def main():
     args = check_args(parse_args())
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.ERROR)
-    create_pidfile(args)
-    update_cherrypy_config(args.port)
+    pidfiles = create_pidfile(args)
+    interfaces = setup_interfaces(args)
+    iptables = setup_iptables(args, interfaces)
+    backend, whitelist = setup_whitelist_backend(args)
+    manager, queue = setup_whitelist_manager(args, backend)
+    root = build_portal(args, interfaces, manager, queue)
+    loop = None
+    if args.engine == 'async' or args.in_process:
+        loop = EventLoop()
+    if args.in_process:
+        setup_in_process(args, loop, root)
+    else:
+        setup_reaper(args.test)
+        setup_hijacker(args)
+    check_ip_tables(iptables or whitelist, args)
+    if args.engine == 'async':
+        start_async_server(args, root, pidfiles, loop)
+        return
+    update_cherrypy_config(args)
     start_ssl_listener(args)
-    setup_url_tree(args)
-    iptables = setup_iptables(args)
-    setup_reaper(args.test)
-    setup_hijacker(args)
-    check_ip_tables(iptables, args)
+    subscribe_whitelist_manager(manager, queue)
+    setup_url_tree(args, root)
+    if loop is not None:
+        start_event_loop_thread(loop)
     start_web_server()
 
 
@@ -7,9 +7,22 @@
 
 # captive_portal_test.py
 
+import argparse
 import flexmock  # http://has207.github.com/flexmock
+import os
+import shutil
+import socket
+import tempfile
+import time
 import unittest
+import async_portal
 import captive_portal
+import event_loop
+import language_negotiation
+import portal_redirect
+import probes
+import template_cache
+import throttle
 
 
 class CaptivePortalDetectorTest(unittest.TestCase):
@@ -20,5 +33,318 @@ class CaptivePortalDetectorTest(unittest.TestCase):
     def test_index(self):
         self.assertEqual("You shouldn't be seeing this, either.", self.detector.index())
 
+
+class TemplateCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.filedir = tempfile.mkdtemp()
+        self.cachedir = tempfile.mkdtemp()
+        self.now = 1000.0
+        self._write('index.html.en-us', 'Hello')
+        self._write('index.html.fr-fr', 'Bonjour')
+        self._write('style.css', 'body {}')
+        self.cache = template_cache.TemplateCache(self.filedir, self.cachedir,
+                                                  check_interval=5,
+                                                  clock=lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.filedir)
+        shutil.rmtree(self.cachedir)
+
+    def _write(self, filename, contents, mtime=None):
+        path = os.path.join(self.filedir, filename)
+        page = open(path, 'w')
+        page.write(contents)
+        page.close()
+        if mtime:
+            os.utime(path, (mtime, mtime))
+
+    def test_precompiles_every_language(self):
+        self.assertEqual(['en-us', 'fr-fr'], self.cache.languages())
+        self.assertEqual('Bonjour', self.cache.get('fr-fr').render())
+
+    def test_unknown_language_returns_none(self):
+        self.assertEqual(None, self.cache.get('xx-yy'))
+
+    def test_same_template_object_between_checks(self):
+        self.assertTrue(self.cache.get('en-us') is self.cache.get('en-us'))
+
+    def test_change_is_picked_up_after_check_interval(self):
+        self._write('index.html.en-us', 'Howdy', mtime=time.time() + 60)
+        self.assertEqual('Hello', self.cache.get('en-us').render())
+        self.now += 10
+        self.assertEqual('Howdy', self.cache.get('en-us').render())
+
+    def test_editor_leftovers_are_not_languages(self):
+        self._write('index.html.en-us~', 'Hello')
+        self._write('index.html.fr-fr.swp', 'Bonjour')
+        self._write('.index.html.de-de.swp', 'Hallo')
+        self.assertEqual(['en-us', 'fr-fr'], self.cache.scan())
+
+    def test_new_language_is_negotiated_on_the_first_request_that_sees_it(self):
+        portal = captive_portal.CaptivePortal(object(), self.cache, None, None, None, None)
+        self._write('index.html.de-de', 'Hallo')
+        os.utime(self.filedir, (time.time() + 60, time.time() + 60))
+        self.now += 10
+        self.assertEqual('Hallo', portal.render_index('de'))
+
+    def test_unchanged_template_is_not_recompiled(self):
+        template = self.cache.get('fr-fr')
+        self._write('index.html.en-us', 'Howdy', mtime=time.time() + 60)
+        self.now += 10
+        self.assertTrue(template is self.cache.get('fr-fr'))
+
+
+class LanguageNegotiatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.negotiator = language_negotiation.LanguageNegotiator(
+            ['en-us', 'es-es', 'fr-fr', 'fr'], cache_size=2)
+
+    def test_parse_orders_by_q_value(self):
+        self.assertEqual(['fr', 'en-us', 'de'],
+                         language_negotiation.parse_accept_language('de;q=0.2, en-US;q=0.8, fr'))
+
+    def test_parse_drops_q_zero_and_garbage(self):
+        self.assertEqual(['en'], language_negotiation.parse_accept_language('en, de;q=0, es;q=abc,,'))
+
+    def test_missing_header_gets_default(self):
+        self.assertEqual('en-us', self.negotiator.negotiate(None))
+
+    def test_regional_fallback(self):
+        self.assertEqual('es-es', self.negotiator.negotiate('es-MX,es;q=0.9'))
+
+    def test_exact_match_beats_prefix(self):
+        self.assertEqual('fr', self.negotiator.negotiate('fr-ca'))
+
+    def test_later_preference_used_when_first_is_unavailable(self):
+        self.assertEqual('fr', self.negotiator.negotiate('de-de, fr;q=0.5'))
+
+    def test_unknown_language_gets_default(self):
+        self.assertEqual('en-us', self.negotiator.negotiate('ja-jp, zh'))
+
+    def test_cache_is_bounded(self):
+        for header in ['es', 'fr', 'de', 'en']:
+            self.negotiator.negotiate(header)
+        self.assertEqual(2, self.negotiator.cache_len())
+
+    def test_reindex_forgets_cached_answers(self):
+        self.assertEqual('en-us', self.negotiator.negotiate('de'))
+        self.negotiator.reindex(['en-us', 'de-de'])
+        self.assertEqual('de-de', self.negotiator.negotiate('de'))
+
+    def test_answer_from_a_replaced_index_is_not_cached(self):
+        resolve = self.negotiator._resolve
+        def reindex_meanwhile(header, index):
+            self.negotiator.reindex(['en-us', 'de-de'])
+            return resolve(header, index)
+        self.negotiator._resolve = reindex_meanwhile
+        self.assertEqual('en-us', self.negotiator.negotiate('de'))
+        self.assertEqual(0, self.negotiator.cache_len())
+        del self.negotiator._resolve
+        self.assertEqual('de-de', self.negotiator.negotiate('de'))
+
+
+class PortalRedirectTest(unittest.TestCase):
+
+    def test_address_from_command_line(self):
+        redirect = portal_redirect.PortalRedirect('10.0.0.1', 'wlan0',
+                                                  resolver=lambda iface: self.fail())
+        headers, body = redirect.response
+        self.assertEqual('http://10.0.0.1/', headers['Location'])
+        self.assertEqual(str(len(body)), headers['Content-Length'])
+
+    def test_refresh_only_rebuilds_on_change(self):
+        addresses = ['10.0.0.1', '10.0.0.1', '10.0.1.1']
+        redirect = portal_redirect.PortalRedirect(None, 'wlan0', resolver=lambda iface: addresses.pop(0))
+        response = redirect.response
+        self.assertFalse(redirect.refresh())
+        self.assertTrue(response is redirect.response)
+        self.assertTrue(redirect.refresh())
+        self.assertEqual('http://10.0.1.1/', redirect.location)
+
+    def test_interface_without_address(self):
+        redirect = portal_redirect.PortalRedirect(None, 'wlan0', resolver=lambda iface: None)
+        self.assertEqual('/', redirect.location)
+
+
+class PortalInterfacesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addresses = {'wlan0': '10.0.0.1', 'wlan1': None}
+        self.interfaces = portal_redirect.PortalInterfaces(
+            [('wlan0', '10.0.0.1'), ('wlan1', None)], resolver=self.addresses.get)
+
+    def test_routes_by_local_address(self):
+        self.assertEqual('wlan0', self.interfaces.route('10.0.0.1').interface)
+        self.addresses['wlan1'] = '10.1.0.1'
+        self.assertTrue(self.interfaces.refresh())
+        self.assertEqual('http://10.1.0.1/', self.interfaces.route('10.1.0.1').location)
+
+    def test_unknown_address_goes_to_first_interface(self):
+        self.assertEqual('wlan0', self.interfaces.route('127.0.0.1').interface)
+        self.assertEqual('wlan0', self.interfaces.route(None).interface)
+
+    def test_counters_per_interface_and_total(self):
+        wlan0, wlan1 = self.interfaces.redirects
+        self.interfaces.count(wlan0, 'requests')
+        self.interfaces.count(wlan1, 'requests')
+        self.interfaces.count(wlan1, 'accepted')
+        metrics = self.interfaces.metrics()
+        self.assertEqual({'requests': 1, 'redirects': 0, 'accepted': 1, 'address': None}, metrics['wlan1'])
+        self.assertEqual({'requests': 2, 'redirects': 0, 'accepted': 1}, metrics['total'])
+
+
+class ProbeResponderTest(unittest.TestCase):
+
+    def setUp(self):
+        redirect = portal_redirect.PortalRedirect('10.0.0.1')
+        self.responder = probes.ProbeResponder(redirect, lambda ip: ip == '10.0.0.2')
+
+    def test_match_by_host_and_path(self):
+        self.assertEqual('windows-ncsi', self.responder.match('WWW.MSFTNCSI.COM:80', '/ncsi.txt'))
+
+    def test_match_by_path_alone(self):
+        self.assertEqual('android', self.responder.match('10.0.0.1', '/generate_204'))
+
+    def test_no_match(self):
+        self.assertEqual(None, self.responder.match('example.com', '/index.html'))
+
+    def test_unauthorized_client_is_redirected(self):
+        status, headers, body = self.responder.respond('android', '10.0.0.3')
+        self.assertEqual((302, 'http://10.0.0.1/'), (status, headers['Location']))
+
+    def test_redirect_to_given_interface(self):
+        redirect = portal_redirect.PortalRedirect('10.1.0.1')
+        status, headers, body = self.responder.respond('android', '10.1.0.3', redirect)
+        self.assertEqual('http://10.1.0.1/', headers['Location'])
+
+    def test_whitelisted_client_gets_success(self):
+        self.assertEqual(204, self.responder.respond('android', '10.0.0.2')[0])
+        self.assertEqual('Microsoft NCSI', self.responder.respond('windows-ncsi', '10.0.0.2')[2])
+
+    def test_counters(self):
+        self.responder.respond('firefox', '10.0.0.2')
+        self.responder.respond('firefox', '10.0.0.3')
+        self.responder.respond('firefox', '10.0.0.3')
+        self.assertEqual({'authorized': 1, 'unauthorized': 2}, self.responder.metrics()['firefox'])
+
+
+class ThrottleTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.table = throttle.ThrottleTable(rate=1, burst=2, max_clients=3, idle=60,
+                                            clock=lambda: self.now)
+
+    def test_burst_then_throttled(self):
+        self.assertEqual([True, True, False], [self.table.allow('10.0.0.2') for _ in range(3)])
+        self.assertEqual(1, self.table.metrics()['throttled_clients'])
+        self.assertTrue(self.table.allow('10.0.0.3'))
+
+    def test_bucket_refills(self):
+        self.table.allow('10.0.0.2')
+        self.table.allow('10.0.0.2')
+        self.now += 1
+        self.assertTrue(self.table.allow('10.0.0.2'))
+        self.assertFalse(self.table.allow('10.0.0.2'))
+
+    def test_idle_clients_are_dropped(self):
+        self.table.allow('10.0.0.2')
+        self.now += 61
+        self.table.allow('10.0.0.3')
+        self.assertEqual(1, len(self.table))
+
+    def test_table_is_bounded(self):
+        for host in range(10):
+            self.table.allow('10.0.0.%d' % host)
+        self.assertEqual(3, len(self.table))
+        self.assertEqual(7, self.table.metrics()['evicted'])
+
+
+class CheckArgsTest(unittest.TestCase):
+
+    def args(self, engine, addresses):
+        return argparse.Namespace(engine=engine, interface=['wlan0', 'wlan1'], address=addresses,
+                                  port=31337, sslport=31338, certificate=__file__, key=__file__,
+                                  configdir='/etc/captiveportal', appconfig='/etc/captiveportal/captiveportal.conf',
+                                  debug=False, test=False)
+
+    def test_cherrypy_needs_every_address_for_several_interfaces(self):
+        self.assertRaises(SystemExit, captive_portal.check_args, self.args('cherrypy', ['10.0.0.1']))
+        args = captive_portal.check_args(self.args('cherrypy', ['10.0.0.1', '10.0.1.1']))
+        self.assertEqual([('wlan0', '10.0.0.1'), ('wlan1', '10.0.1.1')], args.interfaces)
+        args = captive_portal.check_args(self.args('async', ['10.0.0.1']))
+        self.assertEqual([('wlan0', '10.0.0.1'), ('wlan1', None)], args.interfaces)
+
+
+class EchoApp(object):
+
+    def __init__(self):
+        self.servers = []
+
+    def handle(self, request):
+        return 200, {'Content-Type': 'text/plain'}, request.method + ' ' + request.path + ' ' + request.body
+
+
+class AsyncPortalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.loop = event_loop.EventLoop(clock=lambda: self.now)
+        self.server = async_portal.HTTPServer(self.loop, EchoApp(), '127.0.0.1', 0,
+                                              timeout=30, clock=lambda: self.now)
+        self.client = socket.create_connection(self.server.listener.getsockname())
+        self.client.settimeout(2)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        self.loop.close()
+
+    def exchange(self, data, responses):
+        self.client.sendall(data)
+        received = ''
+        while received.count('HTTP/1.') < responses:
+            self.loop.run_once(0.1)
+            try:
+                self.client.setblocking(False)
+                received += self.client.recv(65536)
+            except socket.error:
+                pass
+        return received
+
+    def test_pipelined_requests_answered_in_order(self):
+        received = self.exchange('GET /one HTTP/1.1\r\nHost: x\r\n\r\n'
+                                 'POST /two HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc', 2)
+        self.assertTrue(received.index('GET /one') < received.index('POST /two abc'))
+        self.assertEqual(1, len(self.server.connections))
+
+    def test_oversized_body_rejected(self):
+        received = self.exchange('POST / HTTP/1.1\r\nContent-Length: 999999\r\n\r\n', 1)
+        self.assertTrue(received.startswith('HTTP/1.1 413 '))
+        self.assertTrue('Connection: close' in received)
+
+    def test_head_gets_no_body(self):
+        received = self.exchange('HEAD /page HTTP/1.1\r\n\r\nGET /page HTTP/1.1\r\n\r\n', 2)
+        head, get = received.split('HTTP/1.1 ')[1:]
+        self.assertTrue('Content-Length: 11\r\n' in head)
+        self.assertTrue(head.endswith('\r\n\r\n'))
+        self.assertTrue(get.endswith('\r\n\r\nGET /page '))
+
+    def test_http_1_0_gets_http_1_0(self):
+        received = self.exchange('GET / HTTP/1.0\r\nConnection: keep-alive\r\n\r\n', 1)
+        self.assertTrue(received.startswith('HTTP/1.0 200 '))
+        self.assertTrue('Connection: keep-alive' in received)
+        received = self.exchange('GET / HTTP/1.0\r\n\r\n', 1)
+        self.assertTrue(received.startswith('HTTP/1.0 200 '))
+        self.assertTrue('Connection: close' in received)
+
+    def test_idle_connection_closed(self):
+        self.exchange('GET / HTTP/1.1\r\n\r\n', 1)
+        self.now += 31
+        self.loop.run_once(0)
+        self.assertEqual(0, len(self.server.connections))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# conntrack.py
+# Makes the kernel forget a client's hijacked connections once it's been
+# whitelisted.  captive-portal.sh initialize DNATs unauthorized web and DNS
+# traffic to ports 31337-31339, and conntrack remembers that for the life of
+# each flow: after clicking through, a browser's keep-alive connections and a
+# phone's DNS socket keep landing on the captive portal until they go quiet
+# for long enough to expire, so users reload over and over and load the
+# portal with it.  Deleting the client's DNATed entries right after the
+# whitelist rule goes in makes its next packet start a fresh flow that goes
+# where it was meant to.  Flows that weren't DNATed (ssh to the node, say) are
+# left alone.
+#
+# ConntrackBackend runs conntrack(8) once per client, from the whitelist
+# queue's worker thread, never a web server thread, right after the whitelist
+# script has been handed to the backend.
+
+# Modules.
+import logging
+import os
+import subprocess
+
+CONNTRACK = '/usr/sbin/conntrack'
+
+
+# quiet_call(): Runs a command with its output thrown away and returns its
+# exit code.  conntrack reports how many entries it deleted on stderr.
+def quiet_call(command):
+    devnull = open(os.devnull, 'w')
+    try:
+        return subprocess.call(command, stdout=devnull, stderr=devnull, close_fds=True)
+    finally:
+        devnull.close()
+
+
+class ConntrackBackend(object):
+
+    name = 'conntrack'
+
+    def __init__(self, test=False, runner=quiet_call):
+        self.test = test
+        self.runner = runner
+        self.available = True
+
+        # Counters for metrics().
+        self.flushes = 0
+        self.flushed = 0
+        self.failed = 0
+
+    # run(): Executes one command and returns its exit code.  In test mode the
+    # command is only logged.
+    def run(self, command):
+        if self.test:
+            logging.debug("Command that would be executed:\n%s", ' '.join(command))
+            return 0
+        return self.runner(command)
+
+    # command(): Deletes every DNATed connection tracking entry that came
+    # from clientip.
+    def command(self, clientip):
+        return [CONNTRACK, '-D', '--dst-nat', '-s', clientip]
+
+    # flush(): Forgets the hijacked flows of a batch of clients.  Returns the
+    # number of clients that had any.
+    def flush(self, clientips):
+        if not self.available:
+            return 0
+        flushed = 0
+        for clientip in clientips:
+            try:
+                status = self.run(self.command(clientip))
+            except OSError, e:
+                logging.error("Unable to run %s, not flushing connections of whitelisted clients: %s",
+                              CONNTRACK, e)
+                self.available = False
+                self.failed += 1
+                return flushed
+
+            # conntrack exits with 1 when there was nothing to delete.
+            if status == 0:
+                flushed += 1
+            elif status != 1:
+                logging.error("Unable to flush the connections of %s: conntrack exited with %d.",
+                              clientip, status)
+                self.failed += 1
+        self.flushes += 1
+        self.flushed += flushed
+        return flushed
+
+    def metrics(self):
+        return {'available': self.available,
+                'flushes': self.flushes,
+                'flushed_clients': self.flushed,
+                'failed': self.failed}
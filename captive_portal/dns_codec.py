@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# dns_codec.py
+# Reads and writes DNS messages (RFC 1035) for the DNS servers in Byzantium:
+# the captive portal's hijacker (fake_dns.py) and distdns/dnsserver.py, which
+# has a symlink to this file.  Both used to carry their own copy of the same
+# ActiveState recipe, which walked the name with ord() and no bounds checks,
+# so a query cut short in the name raised IndexError (and killed distdns),
+# and knew nothing about compression pointers, types or classes.
+#
+# Everything that reads a message checks every offset against its length and
+# raises DNSError for anything malformed, so a server only has to catch that.
+# Messages are read from bytearrays, which index as ints without ord() and
+# can be the very buffer a datagram was received into.  Names are followed
+# through compression pointers, which have to point backwards, so they can't
+# loop.  Encoder writes messages with every name compressed against the ones
+# written before it.
+
+# Modules.
+import struct
+
+# Types, classes, opcodes and response codes that come up.
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_PTR = 12
+TYPE_AAAA = 28
+TYPE_OPT = 41
+TYPE_HTTPS = 65
+TYPE_ANY = 255
+CLASS_IN = 1
+CLASS_ANY = 255
+OPCODE_QUERY = 0
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_NOTIMP = 4
+RCODE_REFUSED = 5
+
+# Flag bits of the second 16 bit word of the header.
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+
+# Limits from RFC 1035.
+MAX_LABEL = 63
+MAX_NAME = 255
+MAX_UDP = 512
+
+HEADER = struct.Struct('!HHHHHH')
+RECORD = struct.Struct('!HHIH')
+
+
+class DNSError(Exception):
+    pass
+
+
+# parse_header(): (id, flags, qdcount, ancount, nscount, arcount) of the
+# message in buf.
+def parse_header(buf, length=None):
+    if length is None:
+        length = len(buf)
+    if length < 12:
+        raise DNSError("Message is shorter than its header.")
+    return HEADER.unpack_from(buf)
+
+
+# read_name(): Reads the name at offset in buf, following compression
+# pointers.  Returns it as a list of labels (the root is []), and the offset
+# just past it where it started.
+def read_name(buf, offset, length=None):
+    if isinstance(buf, str):
+        buf = bytearray(buf)
+    if length is None:
+        length = len(buf)
+    labels = []
+    total = 1
+    end = None
+    while True:
+        if offset >= length:
+            raise DNSError("Name runs past the end of the message.")
+        size = buf[offset]
+        if size == 0:
+            if end is None:
+                end = offset + 1
+            return labels, end
+        if size & 0xc0 == 0xc0:
+            if offset + 1 >= length:
+                raise DNSError("Compression pointer runs past the end of the message.")
+            target = ((size & 0x3f) << 8) | buf[offset + 1]
+            if end is None:
+                end = offset + 2
+
+            # Only backwards, and only to somewhere after the header, so
+            # following pointers always ends.
+            if target >= offset or target < 12:
+                raise DNSError("Compression pointer to %d at %d." % (target, offset))
+            offset = target
+            continue
+        if size > MAX_LABEL:
+            raise DNSError("Label of %d bytes at %d." % (size, offset))
+        total += size + 1
+        if total > MAX_NAME:
+            raise DNSError("Name is longer than %d bytes." % MAX_NAME)
+        if offset + 1 + size > length:
+            raise DNSError("Label runs past the end of the message.")
+        labels.append(str(buf[offset + 1:offset + 1 + size]))
+        offset += size + 1
+
+
+# A query, as parse_query() found it.  end is the offset just past the
+# question, and edns the UDP payload size from its OPT record, if it had one.
+class Query(object):
+
+    __slots__ = ('id', 'flags', 'qtype', 'qclass', 'end', 'edns', 'edns_version', 'labels')
+
+    def __init__(self, id, flags, qtype, qclass, end, edns=None, edns_version=0, labels=None):
+        self.id = id
+        self.flags = flags
+        self.qtype = qtype
+        self.qclass = qclass
+        self.end = end
+        self.edns = edns
+        self.edns_version = edns_version
+        self.labels = labels
+
+    @property
+    def opcode(self):
+        return (self.flags >> 11) & 0xf
+
+    @property
+    def rd(self):
+        return bool(self.flags & FLAG_RD)
+
+    @property
+    def name(self):
+        return '.'.join(self.labels) + '.'
+
+    # payload(): Biggest UDP reply the client takes.
+    def payload(self):
+        if self.edns is None:
+            return MAX_UDP
+        return max(self.edns, MAX_UDP)
+
+
+# check_query(): Checks that buf holds a query a server can answer: not a
+# response, one question and no other records than an EDNS0 OPT record, at
+# most max_length bytes.  Returns (flags, end of the question, qtype, qclass,
+# the OPT record's UDP payload size or None), without reading the name, for
+# servers that don't need it; this is the fast path, so it's all in one
+# function.  buf has to be a bytearray.
+def check_query(buf, length, max_length=MAX_UDP):
+    if length < 17 or length > max_length:
+        raise DNSError("Query of %d bytes." % length)
+    id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(buf)
+    if flags & FLAG_QR:
+        raise DNSError("Not a query.")
+    if qdcount != 1 or ancount or nscount or arcount > 1:
+        raise DNSError("Query with %d questions, %d answers, %d authority and %d additional records." %
+                       (qdcount, ancount, nscount, arcount))
+
+    # The name, as labels of at most 63 bytes (questions are never
+    # compressed), then the type and class.
+    end = 12
+    size = buf[12]
+    while size:
+        if size > MAX_LABEL:
+            raise DNSError("Label of %d bytes (or a pointer) at %d." % (size, end))
+        end += size + 1
+        # The name is end - 12 bytes so far, and one more for the root.
+        if end >= length or end - 12 + 1 > MAX_NAME:
+            raise DNSError("Name runs past the end of the message, or is too long.")
+        size = buf[end]
+    end += 5
+    if end > length:
+        raise DNSError("Question runs past the end of the message.")
+    qtype = (buf[end - 4] << 8) | buf[end - 3]
+    qclass = (buf[end - 2] << 8) | buf[end - 1]
+
+    # The OPT record has the root for a name, the UDP payload size for a
+    # class and the extended rcode, version and flags for a TTL.
+    payload = None
+    if arcount:
+        if end + 11 > length or buf[end] or (buf[end + 1] << 8 | buf[end + 2]) != TYPE_OPT:
+            raise DNSError("Additional record in a query that isn't an OPT record.")
+        if end + 11 + (buf[end + 9] << 8 | buf[end + 10]) > length:
+            raise DNSError("OPT record runs past the end of the message.")
+        payload = (buf[end + 3] << 8) | buf[end + 4]
+    return flags, end, qtype, qclass, payload
+
+
+# parse_query(): The same checks as check_query(), returning a Query with the
+# name read too.  buf can be a string, but a bytearray saves copying it into
+# one.
+def parse_query(buf, length=None, max_length=MAX_UDP):
+    if isinstance(buf, str):
+        buf = bytearray(buf)
+    if length is None:
+        length = len(buf)
+    flags, end, qtype, qclass, payload = check_query(buf, length, max_length)
+    query = Query(HEADER.unpack_from(buf)[0], flags, qtype, qclass, end, payload,
+                  labels=read_name(buf, 12, length)[0])
+    if payload is not None:
+        query.edns_version = buf[end + 6]
+    return query
+
+
+# encode_name(): A name on its own, uncompressed.
+def encode_name(name):
+    labels = [label for label in name.split('.') if label]
+    for label in labels:
+        if len(label) > MAX_LABEL:
+            raise DNSError("Label of %d bytes." % len(label))
+    return ''.join(chr(len(label)) + label for label in labels) + '\x00'
+
+
+# Encoder builds a message one section at a time, questions first.  Every
+# name it writes is compressed: the longest ending it shares with a name
+# that's already in the message is replaced with a pointer to it.
+class Encoder(object):
+
+    def __init__(self, id, flags):
+        self.id = id
+        self.flags = flags
+        self.counts = [0, 0, 0, 0]
+        self.parts = []
+        self.length = 12
+
+        # Lower case name ending: where it is in the message.
+        self.names = {}
+
+    def _write(self, data):
+        self.parts.append(data)
+        self.length += len(data)
+
+    # name(): Writes a name, given as a string or a list of labels.
+    def name(self, name):
+        if isinstance(name, basestring):
+            labels = [label for label in name.split('.') if label]
+        else:
+            labels = name
+        data = []
+        length = self.length
+        for i in range(len(labels)):
+            key = '.'.join(labels[i:]).lower()
+            offset = self.names.get(key)
+            if offset is not None:
+                data.append(struct.pack('!H', 0xc000 | offset))
+                break
+            label = labels[i]
+            if not label or len(label) > MAX_LABEL:
+                raise DNSError("Label of %d bytes." % len(label))
+            if length < 0x4000:
+                self.names[key] = length
+            data.append(chr(len(label)) + label)
+            length += len(label) + 1
+        else:
+            data.append('\x00')
+        data = ''.join(data)
+        self._write(data)
+
+    def question(self, name, qtype, qclass=CLASS_IN):
+        self.name(name)
+        self._write(struct.pack('!HH', qtype, qclass))
+        self.counts[0] += 1
+
+    # record(): Adds a record to section 1 (answers), 2 (authority) or 3
+    # (additional).  Sections have to be written in order.
+    def record(self, section, name, rtype, rclass, ttl, rdata):
+        self.name(name)
+        self._write(RECORD.pack(rtype, rclass, ttl, len(rdata)) + rdata)
+        self.counts[section] += 1
+
+    def answer(self, name, rtype, ttl, rdata, rclass=CLASS_IN):
+        self.record(1, name, rtype, rclass, ttl, rdata)
+
+    def authority(self, name, rtype, ttl, rdata, rclass=CLASS_IN):
+        self.record(2, name, rtype, rclass, ttl, rdata)
+
+    # opt(): Adds an EDNS0 OPT record offering a UDP payload of that size.
+    def opt(self, payload, rcode_high=0, version=0):
+        self._write('\x00' + RECORD.pack(TYPE_OPT, payload, (rcode_high << 24) | (version << 16), 0))
+        self.counts[3] += 1
+
+    def tostring(self):
+        return HEADER.pack(self.id, self.flags, *self.counts) + ''.join(self.parts)
+
+
+# response(): An Encoder for the reply to query, with its question already
+# written.  Copies the ID, opcode and recursion desired from the query.
+def response(query, rcode=RCODE_NOERROR, aa=False, ra=True):
+    flags = FLAG_QR | (query.flags & (0x7800 | FLAG_RD)) | rcode
+    if aa:
+        flags |= FLAG_AA
+    if ra:
+        flags |= FLAG_RA
+    encoder = Encoder(query.id, flags)
+    encoder.question(query.labels, query.qtype, query.qclass)
+    return encoder
+
+
+# soa(): The data of an SOA record.
+def soa(mname, rname, serial, refresh, retry, expire, minimum):
+    return (encode_name(mname) + encode_name(rname) +
+            struct.pack('!IIIII', serial, refresh, retry, expire, minimum))
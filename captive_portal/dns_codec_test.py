@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# dns_codec_test.py
+
+import random
+import socket
+import string
+import struct
+import unittest
+import dns_codec
+from dns_codec import DNSError
+
+
+# query(): A standard query for name, with an OPT record if edns is given.
+def query(name, txid=0x1234, qtype=1, qclass=1, edns=None):
+    labels = ''.join(chr(len(label)) + label for label in name.split('.'))
+    data = (struct.pack('!HHHHHH', txid, 0x0100, 1, 0, 0, 1 if edns else 0) + labels + '\x00' +
+            struct.pack('!HH', qtype, qclass))
+    if edns:
+        data += '\x00' + struct.pack('!HHIH', 41, edns, 0, 0)
+    return data
+
+
+def random_name(rand):
+    return [''.join(rand.choice(string.ascii_letters + string.digits + '-')
+                    for i in range(rand.randint(1, 20)))
+            for j in range(rand.randint(1, 5))]
+
+
+# mutations(): Copies of data with a byte changed, cut short or grown, and
+# random bytes, for the fuzz tests.
+def mutations(rand, data, count):
+    for i in range(count):
+        buf = bytearray(data)
+        choice = rand.randint(0, 3)
+        if choice == 0:
+            for j in range(rand.randint(1, 4)):
+                buf[rand.randrange(len(buf))] = rand.randint(0, 255)
+        elif choice == 1:
+            buf = buf[:rand.randrange(len(buf))]
+        elif choice == 2:
+            buf += bytearray(rand.randint(0, 255) for j in range(rand.randint(1, 40)))
+        else:
+            buf = bytearray(rand.randint(0, 255) for j in range(rand.randint(0, 80)))
+        yield str(buf)
+
+
+class ParseQueryTest(unittest.TestCase):
+
+    def test_query(self):
+        query_ = dns_codec.parse_query(query('Captive.Apple.com', qtype=28))
+        self.assertEqual(0x1234, query_.id)
+        self.assertEqual(['Captive', 'Apple', 'com'], query_.labels)
+        self.assertEqual('Captive.Apple.com.', query_.name)
+        self.assertEqual((28, 1), (query_.qtype, query_.qclass))
+        self.assertEqual(0, query_.opcode)
+        self.assertTrue(query_.rd)
+        self.assertEqual(None, query_.edns)
+        self.assertEqual(512, query_.payload())
+
+    def test_edns(self):
+        query_ = dns_codec.parse_query(query('example.com', edns=1232))
+        self.assertEqual(1232, query_.edns)
+        self.assertEqual(1232, query_.payload())
+        self.assertEqual(512, dns_codec.parse_query(query('example.com', edns=200)).payload())
+
+    def test_check_query(self):
+        data = query('example.com', edns=4096)
+        flags, end, qtype, qclass, payload = dns_codec.check_query(bytearray(data), len(data))
+        self.assertEqual((0x0100, 29, 1, 1, 4096), (flags, end, qtype, qclass, payload))
+
+    def test_rejects(self):
+        good = query('example.com')
+        bad = [good[:11],  # Cut short in the header.
+               good[:16],  # Cut short in the name.
+               good[:-1],  # Cut short in the question.
+               good[:12] + '\x50' + 'x' * 80 + good[-5:],  # A label that's too long.
+               good[:12] + '\xc0\x0c' + good[-4:],  # A pointer in the question.
+               good[:12] + ('\x3f' + 'x' * 63) * 4 + good[-5:],  # A name that's too long.
+               struct.pack('!HHHHHH', 1, 0x8180, 1, 0, 0, 0) + good[12:],  # A response.
+               struct.pack('!HHHHHH', 1, 0x0100, 2, 0, 0, 0) + good[12:],  # Two questions.
+               struct.pack('!HHHHHH', 1, 0x0100, 1, 1, 0, 0) + good[12:],  # An answer.
+               struct.pack('!HHHHHH', 1, 0x0100, 1, 0, 0, 1) + good[12:] + '\x00\x00\x01',  # Not OPT.
+               query('example.com', edns=1232)[:-1],  # OPT cut short.
+               good + '\x00' * 600]  # Too big.
+        for data in bad:
+            self.assertRaises(DNSError, dns_codec.parse_query, data)
+
+    def test_longest_name(self):
+        longest = '.'.join(['x' * 63] * 3 + ['x' * 61])
+        data = query(longest)
+        self.assertEqual(dns_codec.MAX_NAME, len(data) - 12 - 4)
+        self.assertEqual(longest + '.', dns_codec.parse_query(data).name)
+        self.assertEqual(4, len(dns_codec.read_name(data, 12)[0]))
+        data = query(longest + 'x')
+        self.assertRaises(DNSError, dns_codec.parse_query, data)
+        self.assertRaises(DNSError, dns_codec.check_query, bytearray(data), len(data))
+        self.assertRaises(DNSError, dns_codec.read_name, data, 12)
+
+    def test_fuzz(self):
+        rand = random.Random(23)
+        seeds = [query('example.com'), query('connectivitycheck.gstatic.com', edns=1232),
+                 query('a.b.c.d.e', qtype=255)]
+        for seed in seeds:
+            for data in mutations(rand, seed, 2000):
+                try:
+                    query_ = dns_codec.parse_query(data)
+                except DNSError:
+                    continue
+                self.assertTrue(query_.end <= len(data))
+                self.assertTrue(len(query_.name) <= dns_codec.MAX_NAME)
+
+
+class ReadNameTest(unittest.TestCase):
+
+    def test_pointer(self):
+        data = query('www.example.com') + '\x04mail\xc0\x10'
+        self.assertEqual((['mail', 'example', 'com'], len(data)), dns_codec.read_name(data, len(data) - 7))
+
+    def test_forward_pointer(self):
+        data = '\x00' * 12 + '\xc0\x0e\x00'
+        self.assertRaises(DNSError, dns_codec.read_name, data, 12)
+
+    def test_loop(self):
+        data = '\x00' * 12 + '\x01a\xc0\x0c'
+        self.assertRaises(DNSError, dns_codec.read_name, data, 12)
+        self.assertRaises(DNSError, dns_codec.read_name, data, 14)
+
+    def test_pointer_into_header(self):
+        data = '\x00' * 12 + '\xc0\x02'
+        self.assertRaises(DNSError, dns_codec.read_name, data, 12)
+
+    def test_fuzz(self):
+        rand = random.Random(1035)
+        encoder = dns_codec.Encoder(1, 0x8180)
+        encoder.question('www.example.com', 1)
+        encoder.answer('www.example.com', 5, 60, '\x03web\xc0\x10')
+        encoder.answer('mail.example.com', 1, 60, socket.inet_aton('10.0.0.1'))
+        for data in mutations(rand, encoder.tostring(), 3000):
+            for offset in range(12, len(data)):
+                try:
+                    labels, end = dns_codec.read_name(data, offset)
+                except DNSError:
+                    continue
+                self.assertTrue(offset < end <= len(data))
+
+
+class EncoderTest(unittest.TestCase):
+
+    def test_compression(self):
+        encoder = dns_codec.Encoder(7, 0x8180)
+        encoder.question('www.example.com', 1)
+        encoder.answer('www.example.com', 1, 60, socket.inet_aton('10.0.0.1'))
+        encoder.answer('mail.Example.com', 1, 60, socket.inet_aton('10.0.0.2'))
+        encoder.authority('example.com', 6, 60, dns_codec.soa('ns.example.com', 'root.example.com',
+                                                              1, 2, 3, 4, 5))
+        data = encoder.tostring()
+        self.assertEqual((7, 0x8180, 1, 2, 1, 0), dns_codec.parse_header(data))
+
+        # The first answer is only a pointer to the question's name, and the
+        # second shares example.com with it.
+        self.assertEqual('\xc0\x0c', data[33:35])
+        self.assertEqual('\x04mail\xc0\x10', data[49:56])
+        self.assertEqual((['www', 'example', 'com'], 35), dns_codec.read_name(data, 33))
+        self.assertEqual((['mail', 'example', 'com'], 56), dns_codec.read_name(data, 49))
+        self.assertEqual((['example', 'com'], 72), dns_codec.read_name(data, 70))
+
+    def test_round_trip(self):
+        rand = random.Random(255)
+        for i in range(200):
+            encoder = dns_codec.Encoder(i, 0x8180)
+            names = []
+            offsets = []
+            for j in range(rand.randint(1, 6)):
+                # Half of them end the same as one before, to be compressed.
+                name = random_name(rand)
+                if names and rand.random() < 0.5:
+                    other = rand.choice(names)
+                    name = name[:2] + other[rand.randrange(len(other)):]
+                names.append(name)
+                offsets.append(encoder.length)
+                encoder.answer(name, 1, 60, '\x0a\x00\x00\x01')
+            data = encoder.tostring()
+            self.assertTrue(len(data) <= 12 + sum(len(dns_codec.encode_name('.'.join(name))) + 14
+                                                  for name in names))
+            for name, offset in zip(names, offsets):
+                self.assertEqual(name, dns_codec.read_name(data, offset)[0])
+
+    def test_response(self):
+        query_ = dns_codec.parse_query(query('example.com', txid=0x4321))
+        encoder = dns_codec.response(query_, dns_codec.RCODE_REFUSED, aa=True)
+        encoder.opt(1232)
+        data = encoder.tostring()
+        self.assertEqual((0x4321, 0x8585, 1, 0, 0, 1), dns_codec.parse_header(data))
+        self.assertEqual(query('example.com', txid=0x4321)[12:], data[12:29])
+        self.assertEqual('\x00' + struct.pack('!HHIH', 41, 1232, 0, 0), data[29:])
+
+    def test_long_label(self):
+        encoder = dns_codec.Encoder(1, 0x8180)
+        self.assertRaises(DNSError, encoder.name, 'x' * 64 + '.com')
+        self.assertRaises(DNSError, dns_codec.encode_name, 'x' * 64 + '.com')
+
+if __name__ == '__main__':
+    unittest.main()
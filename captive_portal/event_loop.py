@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# event_loop.py
+# A small single-threaded event loop on top of epoll (or poll, where there's
+# no epoll).  Callbacks are registered per file descriptor for readability
+# and writability, and timers run on the same thread.  It's what the captive
+# portal's --engine=async mode runs on, so hundreds of idle phones holding
+# connections open cost a file descriptor each instead of a thread each.
+
+# Modules.
+import errno
+import heapq
+import logging
+import select
+import time
+
+if hasattr(select, 'epoll'):
+    READ = select.EPOLLIN | select.EPOLLPRI
+    WRITE = select.EPOLLOUT
+    ERROR = select.EPOLLERR | select.EPOLLHUP
+else:
+    READ = select.POLLIN | select.POLLPRI
+    WRITE = select.POLLOUT
+    ERROR = select.POLLERR | select.POLLHUP
+
+
+# Handle for something scheduled with call_later() or call_every().
+class Timer(object):
+
+    def __init__(self, when, interval, callback, args):
+        self.when = when
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+
+class EventLoop(object):
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._scale = 1.0
+        else:
+            self._poller = select.poll()
+            self._scale = 1000.0
+
+        # fd: [read callback, write callback]
+        self._callbacks = {}
+        self._timers = []
+        self._running = False
+
+    def _update(self, fd):
+        reader, writer = self._callbacks[fd]
+        mask = 0
+        if reader:
+            mask |= READ
+        if writer:
+            mask |= WRITE
+        if not mask:
+            del self._callbacks[fd]
+            self._poller.unregister(fd)
+        else:
+            self._poller.modify(fd, mask)
+
+    def _set(self, fd, which, callback):
+        if hasattr(fd, 'fileno'):
+            fd = fd.fileno()
+        if fd not in self._callbacks:
+            if callback is None:
+                return
+            self._callbacks[fd] = [None, None]
+            self._callbacks[fd][which] = callback
+            self._poller.register(fd, READ if which == 0 else WRITE)
+            return
+        self._callbacks[fd][which] = callback
+        self._update(fd)
+
+    # add_reader()/add_writer(): Calls callback() whenever fd (a file
+    # descriptor or anything with a fileno()) is readable/writable.
+    def add_reader(self, fd, callback):
+        self._set(fd, 0, callback)
+
+    def remove_reader(self, fd):
+        self._set(fd, 0, None)
+
+    def add_writer(self, fd, callback):
+        self._set(fd, 1, callback)
+
+    def remove_writer(self, fd):
+        self._set(fd, 1, None)
+
+    # remove(): Forgets about fd entirely.  Call it before closing a socket.
+    def remove(self, fd):
+        if hasattr(fd, 'fileno'):
+            fd = fd.fileno()
+        if self._callbacks.pop(fd, None) is not None:
+            self._poller.unregister(fd)
+
+    # call_later(): Runs callback(*args) once, delay seconds from now.
+    def call_later(self, delay, callback, *args):
+        timer = Timer(self._clock() + delay, None, callback, args)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    # call_every(): Runs callback(*args) every interval seconds.
+    def call_every(self, interval, callback, *args):
+        timer = Timer(self._clock() + interval, interval, callback, args)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def _run_timers(self):
+        now = self._clock()
+        while self._timers and self._timers[0].when <= now:
+            timer = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logging.exception("Timer callback %r failed.", timer.callback)
+            if timer.interval is not None and not timer.cancelled:
+                timer.when = now + timer.interval
+                heapq.heappush(self._timers, timer)
+
+    def _timeout(self):
+        if not self._timers:
+            return 1.0
+        return min(max(self._timers[0].when - self._clock(), 0.0), 1.0)
+
+    # run_once(): Waits for at most timeout seconds (or until the next timer
+    # is due) and dispatches whatever happened.
+    def run_once(self, timeout=None):
+        if timeout is None:
+            timeout = self._timeout()
+        try:
+            events = self._poller.poll(timeout * self._scale)
+        except (IOError, OSError, select.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+
+        for fd, mask in events:
+            callbacks = self._callbacks.get(fd)
+            if callbacks is None:
+                continue
+            try:
+                if mask & (READ | ERROR) and callbacks[0]:
+                    callbacks[0]()
+                if mask & (WRITE | ERROR) and callbacks[1] and fd in self._callbacks:
+                    callbacks[1]()
+            except Exception:
+                logging.exception("Event loop callback for fd %d failed.", fd)
+        self._run_timers()
+
+    def run(self):
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        self._running = False
+
+    def close(self):
+        if hasattr(self._poller, 'close'):
+            self._poller.close()
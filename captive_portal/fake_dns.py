@@ -4,56 +4,835 @@
 
 # http://minidns.googlecode.com/hg/minidns
 # Found by: Haxwithaxe
+#
+# Answers every query with the captive portal's address.  It runs on an
+# EventLoop (event_loop.py) so a burst of OS connectivity checks is read and
+# answered in batches instead of one blocking recvfrom()/sendto()/print at a
+# time, and it can listen on several addresses and ports at once.  With
+# --workers it forks that many copies of itself, each with its own sockets
+# bound with SO_REUSEPORT so the kernel spreads queries across them, and stays
+# behind to restart any that die.  Queries over UDP are rate limited per
+# client, and identical replies per /24 (RateLimiter).  Names in the mesh's
+# hosts file (/etc/hosts.mesh) are answered with their real addresses
+# (MeshHosts).
 
 # Import Python modules.
+from collections import deque
+
+import argparse
+import os
 import sys
+import errno
+import logging
+import signal
+import time
+import traceback
 import socket
 import fcntl
 import struct
+import threading
+
+import dns_codec
+from dns_codec import (CLASS_ANY, CLASS_IN, RCODE_NOTIMP, RCODE_REFUSED, TYPE_A, TYPE_ANY,
+                       DNSError, check_query)
+from event_loop import EventLoop
+
+# Biggest query that's answered.  A real one has a single question, at most
+# 259 bytes of it, and maybe an EDNS0 OPT record; anything bigger is dropped
+# without being looked at.
+MAX_QUERY = 512
+
+# Biggest UDP payload advertised in the OPT record of replies to EDNS0
+# queries.  The replies are never anywhere near it.
+EDNS_PAYLOAD = 1232
+
+# Biggest UDP reply a client that doesn't use EDNS0 takes, and the least one
+# that does can say it takes.
+UDP_PAYLOAD = dns_codec.MAX_UDP
+
+# ResponseBuilder turns queries into replies that answer with ip, in the
+# buffer they were received into.  Everything after the question is the same
+# for every reply of a kind, so it's packed once, when the builder is made,
+# and build() only has to check the query, patch the header and copy the
+# right records on after the question:
+#   - A (or ANY) queries in class IN get an A record with ip, 15 second TTL.
+#   - Other types get NODATA: no error, no answers, and an SOA record in the
+#     authority section so that resolvers cache that for 15 seconds instead of
+#     asking again, or worse, taking an A record for the AAAA, HTTPS or PTR
+#     they asked for as a broken reply and retrying.
+#   - Other classes are REFUSED, and other opcodes get NOTIMP.
+#   - Queries with an EDNS0 OPT record get one back.
+#   - Over UDP, replies that are bigger than the client can take have their
+#     records left off and TC set, so it asks again over TCP.  With a single
+#     question of at most 255 bytes, they'd have to be rather odd clients.
+#   - Queries that are cut short, too long, have other than one question, or
+#     records where there shouldn't be any, aren't answered at all.
+#   - Names in hosts (MeshHosts.names), if it's given, are answered from
+#     there instead, authoritatively: their own A record, or NODATA for other
+#     types.
+class ResponseBuilder:
+  def __init__(self, ip):
+    self.ip = ip
+
+    # Answer: pointer to the name in the question, type A, class IN, TTL 15
+    # seconds, 4 bytes of data: the address.
+    self.answer = (struct.pack('!H', 0xc00c) +
+                   dns_codec.RECORD.pack(dns_codec.TYPE_A, dns_codec.CLASS_IN, 15, 4) +
+                   socket.inet_aton(ip))
+
+    # Authority for NODATA: an SOA record for the name asked for, with the
+    # root as the primary server and mailbox and a 15 second minimum TTL.
+    soa = dns_codec.soa('.', '.', 1, 3600, 600, 86400, 15)
+    self.authority = (struct.pack('!H', 0xc00c) +
+                      dns_codec.RECORD.pack(dns_codec.TYPE_SOA, dns_codec.CLASS_IN, 15, len(soa)) + soa)
+
+    # Additional: the OPT record.
+    self.opt = '\x00' + dns_codec.RECORD.pack(dns_codec.TYPE_OPT, EDNS_PAYLOAD, 0, 0)
+
+  # build(): Rewrites the length byte query at the start of buf as its reply.
+  # Returns the length of the reply, 0 if the query isn't one to answer, or
+  # None if it's malformed (see dns_codec.parse_query()).  buf needs ROOM
+  # bytes of space after the question.  udp is False for queries that came in
+  # over TCP, which can't be truncated.
+  def build(self, buf, length, udp=True, hosts=None):
+    try:
+      flags, end, qtype, qclass, payload = check_query(buf, length, MAX_QUERY)
+    except DNSError:
+      return None
+
+    # Recursion desired is copied from the query, and recursion is always
+    # available.  Only standard queries are answered properly.
+    rd = buf[2] & 0x01
+    if flags & 0x7800:
+      buf[2:4] = chr(0x80 | (buf[2] & 0x78) | rd) + chr(0x80 | RCODE_NOTIMP)
+      buf[4:12] = '\x00' * 8
+      return 12
+
+    rcode = 0
+    answers = authority = 0
+    aa = 0
+    host = None
+    if hosts:
+      # Length bytes are never letters, so the whole name can be lowered.
+      host = hosts.get(str(buf[12:end - 4]).lower())
+    if qclass not in (CLASS_IN, CLASS_ANY):
+      rcode = RCODE_REFUSED
+      records = ''
+    elif host is not None:
+      aa = 0x04
+      if qtype in (TYPE_A, TYPE_ANY):
+        answers = 1
+        records = host
+      else:
+        authority = 1
+        records = self.authority
+    elif qtype in (TYPE_A, TYPE_ANY) and end > 17:
+      answers = 1
+      records = self.answer
+    else:
+      authority = 1
+      records = self.authority
+    edns = 0
+    limit = UDP_PAYLOAD
+    if payload is not None:
+      edns = 1
+      records += self.opt
+      limit = max(payload, UDP_PAYLOAD)
+
+    flags = 0x80 | aa | rd
+    if udp and end + len(records) > limit:
+      flags |= 0x02
+      answers = authority = 0
+      records = self.opt if edns else ''
+
+    buf[2:12] = struct.pack('!BBHHHH', flags, 0x80 | rcode, 1, answers, authority, edns)
+    size = end + len(records)
+    buf[end:size] = records
+    return size
+
+# Space build() needs after the question for the records it adds.
+ROOM = 48
+
+# Where make_hosts() (control_panel/networkconfiguration.py) writes the names
+# of the node and its clients, the TTL of answers from it, and how often it's
+# checked for changes.
+HOSTS_FILE = '/etc/hosts.mesh'
+HOSTS_TTL = 60
+HOSTS_INTERVAL = 5
+
+# parse_hosts(): Indexes the lines of a hosts file for MeshHosts.  The first
+# IPv4 address given for a name is the one it gets; IPv6 addresses are
+# skipped.
+def parse_hosts(lines, ttl=HOSTS_TTL):
+  names = {}
+  for line in lines:
+    fields = line.split('#', 1)[0].split()
+    if len(fields) < 2:
+      continue
+    try:
+      address = socket.inet_pton(socket.AF_INET, fields[0])
+    except socket.error:
+      continue
+    record = (struct.pack('!H', 0xc00c) +
+              dns_codec.RECORD.pack(dns_codec.TYPE_A, dns_codec.CLASS_IN, ttl, 4) + address)
+    for name in fields[1:]:
+      try:
+        key = dns_codec.encode_name(name.lower())
+      except DNSError:
+        continue
+      if len(key) <= dns_codec.MAX_NAME:
+        names.setdefault(key, record)
+  return names
+
+# MeshHosts indexes a hosts file (/etc/hosts.mesh) for ResponseBuilder, so
+# that clients that haven't been through the captive portal yet can still
+# look up the node and each other by name.  names is keyed by the name the
+# way it's written in a question, in lower case, so a query is looked up with
+# the bytes already in its buffer, and holds the A record that answers it,
+# packed.  check() reloads the file if its mtime, size or inode has changed.
+# refresh() does that on a thread of its own, because Byzantium runs off USB
+# sticks that can take their time, and the event loop shouldn't wait on them;
+# a new index replaces the old one in a single assignment, and generation
+# goes up every time, so that anything caching answers knows to forget them.
+# start() calls refresh() every interval seconds from an EventLoop.
+class MeshHosts:
+  def __init__(self, path=HOSTS_FILE, ttl=HOSTS_TTL):
+    self.path = path
+    self.ttl = ttl
+    self.names = {}
+    self.generation = 0
+    self.errors = 0
+    self._stamp = None
+    self._timer = None
+    self._loading = threading.Lock()
+
+  # check(): Reloads the file if it's changed.  Returns True if it was.  A
+  # file that's gone empties the index.
+  def check(self):
+    try:
+      stat = os.stat(self.path)
+      stamp = (stat.st_mtime, stat.st_size, stat.st_ino)
+    except OSError:
+      stamp = None
+    if stamp == self._stamp:
+      return False
+    names = {}
+    if stamp is not None:
+      try:
+        with open(self.path) as hosts:
+          names = parse_hosts(hosts, self.ttl)
+      except IOError, e:
+        self.errors += 1
+        logging.warning("Unable to read %s: %s", self.path, e)
+        return False
+    self._stamp = stamp
+    self.names = names
+    self.generation += 1
+    return True
+
+  # refresh(): check() on a thread, unless one is still at it.
+  def refresh(self):
+    if not self._loading.acquire(False):
+      return
+    def load():
+      try:
+        self.check()
+      finally:
+        self._loading.release()
+    thread = threading.Thread(target=load, name='hosts-mesh')
+    thread.daemon = True
+    thread.start()
+
+  def start(self, loop, interval=HOSTS_INTERVAL):
+    self.refresh()
+    self._timer = loop.call_every(interval, self.refresh)
+
+  def stop(self):
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+
+  def metrics(self):
+    return {'names': len(self.names), 'generation': self.generation, 'errors': self.errors}
+
+# client_network(): The prefix of every address in the /24 that a client
+# interface at ip serves (captive-portal.sh assumes the same), for
+# startswith().
+def client_network(ip):
+  return ip.rsplit('.', 1)[0] + '.'
+
+# truncate(): Cuts the reply of size bytes in buf down to its header and
+# question, with TC set so that the client asks again over TCP.  Returns its
+# new size.
+def truncate(buf, size):
+  end = 12
+  if buf[5]:
+    while buf[end]:
+      end += buf[end] + 1
+    end += 5
+  buf[2] |= 0x02
+  buf[6:12] = '\x00' * 6
+  return min(end, size)
+
+# Replies ReplyCache keeps by default.  They're rarely much over 100 bytes.
+CACHE_SIZE = 1024
+
+# ReplyCache keeps the replies ResponseBuilder has built, keyed by everything
+# in the query after its transaction ID: the flags, counts, question and OPT
+# record, which is all a reply depends on.  Clients ask for the same few names
+# over and over, so most queries can be answered by copying a cached reply in
+# after their ID instead of building one.  It holds at most size replies.  A
+# hit only stamps the entry with a counter; when the cache is full, the least
+# recently used quarter of it is thrown out in one go, so the sorting that
+# takes is paid for once every size / 4 misses rather than on every hit.
+class ReplyCache:
+  def __init__(self, size=CACHE_SIZE):
+    self.size = size
+    self.hits = 0
+    self.misses = 0
+    self._tick = 0
+
+    # key: [reply without its ID, last used]
+    self._replies = {}
+
+  def get(self, key):
+    entry = self._replies.get(key)
+    if entry is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._tick += 1
+    entry[1] = self._tick
+    return entry[0]
+
+  def put(self, key, reply):
+    if len(self._replies) >= self.size:
+      entries = sorted(self._replies.iteritems(), key=lambda item: item[1][1])
+      for old, entry in entries[:max(self.size // 4, 1)]:
+        del self._replies[old]
+    self._tick += 1
+    self._replies[key] = [reply, self._tick]
+
+  def clear(self):
+    self._replies.clear()
+
+  def __len__(self):
+    return len(self._replies)
+
+  def metrics(self):
+    lookups = self.hits + self.misses
+    return {'size': len(self._replies), 'capacity': self.size,
+            'hits': self.hits, 'misses': self.misses,
+            'hit_ratio': round(float(self.hits) / lookups, 3) if lookups else None}
+
+# Queries a second each client can send over UDP, and how many it can send
+# at once: a phone that's just joined looks up a few dozen names in a second
+# or two.
+QUERY_RATE = 50
+QUERY_BURST = 200
+
+# Identical replies a second that go to one /24 over UDP, and one in how many
+# of those over the limit are sent truncated instead of being dropped.  The
+# node's own client network is one /24 whose clients all ask for the same few
+# connectivity check names, so DNSHijacker leaves it out (see
+# client_network()); this is for everywhere else on the mesh.
+RESPONSE_RATE = 20
+SLIP = 2
+
+# Prefix lengths sources are grouped by: one client at a time for queries,
+# since a node's clients all share one /24, and whole /24s for replies (as
+# BIND's RRL does), so that spoofed sources can't spread a flood of them over
+# a bucket each.
+QUERY_PREFIX = 32
+RESPONSE_PREFIX = 24
+
+# Most buckets in each of a RateLimiter's tables.
+LIMITER_SIZE = 4096
+
+# RateLimiter decides what DNSHijacker answers over UDP, where anyone on the
+# mesh can reach it and sources are easy to spoof:
+#   - Every source (grouped by query_prefix) has a token bucket that refills
+#     at rate queries a second, up to burst.  Queries from a source with an
+#     empty bucket are dropped before they're looked at.
+#   - Every reply has a bucket for each /24 (response_prefix) it goes to,
+#     which refills at responses a second: response rate limiting, so neither
+#     a client nor the victim of queries spoofed to come from it is sent the
+#     same reply over and over.  Of the replies over the limit, one in slip is
+#     sent truncated (see truncate()), so that a real client asks again over
+#     TCP, which can't be spoofed, and the rest are dropped.
+# A rate of 0 turns either off.  Sources that start with one of exempt (the
+# node itself, by default) aren't limited.  The buckets are kept in dicts of
+# at most size entries.  An entry whose bucket has had time to refill is as
+# good as none, so when a table is full, those are thrown out first, then the
+# least recently used until a quarter of it is free.  fake_dns.py --workers
+# runs one in every worker, so the limits are per worker.  DNSHijacker
+# doesn't response rate limit replies to its own client network.
+class RateLimiter:
+  def __init__(self, rate=QUERY_RATE, burst=QUERY_BURST, responses=RESPONSE_RATE, slip=SLIP,
+               query_prefix=QUERY_PREFIX, response_prefix=RESPONSE_PREFIX, size=LIMITER_SIZE,
+               exempt=('127.',), clock=time.time):
+    self.rate = float(rate)
+    self.burst = float(max(burst, 1))
+    self.responses = float(responses)
+    self.slip = slip
+    self.size = size
+    self.exempt = tuple(exempt)
+    self._clock = clock
+    self._query_mask = (0xffffffff << (32 - query_prefix)) & 0xffffffff
+    self._response_mask = (0xffffffff << (32 - response_prefix)) & 0xffffffff
+
+    # Counters for metrics().
+    self.limited = 0
+    self.dropped = 0
+    self.slipped = 0
+    self.evicted = 0
+
+    # prefix: [tokens, last seen, 0]
+    self._sources = {}
+
+    # (prefix, reply without its ID): [tokens, last seen, replies over the
+    # limit]
+    self._replies = {}
+
+  # _prefix(): ip's prefix under mask; ip itself for a whole address.
+  def _prefix(self, ip, mask):
+    if mask == 0xffffffff:
+      return ip
+    return struct.unpack('!I', socket.inet_aton(ip))[0] & mask
+
+  # _take(): Takes a token from the bucket for key in table.  Returns None if
+  # there was one, or the bucket's entry if it was empty.
+  def _take(self, table, key, rate, burst):
+    now = self._clock()
+    entry = table.get(key)
+    if entry is None:
+      if len(table) >= self.size:
+        self._expire(table, now, burst / rate)
+      table[key] = [burst - 1, now, 0]
+      return None
+    tokens = entry[0] + (now - entry[1]) * rate
+    entry[1] = now
+    if tokens >= 1:
+      entry[0] = min(tokens, burst) - 1
+      return None
+    entry[0] = tokens
+    return entry
+
+  # _expire(): Makes room in a full table.  full is how long an empty bucket
+  # takes to refill.
+  def _expire(self, table, now, full):
+    for key, entry in table.items():
+      if now - entry[1] >= full:
+        del table[key]
+    room = len(table) - self.size * 3 // 4
+    if room > 0:
+      entries = sorted(table.iteritems(), key=lambda item: item[1][1])
+      for key, entry in entries[:room]:
+        del table[key]
+      self.evicted += room
+
+  # allow(): Whether to answer a query from source at all.
+  def allow(self, source):
+    if not self.rate or source.startswith(self.exempt):
+      return True
+    if self._take(self._sources, self._prefix(source, self._query_mask), self.rate, self.burst) is None:
+      return True
+    self.limited += 1
+    return False
 
-# DNSQuery class from http://code.activestate.com/recipes/491264-mini-fake-dns-server/
-class DNSQuery:
-  # 'data' is the actual DNS resolution request from the client.
-  def __init__(self, data):
-    self.data=data
-    self.domain=''
-
-    tipo = (ord(data[2]) >> 3) & 15   # Opcode bits
-
-    # Determine if the client is making a standard resolution request.
-    # Otherwise, don't do anything because it's not a resolution request.
-    if tipo == 0:
-      ini=12
-      lon=ord(data[ini])
-      while lon != 0:
-        self.domain+=data[ini+1:ini+lon+1]+'.'
-        ini+=lon+1
-        lon=ord(data[ini])
-
-  # Build a reply packet for the client.
-  def respuesta(self, ip):
-    packet=''
-    if self.domain:
-      packet+=self.data[:2] + "\x81\x80"
-
-      # Question and answer counts.
-      packet+=self.data[4:6] + self.data[4:6] + '\x00\x00\x00\x00'
-
-      # A copy of the original resolution query from the client.
-      packet+=self.data[12:]
-
-      # Pointer to the domain name.
-      packet+='\xc0\x0c'
-
-      # Response type, TTL of the reply, and length of data in reply.
-      packet+='\x00\x01'  # TYPE: A record
-      packet+='\x00\x01'  # CLASS: IN (Internet)
-      packet+='\x00\x00\x00\x0f'  # TTL: 15 sec
-      packet+='\x00\x04'  # Length of data: 4 bytes
-
-      # The IP address of the server the DNS is running on.
-      packet+=str.join('',map(lambda x: chr(int(x)), ip.split('.')))
-    return packet
+  # check(): Returns size if the reply of size bytes in buf can go to source,
+  # the size it's been truncated to if it's slipped, or 0 if it's dropped.
+  def check(self, source, buf, size):
+    if not self.responses or source.startswith(self.exempt):
+      return size
+    key = (self._prefix(source, self._response_mask), str(buf[2:size]))
+    entry = self._take(self._replies, key, self.responses, self.responses)
+    if entry is None:
+      return size
+    entry[2] += 1
+    if self.slip and entry[2] % self.slip == 0:
+      self.slipped += 1
+      return truncate(buf, size)
+    self.dropped += 1
+    return 0
+
+  def metrics(self):
+    return {'sources': len(self._sources), 'replies': len(self._replies),
+            'limited_queries': self.limited, 'dropped_replies': self.dropped,
+            'slipped_replies': self.slipped, 'evicted': self.evicted}
+
+# Most replies that go out in one batch from DNSHijacker, and most that are
+# held back when the socket's send buffer is full.
+BATCH_SIZE = 64
+MAX_BACKLOG = 1024
+
+# Biggest datagram read from the socket: one byte more than a query that
+# would be answered, to tell which ones are too big.
+RECV_SIZE = MAX_QUERY + 1
+
+# Python 2.7 only knows SO_REUSEPORT if it was built against headers that have
+# it; this is its value on Linux.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# DNSHijacker answers queries on one UDP socket from an EventLoop
+# (event_loop.py).  Each time the socket becomes readable it reads everything
+# that's waiting, up to EAGAIN, and sends the replies out in batches of
+# BATCH_SIZE instead of interleaving one recvfrom() with one sendto().  Each
+# query of a batch is read into a buffer of its own that's kept from one
+# wakeup to the next, and its reply is built and sent from there
+# (ResponseBuilder), or copied there from a ReplyCache.  If the
+# send buffer fills up, replies are held (up to MAX_BACKLOG of them) until the
+# socket is writable again.  With sample set, one query in every sample is
+# logged.  fake_dns.py runs one for every --listen address; captive_portal.py
+# --in-process runs one next to the web server.  ip can be changed at any
+# time.  With reuseport set, other processes can bind the same address and
+# port and share its queries.  With tcp set, it answers over TCP on the same
+# address and port too (DNSTCPServer).  Queries and replies over UDP go
+# through limiter: True for a RateLimiter with the default limits, a
+# RateLimiter to share one between hijackers, or None for no limits.  Names
+# in hosts, a MeshHosts that whoever made it keeps up to date, are answered
+# with their own addresses.  Unless limit_clients is set, replies to the
+# client network ip is in only count against each client's query rate, not
+# the response rate limit.
+class DNSHijacker:
+  def __init__(self, loop, ip, port=31339, address='', sample=0, reuseport=False, tcp=True,
+               limiter=True, hosts=None, limit_clients=False):
+    self.loop = loop
+    self.ip = ip
+    self.limit_clients = limit_clients
+    self.sample = sample
+    self.queries = 0
+    self.errors = 0
+    self.replies = 0
+    self.batches = 0
+    self.dropped = 0
+    self._backlog = deque()
+    self._builder = None
+    self.cache = ReplyCache()
+    self.hosts = hosts
+    self._generation = None
+    if limiter is True:
+      limiter = RateLimiter()
+    self.limiter = limiter
+    # Room for a query and the records ResponseBuilder adds.
+    self._buffers = [bytearray(RECV_SIZE + ROOM) for i in range(BATCH_SIZE)]
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuseport:
+      self.sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    self.sock.bind((address, port))
+    self.sock.setblocking(0)
+    self.tcp = None
+    if tcp:
+      try:
+        self.tcp = DNSTCPServer(self, address, self.sock.getsockname()[1], reuseport)
+      except socket.error:
+        self.sock.close()
+        raise
+    loop.add_reader(self.sock, self.on_readable)
+
+  # Answer everything that's waiting, then go back to the loop.
+  def on_readable(self):
+    replies = []
+    limiter = self.limiter
+    clients = None
+    if self.ip and not self.limit_clients:
+      clients = client_network(self.ip)
+    while True:
+      buf = self._buffers[len(replies)]
+      try:
+        length, addr = self.sock.recvfrom_into(buf, RECV_SIZE)
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          break
+        # An ICMP error from an earlier reply, not a query.
+        if e.args[0] == errno.ECONNREFUSED:
+          continue
+        raise
+      self.queries += 1
+      if not self.ip:
+        continue
+      if limiter is not None and not limiter.allow(addr[0]):
+        continue
+      size = self.answer(buf, length)
+      if size is None:
+        self.errors += 1
+        continue
+      if size and limiter is not None and not (clients and addr[0].startswith(clients)):
+        size = limiter.check(addr[0], buf, size)
+        if not size:
+          continue
+      if self.sample and self.queries % self.sample == 0:
+        name = '.'.join(dns_codec.read_name(buf, 12, length)[0]) + '.'
+        logging.info("Request: %s -> %s (%s)", name, self.ip, addr[0])
+      if size:
+        replies.append((memoryview(buf)[:size], addr))
+        if len(replies) >= BATCH_SIZE:
+          self._send(replies)
+          replies = []
+    if replies:
+      self._send(replies)
+
+  # answer(): Turns the query in buf into its reply, from the cache if it's
+  # there.  Returns what ResponseBuilder.build() does.  Only replies small
+  # enough for any client over UDP, and not truncated, are cached, so they
+  # do for queries over either.
+  def answer(self, buf, length, udp=True):
+    builder = self._builder
+    if builder is None or builder.ip != self.ip:
+      builder = self._builder = ResponseBuilder(self.ip)
+      self.cache.clear()
+    names = None
+    if self.hosts is not None:
+      names = self.hosts.names
+      if self.hosts.generation != self._generation:
+        self._generation = self.hosts.generation
+        self.cache.clear()
+    key = str(buf[2:length])
+    reply = self.cache.get(key)
+    if reply is not None:
+      size = len(reply) + 2
+      buf[2:size] = reply
+      return size
+    size = builder.build(buf, length, udp, names)
+    if size and size <= UDP_PAYLOAD and not buf[2] & 0x02:
+      self.cache.put(key, str(buf[2:size]))
+    return size
+
+  # Send a batch of replies, or hold on to them if earlier ones are still
+  # waiting for the socket.
+  def _send(self, replies):
+    self.batches += 1
+    if self._backlog:
+      self._hold(replies)
+      return
+    for i in range(len(replies)):
+      packet, addr = replies[i]
+      try:
+        self.sock.sendto(packet, addr)
+        self.replies += 1
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+          self._hold(replies[i:])
+          self.loop.add_writer(self.sock, self.on_writable)
+          return
+        logging.debug("Unable to answer %s: %s", addr[0], e)
+
+  # The buffers are about to be reused, so held replies are copied out.
+  def _hold(self, replies):
+    room = MAX_BACKLOG - len(self._backlog)
+    self._backlog.extend((packet.tobytes(), addr) for packet, addr in replies[:room])
+    self.dropped += max(len(replies) - room, 0)
+
+  def on_writable(self):
+    while self._backlog:
+      packet, addr = self._backlog[0]
+      try:
+        self.sock.sendto(packet, addr)
+        self.replies += 1
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+          return
+        logging.debug("Unable to answer %s: %s", addr[0], e)
+      self._backlog.popleft()
+    self.loop.remove_writer(self.sock)
+
+  def metrics(self):
+    metrics = {'queries': self.queries, 'errors': self.errors,
+               'replies': self.replies, 'batches': self.batches,
+               'backlog': len(self._backlog), 'dropped': self.dropped,
+               'cache': self.cache.metrics()}
+    if self.limiter is not None:
+      metrics['rate_limit'] = self.limiter.metrics()
+    if self.hosts is not None:
+      metrics['hosts'] = self.hosts.metrics()
+    if self.tcp is not None:
+      metrics['tcp'] = self.tcp.metrics()
+    return metrics
+
+  def close(self):
+    if self.tcp is not None:
+      self.tcp.close()
+    self.loop.remove(self.sock)
+    self.sock.close()
+
+# Most TCP connections a DNSTCPServer holds, how long one can sit idle before
+# it's closed (RFC 7766 asks for a few seconds), and how many bytes of replies
+# can pile up for a client before it's no longer read from.
+MAX_TCP_CONNECTIONS = 256
+TCP_TIMEOUT = 10
+MAX_TCP_OUTBUF = 65536
+
+# DNSTCPServer answers queries over TCP for a DNSHijacker, on the same loop,
+# address and port.  Clients ask again over TCP when a UDP reply is truncated,
+# and some do when UDP replies don't come at all; with nothing listening they
+# wait for the connection to time out, and only then give up on the portal.
+# Replies come from the hijacker's answer(), so they share its cache.
+class DNSTCPServer:
+  def __init__(self, hijacker, address, port, reuseport=False, timeout=TCP_TIMEOUT,
+               max_connections=MAX_TCP_CONNECTIONS, clock=time.time):
+    self.hijacker = hijacker
+    self.loop = hijacker.loop
+    self.timeout = timeout
+    self.max_connections = max_connections
+    self.clock = clock
+    self.connections = set()
+    self.accepted = 0
+    self.queries = 0
+    self.errors = 0
+    self.timeouts = 0
+
+    # Queries are copied in here to be answered, one at a time.
+    self.buf = bytearray(RECV_SIZE + ROOM)
+
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+      self.listener.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    self.listener.bind((address, port))
+    self.listener.listen(64)
+    self.listener.setblocking(0)
+    self.loop.add_reader(self.listener, self.on_accept)
+    self._sweeper = self.loop.call_every(1.0, self.close_idle)
+
+  def on_accept(self):
+    while True:
+      try:
+        sock, address = self.listener.accept()
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+          return
+        if e.args[0] in (errno.EMFILE, errno.ENFILE):
+          logging.error("Out of file descriptors, not accepting DNS connections.")
+          return
+        raise
+      if len(self.connections) >= self.max_connections:
+        sock.close()
+        continue
+      sock.setblocking(0)
+      self.accepted += 1
+      self.connections.add(DNSTCPConnection(self, sock))
+
+  def forget(self, connection):
+    self.connections.discard(connection)
+
+  # close_idle(): Closes every connection that has been quiet for longer than
+  # the timeout.
+  def close_idle(self):
+    cutoff = self.clock() - self.timeout
+    for connection in [c for c in self.connections if c.last_active < cutoff]:
+      self.timeouts += 1
+      connection.close()
+
+  def metrics(self):
+    return {'connections': len(self.connections), 'accepted': self.accepted,
+            'queries': self.queries, 'errors': self.errors, 'timeouts': self.timeouts}
+
+  def close(self):
+    self._sweeper.cancel()
+    for connection in list(self.connections):
+      connection.close()
+    self.loop.remove(self.listener)
+    self.listener.close()
+
+# DNSTCPConnection reads queries from one client, each one preceded by its
+# length in two bytes, and writes the replies back the same way, in order.
+# Clients can send several queries without waiting for the replies; they're
+# answered as soon as they've arrived.  A query that's too long or malformed
+# closes the connection.
+class DNSTCPConnection:
+  def __init__(self, server, sock):
+    self.server = server
+    self.loop = server.loop
+    self.sock = sock
+    self.inbuf = ''
+    self.outbuf = ''
+    self.paused = False
+    self.last_active = server.clock()
+    self.loop.add_reader(sock, self.on_readable)
+
+  def on_readable(self):
+    self.last_active = self.server.clock()
+    while True:
+      try:
+        data = self.sock.recv(4096)
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          break
+        self.close()
+        return
+      if not data:
+        self.close()
+        return
+      self.inbuf += data
+    self._process()
+
+  # _process(): Answers every complete query in the input buffer.
+  def _process(self):
+    server = self.server
+    if not server.hijacker.ip:
+      self.close()
+      return
+    buf = server.buf
+    inbuf = self.inbuf
+    offset = 0
+    replies = []
+    while len(inbuf) - offset >= 2:
+      length = (ord(inbuf[offset]) << 8) | ord(inbuf[offset + 1])
+      if length > MAX_QUERY:
+        server.errors += 1
+        self.close()
+        return
+      if len(inbuf) - offset - 2 < length:
+        break
+      buf[:length] = inbuf[offset + 2:offset + 2 + length]
+      offset += 2 + length
+      server.queries += 1
+      size = server.hijacker.answer(buf, length, udp=False)
+      if size is None:
+        server.errors += 1
+        self.close()
+        return
+      if size:
+        replies.append(struct.pack('!H', size) + str(buf[:size]))
+    self.inbuf = inbuf[offset:]
+    if replies:
+      self.outbuf += ''.join(replies)
+      self.on_writable()
+
+  def on_writable(self):
+    while self.outbuf:
+      try:
+        sent = self.sock.send(self.outbuf)
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          break
+        self.close()
+        return
+      self.outbuf = self.outbuf[sent:]
+      self.last_active = self.server.clock()
+    if self.outbuf:
+      self.loop.add_writer(self.sock, self.on_writable)
+
+      # Stop reading from a client that doesn't read its replies.
+      if len(self.outbuf) > MAX_TCP_OUTBUF and not self.paused:
+        self.paused = True
+        self.loop.remove_reader(self.sock)
+      return
+    self.loop.remove_writer(self.sock)
+    if self.paused:
+      self.paused = False
+      self.loop.add_reader(self.sock, self.on_readable)
+
+  def close(self):
+    if self.sock is None:
+      return
+    self.loop.remove(self.sock)
+    try:
+      self.sock.close()
+    except socket.error:
+      pass
+    self.sock = None
+    self.server.forget(self)
 
 # get_ip_address code from http://code.activestate.com/recipes/439094-get-the-ip-address-associated-with-a-network-inter/
 # Method that acquires the IP address of a network interface on the system
@@ -75,77 +854,212 @@ def get_ip_address(ifname):
   except:
     return None
 
-# Display usage information to the user.
-def usage():
-  print "Usage:"
-  print "\t# minidns [ip | interface]\n"
-  print "Description:"
-  print "\tMiniDNS will respond to all DNS queries with a single IPv4 address."
-  print "\tYou may specify the IP address to be returned as the first argument"
-  print "\ton the command line:\n"
-  print "\t\t# minidns 1.2.3.4\n"
-  print "\tAlternatively, you may specify an interface name and MiniDNS will"
-  print "\tuse the IP address currently assigned to that interface:\n"
-  print "\t\t# minidns eth0\n"
-  print "\tIf no interface or IP address is specified, the IP address of eth0"
-  print "\twill be used."
-  sys.exit(1)
+# parse_listen(): Turns [address][:port] into an (address, port) pair.
+def parse_listen(text):
+  address, _, port = text.partition(':')
+  return (address, int(port or 31339))
+
+# Exit code of a worker that couldn't open its sockets.  The supervisor gives
+# up instead of restarting it.
+EXIT_NO_SOCKET = 3
+
+# Supervisor forks workers processes, each running target(), and forks a new
+# one whenever one dies.  A worker that dies less than delay seconds after it
+# was started is only replaced once that much time has passed, so one that
+# crashes on startup doesn't spin.
+class Supervisor:
+  def __init__(self, workers, target, delay=1.0):
+    self.workers = workers
+    self.target = target
+    self.delay = delay
+    self.restarts = 0
+    self.running = False
+    self.failed = False
+
+    # pid: time the worker was started.
+    self.children = {}
+
+  def _spawn(self):
+    pid = os.fork()
+    if pid == 0:
+      status = 1
+      try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        status = self.target() or 0
+      except SystemExit, e:
+        status = e.code
+      except:
+        traceback.print_exc()
+      finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+    self.children[pid] = time.time()
+    return pid
+
+  def start(self):
+    self.running = True
+    while len(self.children) < self.workers:
+      self._spawn()
+
+  # reap(): Waits for a worker to die and replaces it.  Returns False once
+  # there is nothing left to supervise.
+  def reap(self):
+    try:
+      pid, status = os.wait()
+    except OSError, e:
+      if e.errno == errno.EINTR:
+        return True
+      if e.errno == errno.ECHILD:
+        return False
+      raise
+    started = self.children.pop(pid, None)
+    if started is None or not self.running:
+      return bool(self.children)
+    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == EXIT_NO_SOCKET:
+      logging.error("Worker %d couldn't open its sockets, stopping.", pid)
+      self.failed = True
+      self.stop()
+      return bool(self.children)
+    logging.warning("Worker %d died (status %d), starting another.", pid, status)
+    wait = started + self.delay - time.time()
+    if wait > 0:
+      time.sleep(wait)
+    if self.running:
+      self._spawn()
+      self.restarts += 1
+    return True
+
+  def run(self):
+    self.start()
+    while self.reap():
+      pass
+
+  # stop(): Tells every worker to finish.  Safe to call from a signal handler.
+  def stop(self):
+    self.running = False
+    for pid in self.children.keys():
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except OSError:
+        pass
+
+# serve(): Answers queries with ip on every listen address until SIGTERM or
+# SIGINT.  This is what each worker runs.  limits are the arguments of the
+# RateLimiter they share, or None for no limits, and names in hosts_file, if
+# it's given, are answered with their own addresses.  limit_clients is passed
+# on to DNSHijacker.
+def serve(ip, listen, sample=0, reuseport=False, limits=None, hosts_file=None, limit_clients=False):
+  loop = EventLoop()
+  limiter = RateLimiter(**limits) if limits is not None else None
+  hosts = None
+  if hosts_file:
+    hosts = MeshHosts(hosts_file)
+    hosts.start(loop)
+  hijackers = []
+  for address, port in listen:
+    try:
+      hijackers.append(DNSHijacker(loop, ip, port, address, sample, reuseport, limiter=limiter,
+                                   hosts=hosts, limit_clients=limit_clients))
+    except socket.error, e:
+      print "Failed to create socket on %s:%d/udp:" % (address or '*', port), e
+      return EXIT_NO_SOCKET
+
+  def shutdown(signum, frame):
+    loop.stop()
+  signal.signal(signal.SIGTERM, shutdown)
+  signal.signal(signal.SIGINT, shutdown)
+
+  # The do-stuff loop.
+  loop.run()
+  for hijacker in hijackers:
+    hijacker.close()
+  if hosts is not None:
+    hosts.stop()
+  loop.close()
+  if limiter is not None and (limiter.limited or limiter.dropped or limiter.slipped):
+    print "Rate limited: %d queries, %d replies dropped, %d slipped" % (limiter.limited, limiter.dropped,
+                                                                        limiter.slipped)
+  return 0
 
 # Core code.
 if __name__ == '__main__':
-  # Set defaults for basic operation.  Hopefully these will be overridden on
-  # the command line.
-  ip = None
-  iface = 'eth0'
-
-  # Parse the argument vector.
-  if len(sys.argv) == 2:
-    if sys.argv[-1] == '-h' or sys.argv[-1] == '--help':
-      usage()
-    else:
-      if len(sys.argv[-1].split('.')) == 4:
-        ip=sys.argv[-1]
-      else:
-        iface = sys.argv[-1]
+  parser = argparse.ArgumentParser(description="MiniDNS will respond to all DNS queries with a single IPv4 "
+                                   "address: the one given on the command line, or the one currently assigned "
+                                   "to the interface given instead.  If neither is given, the IP address of eth0 "
+                                   "will be used.")
+  parser.add_argument("target", nargs="?", default="eth0", metavar="ip | interface")
+  parser.add_argument("-l", "--listen", action="append", type=parse_listen, metavar="[ADDRESS][:PORT]",
+                      help="Address and port to answer queries on, over UDP and TCP.  Can be given more than once.  "
+                      "(Defaults to every address, port 31339.)")
+  parser.add_argument("-d", "--debug", action="store", type=int, default=0, metavar="N",
+                      help="Print one query in every N.")
+  parser.add_argument("-w", "--workers", action="store", type=int, default=0, metavar="N",
+                      help="Answer from N worker processes sharing each socket (SO_REUSEPORT), "
+                      "restarting any that die.  (Defaults to answering from this process.)")
+  parser.add_argument("--rate", action="store", type=float, default=QUERY_RATE, metavar="N",
+                      help="Queries a second each client can send over UDP, 0 for no limit.  "
+                      "(Defaults to %(default)s.)")
+  parser.add_argument("--burst", action="store", type=int, default=QUERY_BURST, metavar="N",
+                      help="Queries each client can send at once.  (Defaults to %(default)s.)")
+  parser.add_argument("--response-rate", action="store", type=float, default=RESPONSE_RATE, metavar="N",
+                      help="Identical replies a second sent to one /24 over UDP, 0 for no limit.  Replies "
+                      "to the client network of the address being served aren't limited unless "
+                      "--limit-clients is given.  (Defaults to %(default)s.)")
+  parser.add_argument("--limit-clients", action="store_true", default=False,
+                      help="Apply --response-rate to the client network too.")
+  parser.add_argument("--slip", action="store", type=int, default=SLIP, metavar="N",
+                      help="Send one in N replies over the limit truncated, so the client asks again over "
+                      "TCP, and drop the rest; 0 to drop them all.  (Defaults to %(default)s.)")
+  parser.add_argument("--hosts", action="store", default=HOSTS_FILE, metavar="FILE",
+                      help="Hosts file whose names are answered with their own addresses, reloaded when it "
+                      "changes; '' for none.  (Defaults to %(default)s.)")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO if args.debug else logging.WARNING,
+                      format="%(message)s")
 
   # In the event that an interface name was given but not an IP address, get
   # the IP address.
-  if ip is None:
-    ip = get_ip_address(iface)
+  if len(args.target.split('.')) == 4:
+    ip = args.target
+  else:
+    ip = get_ip_address(args.target)
 
   # If the IP address can't be gotten somehow, carp.
   if ip is None:
     print "ERROR: Invalid IP address or interface name specified!"
-    usage()
-
-  # Open a socket to listen on.  Haxwithaxe set this to port 31339/udp because
-  # this is the DNS hijacker bit of the captive portal.  Only clients that
-  # aren't in the whitelist will see it.
-  try:
-    udps = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udps.bind(('',31339))
-  except Exception, e:
-    print "Failed to create socket on UDP port 31339:", e
+    parser.print_help()
     sys.exit(1)
 
   # Print something for anyone watching a TTY.  All 'A' records this daemon
   # serves up have a TTL of 15 seconds.
   print 'miniDNS :: * 15 IN A %s\n' % ip
+  sys.stdout.flush()
 
-  # The do-stuff loop.
-  try:
-    while 1:
-      # Receive a DNS resolution request from a client.
-      data, addr = udps.recvfrom(1024)
-
-      # Generate the response.
-      p=DNSQuery(data)
-
-      # Send the response to the client.
-      udps.sendto(p.respuesta(ip), addr)
-      print 'Request: %s -> %s' % (p.domain, ip)
-  except KeyboardInterrupt:
-    print '\nBye!'
-    udps.close()
+  # Open the sockets to listen on.  Haxwithaxe set this to port 31339/udp
+  # because this is the DNS hijacker bit of the captive portal.  Only clients
+  # that aren't in the whitelist will see it.
+  listen = args.listen or [('', 31339)]
+  limits = None
+  if args.rate or args.response_rate:
+    limits = {'rate': args.rate, 'burst': args.burst, 'responses': args.response_rate, 'slip': args.slip}
+  if args.workers:
+    supervisor = Supervisor(args.workers, lambda: serve(ip, listen, args.debug, True, limits, args.hosts,
+                                                            args.limit_clients))
+    def shutdown(signum, frame):
+      supervisor.stop()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    supervisor.run()
+    status = supervisor.failed
+    if supervisor.restarts:
+      print "Workers restarted: %d" % supervisor.restarts
+  else:
+    status = serve(ip, listen, args.debug, limits=limits, hosts_file=args.hosts,
+                   limit_clients=args.limit_clients)
+  if status:
+    sys.exit(1)
+  print '\nBye!'
 
 # Fin.
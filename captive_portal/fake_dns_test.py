@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# fake_dns_test.py
+
+from flexmock import flexmock  # http://has207.github.com/flexmock
+import errno
+import os
+import signal
+import socket
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+import event_loop
+import fake_dns
+
+
+# query(): A standard query for name.
+def query(name, txid=0x1234, qtype=1):
+    labels = ''.join(chr(len(label)) + label for label in name.split('.'))
+    return struct.pack('!HHHHHH', txid, 0x0100, 1, 0, 0, 0) + labels + '\x00' + struct.pack('!HH', qtype, 1)
+
+
+# Wraps a socket whose sendto() fails with EAGAIN while full is set.
+class FullSocket(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.full = True
+
+    def sendto(self, packet, address):
+        if self.full:
+            raise socket.error(errno.EAGAIN, 'Resource temporarily unavailable')
+        return self.sock.sendto(packet, address)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class ResponseBuilderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.builder = fake_dns.ResponseBuilder('10.0.0.1')
+
+    def build(self, data, hosts=None):
+        buf = bytearray(len(data) + fake_dns.ROOM)
+        buf[:len(data)] = data
+        size = self.builder.build(buf, len(data), hosts=hosts)
+        if size:
+            return str(buf[:size])
+        return size
+
+    # header(): flags, rcode and the four counts of a reply.
+    def header(self, reply):
+        fields = struct.unpack('!HHHHHH', reply[:12])
+        return (fields[1] & 0xfff0, fields[1] & 0xf) + fields[2:]
+
+    def test_a_is_answered(self):
+        for data in (query('example.com'), query('connectivitycheck.gstatic.com', txid=7),
+                     query('a.b.c.d.e', qtype=255)):
+            answer = '\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x0f\x00\x04\x0a\x00\x00\x01'
+            self.assertEqual(data[:2] + '\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00' + data[12:] + answer,
+                             self.build(data))
+
+    def test_other_types_get_nodata(self):
+        for qtype in (28, 65, 12, 16):
+            reply = self.build(query('example.com', qtype=qtype))
+            self.assertEqual((0x8180, 0, 1, 0, 1, 0), self.header(reply))
+            self.assertEqual((6, 1, 15), struct.unpack('!HHI', reply[31:39]))
+
+        # A for the root has nothing to answer with either.
+        root = query('example.com')[:12] + '\x00\x00\x01\x00\x01'
+        self.assertEqual((0x8180, 0, 1, 0, 1, 0), self.header(self.build(root)))
+
+    def test_recursion_desired_is_copied(self):
+        data = query('example.com')
+        self.assertEqual(0x8080, self.header(self.build(data[:2] + '\x00' + data[3:]))[0])
+
+    def test_edns_gets_an_opt_record(self):
+        opt = '\x00' + struct.pack('!HHIH', 41, 4096, 0, 0)
+        data = query('example.com')
+        reply = self.build(data[:11] + '\x01' + data[12:] + opt)
+        self.assertEqual((0x8180, 0, 1, 1, 0, 1), self.header(reply))
+        self.assertEqual('10.0.0.1', socket.inet_ntoa(reply[-15:-11]))
+        self.assertEqual((41, fake_dns.EDNS_PAYLOAD), struct.unpack('!HH', reply[-10:-6]))
+
+    def test_other_classes_and_opcodes(self):
+        chaos = query('version.bind', qtype=16)[:-2] + '\x00\x03'
+        self.assertEqual((0x8180, 5, 1, 0, 0, 0), self.header(self.build(chaos)))
+        inverse = query('example.com')
+        inverse = inverse[:2] + chr(0x09) + inverse[3:]
+        self.assertEqual((0x8980, 4, 0, 0, 0, 0), self.header(self.build(inverse)))
+
+    def test_malformed_queries_are_dropped(self):
+        data = query('example.com')
+        for bad in (data[:12],  # No question.
+                    data[:18],  # Cut short in the name.
+                    data[:-1],  # Cut short in the class.
+                    data[:2] + chr(0x81) + data[3:],  # A response.
+                    data[:5] + '\x02' + data[6:],  # Two questions.
+                    data[:7] + '\x01' + data[8:],  # An answer.
+                    data[:11] + '\x01' + data[12:],  # An OPT record that isn't there.
+                    data[:12] + '\xc0\x0c' + data[-4:],  # A compression pointer.
+                    data + '\x00' * fake_dns.MAX_QUERY):  # Too big.
+            self.assertEqual(None, self.build(bad), repr(bad))
+
+
+    def test_mesh_names_are_answered_authoritatively(self):
+        hosts = fake_dns.parse_hosts(['10.1.2.1\tbyzantium.byzantium.mesh\n'])
+        reply = self.build(query('Byzantium.BYZANTIUM.mesh'), hosts)
+        self.assertEqual((0x8580, 0, 1, 1, 0, 0), self.header(reply))
+        self.assertEqual('\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x3c\x00\x04\x0a\x01\x02\x01', reply[-16:])
+        self.assertEqual((0x8580, 0, 1, 0, 1, 0), self.header(self.build(query('byzantium.byzantium.mesh',
+                                                                               qtype=28), hosts)))
+
+        # Everything else still gets the portal.
+        reply = self.build(query('example.com'), hosts)
+        self.assertEqual((0x8180, 0, 1, 1, 0, 0), self.header(reply))
+        self.assertEqual('10.0.0.1', socket.inet_ntoa(reply[-4:]))
+
+
+class ParseHostsTest(unittest.TestCase):
+
+    def test_hosts_file(self):
+        hosts = fake_dns.parse_hosts(['# Comment\n',
+                                      '10.1.2.1 node.mesh Alias.mesh # trailing\n',
+                                      '10.1.2.9 node.mesh\n',
+                                      'fe80::1 six.mesh\n',
+                                      '300.1.2.3 bad.mesh\n',
+                                      '10.1.2.3\n',
+                                      '\n'])
+        self.assertEqual(['\x04node\x04mesh\x00', '\x05alias\x04mesh\x00'], sorted(hosts))
+        self.assertEqual('\x0a\x01\x02\x01', hosts['\x04node\x04mesh\x00'][-4:])
+
+
+class MeshHostsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'hosts.mesh')
+        self.hosts = fake_dns.MeshHosts(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text):
+        with open(self.path + '.new', 'w') as hosts:
+            hosts.write(text)
+        os.rename(self.path + '.new', self.path)
+
+    def test_reloaded_when_changed(self):
+        self.assertFalse(self.hosts.check())
+        self.write('10.1.2.1\tbyzantium.byzantium.mesh\n')
+        self.assertTrue(self.hosts.check())
+        self.assertEqual(1, len(self.hosts.names))
+        self.assertFalse(self.hosts.check())
+        self.write('10.1.2.1\tbyzantium.byzantium.mesh\n10.1.2.2\tclient-10.1.2.2.byzantium.mesh\n')
+        self.assertTrue(self.hosts.check())
+        self.assertEqual((2, 2), (len(self.hosts.names), self.hosts.generation))
+        os.remove(self.path)
+        self.assertTrue(self.hosts.check())
+        self.assertEqual({}, self.hosts.names)
+
+    def test_refresh_loads_on_a_thread(self):
+        self.write('10.1.2.1\tbyzantium.byzantium.mesh\n')
+        self.hosts.refresh()
+        deadline = time.time() + 5
+        while not self.hosts.generation and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(1, len(self.hosts.names))
+
+
+class ReplyCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_are_dropped(self):
+        cache = fake_dns.ReplyCache(4)
+        for key in 'abcd':
+            cache.put(key, key.upper())
+        self.assertEqual('A', cache.get('a'))
+        cache.put('e', 'E')
+        self.assertEqual(4, len(cache))
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(['A', 'C', 'D', 'E'], [cache.get(key) for key in 'acde'])
+
+    def test_metrics(self):
+        cache = fake_dns.ReplyCache(4)
+        self.assertEqual(None, cache.metrics()['hit_ratio'])
+        cache.get('a')
+        cache.put('a', 'A')
+        cache.get('a')
+        cache.get('a')
+        self.assertEqual({'size': 1, 'capacity': 4, 'hits': 2, 'misses': 1, 'hit_ratio': 0.667},
+                         cache.metrics())
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.limiter = fake_dns.RateLimiter(rate=2, burst=3, responses=2, slip=2,
+                                            clock=lambda: self.now)
+
+    # reply(): A reply to a query for name, in a buffer, and its size.
+    def reply(self, name):
+        data = query(name)
+        buf = bytearray(data + '\x00' * fake_dns.ROOM)
+        return buf, fake_dns.ResponseBuilder('10.0.0.1').build(buf, len(data))
+
+    def test_queries_over_the_rate_are_dropped(self):
+        self.assertEqual([True, True, True, False], [self.limiter.allow('10.1.2.3') for i in range(4)])
+        self.assertTrue(self.limiter.allow('10.1.2.4'))
+        self.now += 0.5
+        self.assertEqual([True, False], [self.limiter.allow('10.1.2.3') for i in range(2)])
+        self.assertEqual(2, self.limiter.metrics()['limited_queries'])
+
+    def test_identical_replies_are_slipped_or_dropped(self):
+        buf, size = self.reply('example.com')
+        sizes = [self.limiter.check('10.1.2.3', buf, size) for i in range(3)]
+        self.assertEqual([size, size, 0], sizes)
+
+        # Every second one over the limit is sent with no records and TC set.
+        truncated = self.limiter.check('10.1.2.4', buf, size)
+        self.assertEqual(29, truncated)
+        self.assertEqual((0x8380, 1, 0, 0, 0), struct.unpack('!HHHHH', str(buf[2:12])))
+
+        # Another name, or another /24, has a bucket of its own.
+        other, other_size = self.reply('example.org')
+        self.assertEqual(other_size, self.limiter.check('10.1.2.3', other, other_size))
+        buf, size = self.reply('example.com')
+        self.assertEqual(size, self.limiter.check('10.1.3.3', buf, size))
+        self.assertEqual((1, 1), (self.limiter.metrics()['dropped_replies'],
+                                  self.limiter.metrics()['slipped_replies']))
+
+    def test_the_node_itself_is_exempt(self):
+        buf, size = self.reply('example.com')
+        for i in range(10):
+            self.assertTrue(self.limiter.allow('127.0.0.1'))
+            self.assertEqual(size, self.limiter.check('127.0.0.1', buf, size))
+
+    def test_tables_are_bounded(self):
+        self.limiter.size = 8
+        for i in range(8):
+            self.limiter.allow('10.0.0.%d' % i)
+
+        # Buckets that have refilled go first, then the least recently used.
+        self.now += 10
+        self.limiter.allow('10.0.0.0')
+        for i in range(8, 20):
+            self.limiter.allow('10.0.0.%d' % i)
+        self.assertTrue(len(self.limiter._sources) <= 8)
+        self.assertTrue(self.limiter.metrics()['evicted'] > 0)
+
+
+class DNSHijackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = event_loop.EventLoop()
+        self.hijacker = fake_dns.DNSHijacker(self.loop, '10.0.0.1', 0, '127.0.0.1')
+        self.address = self.hijacker.sock.getsockname()
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(2)
+
+    def tearDown(self):
+        self.client.close()
+        self.hijacker.close()
+        self.loop.close()
+
+    def test_burst_is_answered_in_one_wakeup(self):
+        for i in range(5):
+            self.client.sendto(query('example.com', txid=i), self.address)
+        self.loop.run_once(1.0)
+        replies = [self.client.recvfrom(512)[0] for i in range(5)]
+        self.assertEqual(range(5), [struct.unpack('!H', reply[:2])[0] for reply in replies])
+        self.assertEqual('10.0.0.1', socket.inet_ntoa(replies[0][-4:]))
+        self.assertEqual(1, self.hijacker.metrics()['batches'])
+
+        # Only the first one had to be built.
+        cache = self.hijacker.metrics()['cache']
+        self.assertEqual((1, 4, 1), (cache['size'], cache['hits'], cache['misses']))
+
+    def test_cached_replies_are_forgotten_when_the_address_changes(self):
+        self.client.sendto(query('example.com'), self.address)
+        self.loop.run_once(1.0)
+        self.client.recvfrom(512)
+        self.hijacker.ip = '10.0.0.2'
+        self.client.sendto(query('example.com', txid=9), self.address)
+        self.loop.run_once(1.0)
+        reply = self.client.recvfrom(512)[0]
+        self.assertEqual(9, struct.unpack('!H', reply[:2])[0])
+        self.assertEqual('10.0.0.2', socket.inet_ntoa(reply[-4:]))
+
+    def test_truncated_query_is_counted_not_answered(self):
+        self.client.sendto(query('example.com')[:15], self.address)
+        self.loop.run_once(1.0)
+        self.assertEqual(1, self.hijacker.errors)
+        self.assertEqual(0, self.hijacker.replies)
+
+    def test_replies_are_held_while_socket_is_full(self):
+        self.hijacker.sock = FullSocket(self.hijacker.sock)
+        self.client.sendto(query('example.com'), self.address)
+        self.client.sendto(query('example.org'), self.address)
+        self.loop.run_once(1.0)
+        self.assertEqual(2, self.hijacker.metrics()['backlog'])
+        self.hijacker.sock.full = False
+        self.loop.run_once(1.0)
+        self.assertEqual((0, 2), (self.hijacker.metrics()['backlog'], self.hijacker.replies))
+
+    def test_cached_replies_are_forgotten_when_hosts_change(self):
+        hosts = self.hijacker.hosts = fake_dns.MeshHosts('/nonexistent')
+        self.client.sendto(query('node.mesh'), self.address)
+        self.loop.run_once(1.0)
+        self.assertEqual('10.0.0.1', socket.inet_ntoa(self.client.recvfrom(512)[0][-4:]))
+        hosts.names = fake_dns.parse_hosts(['10.1.2.1 node.mesh'])
+        hosts.generation += 1
+        self.client.sendto(query('node.mesh'), self.address)
+        self.loop.run_once(1.0)
+        self.assertEqual('10.1.2.1', socket.inet_ntoa(self.client.recvfrom(512)[0][-4:]))
+        self.assertEqual(1, self.hijacker.metrics()['hosts']['names'])
+
+    def test_flood_is_rate_limited(self):
+        self.hijacker.limiter = fake_dns.RateLimiter(rate=1, burst=5, responses=1000, exempt=())
+        for i in range(8):
+            self.client.sendto(query('example.com', txid=i), self.address)
+        self.loop.run_once(1.0)
+        self.assertEqual(5, self.hijacker.replies)
+        self.assertEqual(3, self.hijacker.metrics()['rate_limit']['limited_queries'])
+
+    def test_client_network_is_not_response_rate_limited(self):
+        self.hijacker.limiter = fake_dns.RateLimiter(rate=1000, burst=1000, responses=1, slip=0, exempt=())
+        self.hijacker.ip = '127.0.0.1'
+        for i in range(4):
+            self.client.sendto(query('example.com', txid=i), self.address)
+        self.loop.run_once(1.0)
+        self.assertEqual(4, self.hijacker.replies)
+        self.hijacker.limit_clients = True
+        for i in range(4):
+            self.client.sendto(query('example.com', txid=i), self.address)
+        self.loop.run_once(1.0)
+        self.assertEqual(5, self.hijacker.replies)
+
+    def test_one_in_sample_queries_is_logged(self):
+        self.hijacker.sample = 2
+        logger = flexmock(fake_dns.logging)
+        logger.should_receive('info').once()
+        for name in ('a.example.com', 'b.example.com', 'c.example.com'):
+            self.client.sendto(query(name), self.address)
+        self.loop.run_once(1.0)
+
+    def test_reuseport_shares_the_port(self):
+        port = self.address[1]
+        self.hijacker.close()
+        first = fake_dns.DNSHijacker(self.loop, '10.0.0.1', port, '127.0.0.1', reuseport=True)
+        second = fake_dns.DNSHijacker(self.loop, '10.0.0.2', port, '127.0.0.1', reuseport=True)
+        self.hijacker = first
+        second.close()
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = fake_dns.Supervisor(2, lambda: time.sleep(30), delay=0)
+
+    def tearDown(self):
+        self.supervisor.stop()
+        while self.supervisor.reap():
+            pass
+
+    def test_dead_worker_is_replaced(self):
+        self.supervisor.start()
+        dead = self.supervisor.children.keys()[0]
+        os.kill(dead, signal.SIGKILL)
+        self.assertTrue(self.supervisor.reap())
+        self.assertEqual(2, len(self.supervisor.children))
+        self.assertFalse(dead in self.supervisor.children)
+        self.assertEqual(1, self.supervisor.restarts)
+
+    def test_gives_up_when_a_worker_cannot_listen(self):
+        self.supervisor.target = lambda: fake_dns.EXIT_NO_SOCKET
+        self.supervisor.start()
+        self.supervisor.reap()
+        self.assertTrue(self.supervisor.failed)
+        self.assertFalse(self.supervisor.running)
+        self.assertEqual(0, self.supervisor.restarts)
+
+
+class DNSTCPServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = event_loop.EventLoop()
+        self.hijacker = fake_dns.DNSHijacker(self.loop, '10.0.0.1', 0, '127.0.0.1')
+        self.address = self.hijacker.sock.getsockname()
+        self.client = socket.create_connection(self.address, 2)
+
+    def tearDown(self):
+        self.client.close()
+        self.hijacker.close()
+        self.loop.close()
+
+    def pump(self):
+        for i in range(3):
+            self.loop.run_once(0.05)
+
+    def read_reply(self):
+        length = struct.unpack('!H', self.client.recv(2, socket.MSG_WAITALL))[0]
+        return self.client.recv(length, socket.MSG_WAITALL)
+
+    def test_pipelined_queries_are_answered_in_order(self):
+        queries = [query('example.com', txid=i, qtype=qtype) for i, qtype in enumerate((1, 28, 1))]
+        self.client.sendall(''.join(struct.pack('!H', len(data)) + data for data in queries))
+        self.pump()
+        replies = [self.read_reply() for data in queries]
+        self.assertEqual([0, 1, 2], [struct.unpack('!H', reply[:2])[0] for reply in replies])
+        self.assertEqual('10.0.0.1', socket.inet_ntoa(replies[2][-4:]))
+        self.assertEqual(3, self.hijacker.metrics()['tcp']['queries'])
+
+    def test_query_split_across_reads(self):
+        data = query('example.com')
+        framed = struct.pack('!H', len(data)) + data
+        self.client.sendall(framed[:7])
+        self.pump()
+        self.client.sendall(framed[7:])
+        self.pump()
+        self.assertEqual(data[:2], self.read_reply()[:2])
+
+    def test_too_long_closes_the_connection(self):
+        self.client.sendall(struct.pack('!H', fake_dns.MAX_QUERY + 1))
+        self.pump()
+        self.assertEqual('', self.client.recv(2))
+        self.assertEqual(0, len(self.hijacker.tcp.connections))
+
+    def test_idle_connections_are_closed(self):
+        self.pump()
+        self.assertEqual(1, len(self.hijacker.tcp.connections))
+        self.hijacker.tcp.clock = lambda: time.time() + fake_dns.TCP_TIMEOUT + 1
+        self.hijacker.tcp.close_idle()
+        self.assertEqual('', self.client.recv(2))
+        self.assertEqual(1, self.hijacker.metrics()['tcp']['timeouts'])
+
+    # A reply too big for UDP is truncated, and the client gets the whole of
+    # it over TCP straight away instead of waiting for a timeout.
+    def test_fallback_to_tcp_after_truncation(self):
+        payload = fake_dns.UDP_PAYLOAD
+        fake_dns.UDP_PAYLOAD = 40
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.settimeout(2)
+        try:
+            started = time.time()
+            udp.sendto(query('example.com'), self.address)
+            self.loop.run_once(1.0)
+            truncated = udp.recv(512)
+            data = query('example.com')
+            self.client.sendall(struct.pack('!H', len(data)) + data)
+            self.pump()
+            reply = self.read_reply()
+            elapsed = time.time() - started
+        finally:
+            fake_dns.UDP_PAYLOAD = payload
+            udp.close()
+        self.assertTrue(ord(truncated[2]) & 0x02)
+        self.assertEqual(0, struct.unpack('!H', truncated[6:8])[0])
+        self.assertFalse(ord(reply[2]) & 0x02)
+        self.assertEqual('10.0.0.1', socket.inet_ntoa(reply[-4:]))
+        self.assertTrue(elapsed < 0.5, "Falling back to TCP took %.3f seconds." % elapsed)
+
+
+class ParseListenTest(unittest.TestCase):
+
+    def test_address_and_port(self):
+        self.assertEqual(('10.0.0.1', 53), fake_dns.parse_listen('10.0.0.1:53'))
+        self.assertEqual(('', 5353), fake_dns.parse_listen(':5353'))
+        self.assertEqual(('10.0.0.1', 31339), fake_dns.parse_listen('10.0.0.1'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# idle_reaper.py
+# The idle client reaper from mop_up_dead_clients.py, as something that runs
+# inside the captive portal daemon (--in-process) instead of in its own Python
+# interpreter.  Every check it asks the whitelist backend for the packet
+# counters of every whitelisted client, and takes clients whose counters
+# haven't moved for max_idle seconds out of the whitelist through the same
+# WhitelistManager the web server uses, so its index and the on-disk copy of
+# the whitelist stay right.
+#
+# Reading the counters and taking clients out both run commands and wait for
+# them, so on the daemon's event loop each check runs on a thread of its own,
+# leaving the loop free to answer DNS queries and web requests meanwhile.
+
+# Modules.
+import logging
+import threading
+import time
+
+
+class IdleReaper(object):
+
+    def __init__(self, manager, max_idle=600, clock=time.time):
+        self.manager = manager
+        self.max_idle = max_idle
+        self._clock = clock
+        self._timer = None
+        self._checking = threading.Lock()
+
+        # MAC address: [packets, time the count last changed]
+        self._clients = {}
+
+        # Counters for metrics().
+        self.checks = 0
+        self.reaped = 0
+
+    # check(): Reads the packet counters and reaps idle clients.  Returns the
+    # number of clients reaped.
+    def check(self):
+        counts = self.manager.backend.packet_counts()
+        now = self._clock()
+        reaped = 0
+        for mac, packets in counts.items():
+            seen = self._clients.get(mac)
+            if seen is None or seen[0] != packets:
+                self._clients[mac] = [packets, now]
+            elif now - seen[1] > self.max_idle:
+                logging.debug("Client %s has been idle for %d seconds, reaping it.",
+                              mac, now - seen[1])
+                # Clients the manager doesn't know about were whitelisted by
+                # hand with captive-portal.sh.
+                if not self.manager.remove(mac):
+                    self.manager.backend.remove(mac)
+                del self._clients[mac]
+                reaped += 1
+
+        # Forget about clients that were taken out of the whitelist some other
+        # way.
+        for mac in set(self._clients) - set(counts):
+            del self._clients[mac]
+
+        self.checks += 1
+        self.reaped += reaped
+        return reaped
+
+    # check_on_thread(): check() on a thread, unless one is still at it.
+    def check_on_thread(self):
+        if not self._checking.acquire(False):
+            return
+        def run():
+            try:
+                self.check()
+            except Exception:
+                logging.exception("Idle client check failed.")
+            finally:
+                self._checking.release()
+        thread = threading.Thread(target=run, name='idle-reaper')
+        thread.daemon = True
+        thread.start()
+
+    def start(self, loop, interval=60):
+        self._timer = loop.call_every(interval, self.check_on_thread)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def metrics(self):
+        return {'clients': len(self._clients),
+                'checks': self.checks,
+                'reaped': self.reaped}
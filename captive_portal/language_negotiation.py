@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# language_negotiation.py
+# Picks which index.html.<language> page to hand a client based on its
+# Accept-Language header.  q-values are honoured and regional variants fall
+# back to their base language (es-mx -> es -> es-es), so a multilingual crowd
+# gets the closest page we have instead of the default one.  The set of
+# languages on disk is indexed once; answers for raw header strings are kept in
+# a small LRU so repeat visitors (every phone of the same make, basically) cost
+# a single dictionary lookup.
+
+# Modules.
+from collections import OrderedDict
+
+import threading
+
+
+# parse_accept_language(): Takes the raw value of an Accept-Language header
+# and returns a list of lowercase language tags, most preferred first.  Tags
+# with q=0 are dropped, as are malformed q-values.
+def parse_accept_language(header):
+    preferences = []
+    for position, item in enumerate(header.split(',')):
+        parts = item.strip().split(';')
+        tag = parts[0].strip().lower()
+        if not tag:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality <= 0.0:
+            continue
+
+        # Sort on descending q-value, keeping the client's order for ties.
+        preferences.append((-quality, position, tag))
+    preferences.sort()
+    return [tag for _, _, tag in preferences]
+
+
+# build_language_index(): Takes a list of available language tags and returns
+# a dict that maps every tag a client might ask for onto one of them.  Every
+# prefix of an available tag is indexed too, so 'es' finds 'es-es'.  Exact
+# matches always win over prefixes.
+def build_language_index(languages):
+    index = {}
+    for language in sorted(languages):
+        subtags = language.split('-')
+        for i in range(len(subtags) - 1, 0, -1):
+            index.setdefault('-'.join(subtags[:i]), language)
+    for language in languages:
+        index[language] = language
+    return index
+
+
+class LanguageNegotiator(object):
+
+    def __init__(self, languages, default='en-us', cache_size=256):
+        self.default = default
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+
+        # Bumped by every reindex(), so an answer worked out from an index
+        # that's since been replaced isn't cached.
+        self._generation = 0
+        self.reindex(languages)
+
+    # reindex(): Rebuilds the language index (for example, after a template
+    # was added to or removed from --filedir) and empties the cache.
+    def reindex(self, languages):
+        index = build_language_index(languages)
+        with self._lock:
+            self._index = index
+            self._cache = OrderedDict()
+            self._generation += 1
+
+    # negotiate(): Takes the raw Accept-Language header (or None) and returns
+    # the language whose page the client should get.
+    def negotiate(self, header):
+        if not header:
+            return self.default
+
+        with self._lock:
+            language = self._cache.pop(header, None)
+            if language is not None:
+                self._cache[header] = language
+                return language
+            index, generation = self._index, self._generation
+
+        language = self._resolve(header, index)
+        with self._lock:
+            if generation != self._generation:
+                return language
+            self._cache[header] = language
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return language
+
+    def _resolve(self, header, index):
+        for tag in parse_accept_language(header):
+            if tag == '*':
+                return self.default
+
+            # Strip subtags off the end until something matches.
+            while tag:
+                if tag in index:
+                    return index[tag]
+                tag = tag.rpartition('-')[0]
+        return self.default
+
+    def cache_len(self):
+        return len(self._cache)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# portal_redirect.py
+# The redirect that bounces clients who ask for anything the captive portal
+# doesn't serve back to http://<portal address>/.  Unwhitelisted devices hit
+# random URLs all day long, so the address is worked out once (from --address,
+# or from the interface) and the Location header and body are built ahead of
+# time.  Serving a redirect doesn't touch a socket or the network stack; the
+# interface is only asked for its address again when refresh() is called.
+#
+# One daemon can serve the portal on several client interfaces.
+# PortalInterfaces holds a PortalRedirect for each of them and picks the one
+# to use for a request by the address the request came in on, so clients are
+# always sent to the portal address of their own network.  It also counts
+# requests, redirects and click-throughs per interface.
+
+# Modules.
+import fcntl
+import logging
+import socket
+import struct
+import threading
+
+SIOCGIFADDR = 0x8915
+
+# Body sent along with the 302, for clients that don't follow Location.
+REDIRECT_BODY = ('<html><head><meta http-equiv="refresh" content="0; url=%s" /></head>'
+                 '<body><a href="%s">%s</a></body></html>')
+
+
+# get_ip_address(): Returns the IPv4 address of a network interface, or None
+# if it doesn't have one.
+def get_ip_address(interface):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        return socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFADDR,
+                                struct.pack('256s', interface[:15]))[20:24])
+    except IOError:
+        return None
+    finally:
+        sock.close()
+
+
+class PortalRedirect(object):
+
+    def __init__(self, address=None, interface=None, resolver=get_ip_address):
+        self.interface = interface
+        self._resolver = resolver
+        self.address = None
+        self.location = None
+
+        # (headers, body), replaced as a whole by _build().
+        self.response = None
+        if address:
+            self._build(address)
+        elif not self.refresh():
+            # Until the interface has an address, at least send them to / on
+            # whatever address they used to reach us.
+            self._build(None)
+
+    def _build(self, address):
+        location = '/'
+        if address:
+            location = 'http://%s/' % address
+        body = REDIRECT_BODY % (location, location, location)
+
+        # One assignment, so request threads never see a Location header and a
+        # body that disagree.
+        self.response = ({'Location': location, 'Content-Type': 'text/html',
+                          'Content-Length': str(len(body))}, body)
+        self.location = location
+        self.address = address
+        logging.debug("Redirecting unknown URLs to %s.", location)
+
+    # refresh(): Asks the interface for its address again and rebuilds the
+    # redirect if it changed.  Returns True if it did.  Called when the
+    # interface might have been reconfigured, never per request.
+    def refresh(self):
+        if not self.interface:
+            return False
+        address = self._resolver(self.interface)
+        if not address or address == self.address:
+            return False
+        self._build(address)
+        return True
+
+
+# Counters kept for each interface, in the order they're stored.
+COUNTERS = ('requests', 'redirects', 'accepted')
+
+
+class PortalInterfaces(object):
+
+    # pairs is a list of (interface, address) tuples; an address of None is
+    # asked of the interface.  Requests that didn't come in on any of the
+    # interfaces' addresses (from localhost, or before an interface has an
+    # address) are routed to the first one.
+    def __init__(self, pairs, resolver=get_ip_address):
+        self.redirects = [PortalRedirect(address, interface, resolver)
+                          for interface, address in pairs]
+        self._lock = threading.Lock()
+
+        # interface: [requests, redirects, accepted]
+        self._counters = dict((redirect.interface, [0] * len(COUNTERS))
+                              for redirect in self.redirects)
+        self._index()
+
+    def _index(self):
+        # Replaced as a whole, like PortalRedirect.response.
+        self._by_address = dict((redirect.address, redirect)
+                                for redirect in self.redirects if redirect.address)
+
+    def __iter__(self):
+        return iter(self.redirects)
+
+    def __len__(self):
+        return len(self.redirects)
+
+    # route(): Returns the PortalRedirect of the interface a request arrived
+    # on, given the local address of its connection.
+    def route(self, localip):
+        return self._by_address.get(localip, self.redirects[0])
+
+    # count(): Bumps one of COUNTERS for an interface's PortalRedirect.
+    def count(self, redirect, counter):
+        with self._lock:
+            self._counters[redirect.interface][COUNTERS.index(counter)] += 1
+
+    # refresh(): Refreshes every interface's redirect.  Returns True if any of
+    # them changed.
+    def refresh(self):
+        changed = False
+        for redirect in self.redirects:
+            if redirect.refresh():
+                changed = True
+        if changed:
+            self._index()
+        return changed
+
+    # metrics(): The counters of each interface, and their totals.
+    def metrics(self):
+        metrics = {}
+        total = dict((counter, 0) for counter in COUNTERS)
+        with self._lock:
+            for redirect in self.redirects:
+                counts = dict(zip(COUNTERS, self._counters[redirect.interface]))
+                for counter, count in counts.items():
+                    total[counter] += count
+                counts['address'] = redirect.address
+                metrics[redirect.interface] = counts
+        metrics['total'] = total
+        return metrics
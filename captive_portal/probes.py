@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# probes.py
+# Canned answers for the URLs operating systems fetch to find out whether
+# they're behind a captive portal.  Every hijacked client hammers these as
+# soon as it associates, and if a probe falls through to the 404 handler the
+# OS retries until it gets an answer it understands.  Before a client has
+# clicked through it gets the portal redirect, which is what makes the OS
+# pop up its sign-in window; afterwards it gets the exact bytes its OS
+# expects from the real server, so the sign-in window goes away.
+#
+# Probes are matched on (Host, path) first and then on the path alone, since
+# only the distinctive paths are in the table and every request that reaches
+# the portal was hijacked anyway.
+
+# Modules.
+import threading
+
+# (host, path): probe
+PROBES = {
+    ('connectivitycheck.gstatic.com', '/generate_204'): 'android',
+    ('connectivitycheck.android.com', '/generate_204'): 'android',
+    ('clients1.google.com', '/generate_204'): 'android',
+    ('clients3.google.com', '/generate_204'): 'android',
+    ('www.google.com', '/gen_204'): 'android',
+    ('www.msftncsi.com', '/ncsi.txt'): 'windows-ncsi',
+    ('www.msftconnecttest.com', '/connecttest.txt'): 'windows-connecttest',
+    ('detectportal.firefox.com', '/success.txt'): 'firefox',
+    ('captive.apple.com', '/hotspot-detect.html'): 'apple',
+    ('www.apple.com', '/library/test/success.html'): 'apple',
+    ('apple.com', '/library/test/success.html'): 'apple',
+    }
+
+# path: probe, for requests whose Host header isn't one of the above.
+PROBE_PATHS = {
+    '/generate_204': 'android',
+    '/gen_204': 'android',
+    '/ncsi.txt': 'windows-ncsi',
+    '/connecttest.txt': 'windows-connecttest',
+    '/success.txt': 'firefox',
+    '/hotspot-detect.html': 'apple',
+    '/library/test/success.html': 'apple',
+    }
+
+APPLE_SUCCESS = '<HTML><HEAD><TITLE>Success</TITLE></HEAD><BODY>Success</BODY></HTML>'
+
+
+def _canned(status, content_type, body):
+    headers = {'Content-Length': str(len(body)), 'Cache-Control': 'no-cache'}
+    if content_type:
+        headers['Content-Type'] = content_type
+    return (status, headers, body)
+
+# probe: (status, headers, body) a client that's been whitelisted gets.
+SUCCESS = {
+    'android': _canned(204, None, ''),
+    'windows-ncsi': _canned(200, 'text/plain', 'Microsoft NCSI'),
+    'windows-connecttest': _canned(200, 'text/plain', 'Microsoft Connect Test'),
+    'firefox': _canned(200, 'text/plain', 'success\n'),
+    'apple': _canned(200, 'text/html', APPLE_SUCCESS),
+    }
+
+
+class ProbeResponder(object):
+
+    # redirect is the PortalRedirect unauthorized clients are sent to.
+    # is_whitelisted is a callable taking a client's IP address.
+    def __init__(self, redirect, is_whitelisted):
+        self.redirect = redirect
+        self.is_whitelisted = is_whitelisted
+        self._lock = threading.Lock()
+
+        # probe: [authorized, unauthorized]
+        self.counters = dict((probe, [0, 0]) for probe in SUCCESS)
+
+    # match(): Takes the Host header (or None) and the path of a request and
+    # returns the name of the probe it is, or None.
+    def match(self, host, path):
+        if host:
+            host = host.split(':', 1)[0].lower()
+            probe = PROBES.get((host, path))
+            if probe:
+                return probe
+        return PROBE_PATHS.get(path)
+
+    # respond(): Returns (status, headers, body) for a probe from clientip.
+    # Unauthorized clients are sent to redirect, if it's given, instead of the
+    # responder's own.
+    def respond(self, probe, clientip, redirect=None):
+        authorized = self.is_whitelisted(clientip)
+        with self._lock:
+            self.counters[probe][0 if authorized else 1] += 1
+        if authorized:
+            return SUCCESS[probe]
+        headers, body = (redirect or self.redirect).response
+        return 302, headers, body
+
+    def metrics(self):
+        return dict((probe, {'authorized': counts[0], 'unauthorized': counts[1]})
+                    for probe, counts in self.counters.items())
@@ -0,0 +1 @@
+../control_panel/static_assets.py
\ No newline at end of file
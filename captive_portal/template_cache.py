@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# template_cache.py
+# Process-wide cache of the captive portal's compiled index.html.<language>
+# templates.  One Mako TemplateLookup is built when the daemon starts and every
+# index.html.* file in --filedir is compiled right away, so handing a page to a
+# client is a dictionary lookup.  Changes on disk are picked up by comparing
+# mtimes at most once every check_interval seconds; a template is only
+# recompiled when its mtime actually moved.
+
+# Modules.
+from mako.lookup import TemplateLookup
+from mako.template import Template
+
+import logging
+import os
+import re
+import threading
+import time
+
+# Every page the portal can serve is named index.html.<language>.
+TEMPLATE_PREFIX = 'index.html.'
+
+# What the <language> has to look like, so that editor leftovers like
+# index.html.en-us~ and index.html.en-us.swp aren't offered to clients.
+LANGUAGE_TAG = re.compile(r'^[a-z]{1,8}(-[a-z0-9]{1,8})*$')
+
+
+class TemplateCache(object):
+
+    def __init__(self, filedir, cachedir, check_interval=5.0, clock=time.time):
+        self.filedir = filedir
+        self.cachedir = cachedir
+        self.check_interval = check_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+
+        # filesystem_checks is off because this class does its own (rate
+        # limited) mtime checks instead of stat()ing on every get_template().
+        self.lookup = TemplateLookup(directories=[filedir],
+                                     module_directory=cachedir,
+                                     collection_size=100,
+                                     filesystem_checks=False)
+
+        # language: compiled template, and filename: (mtime, compiled template).
+        self._templates = {}
+        self._compiled = {}
+        self._dir_mtime = None
+        self._next_check = 0
+
+        # Bumped whenever the set of available languages changes, so anything
+        # indexing languages() knows when to reindex.
+        self.generation = 0
+        self.scan()
+
+    # scan(): Walks --filedir and (re)compiles every index.html.* template
+    # whose mtime differs from the one seen last time.  Drops templates that
+    # have vanished.  Returns the list of languages available afterwards.
+    def scan(self):
+        with self._lock:
+            self._scan()
+            self._next_check = self._clock() + self.check_interval
+        return self.languages()
+
+    def _scan(self):
+        try:
+            self._dir_mtime = os.stat(self.filedir).st_mtime
+            filenames = os.listdir(self.filedir)
+        except OSError:
+            logging.error("Unable to read template directory %s.", self.filedir)
+            return
+
+        templates = {}
+        for filename in filenames:
+            if not filename.startswith(TEMPLATE_PREFIX):
+                continue
+            language = filename[len(TEMPLATE_PREFIX):].lower()
+            if not LANGUAGE_TAG.match(language):
+                continue
+            template = self._load(filename)
+            if template is not None:
+                templates[language] = template
+
+        for filename in self._compiled.keys():
+            if filename not in filenames:
+                logging.debug("Template %s went away.", filename)
+                del self._compiled[filename]
+        if set(templates) != set(self._templates):
+            self.generation += 1
+        self._templates = templates
+
+    # _load(): Returns the compiled template for filename, compiling it again
+    # only when the file has changed since it was last seen.
+    def _load(self, filename):
+        try:
+            mtime = os.stat(os.path.join(self.filedir, filename)).st_mtime
+        except OSError:
+            return None
+
+        if filename in self._compiled and self._compiled[filename][0] == mtime:
+            return self._compiled[filename][1]
+
+        logging.debug("Compiling template %s.", filename)
+        uri = '/' + filename
+        try:
+            template = Template(uri=uri, filename=os.path.join(self.filedir, filename),
+                                lookup=self.lookup, module_directory=self.cachedir)
+        except Exception:
+            logging.error("Unable to compile template %s.", filename)
+            return None
+        self.lookup.put_template(uri, template)
+        self._compiled[filename] = (mtime, template)
+        return template
+
+    # check(): Cheap freshness test.  Does nothing until check_interval has
+    # passed since the last look at the disk, then re-stats the directory and
+    # the templates and recompiles whatever changed.
+    def check(self):
+        if self._clock() < self._next_check:
+            return
+        with self._lock:
+            if self._clock() < self._next_check:
+                return
+            self._next_check = self._clock() + self.check_interval
+            try:
+                dir_mtime = os.stat(self.filedir).st_mtime
+            except OSError:
+                return
+            changed = dir_mtime != self._dir_mtime
+            if not changed:
+                for filename, (mtime, _) in self._compiled.items():
+                    try:
+                        if os.stat(os.path.join(self.filedir, filename)).st_mtime != mtime:
+                            changed = True
+                            break
+                    except OSError:
+                        changed = True
+                        break
+            if changed:
+                self._scan()
+
+    # get(): Returns the compiled template for a (lowercase) language tag, or
+    # None if there isn't one.
+    def get(self, language):
+        self.check()
+        return self._templates.get(language)
+
+    def languages(self):
+        return sorted(self._templates.keys())
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# throttle.py
+# Per-client rate limiting for the captive portal.  One phone app retrying in a
+# loop can keep the portal busy rendering pages and redirects for nobody.
+# Every client IP address gets a token bucket that refills at rate tokens a
+# second up to burst; a request takes a token, and a client with an empty
+# bucket gets THROTTLED, which was built ahead of time, instead of whatever it
+# asked for.
+#
+# The table is an OrderedDict kept in least-recently-seen order, so clients
+# that have gone quiet for idle seconds are dropped off the front as new
+# requests come in, and the table never holds more than max_clients entries.
+
+# Modules.
+from collections import OrderedDict
+
+import threading
+import time
+
+THROTTLED_BODY = 'Too many requests.\n'
+
+# (status, headers, body) sent to clients that are over the limit.
+THROTTLED = (429, {'Content-Type': 'text/plain', 'Retry-After': '1',
+                   'Content-Length': str(len(THROTTLED_BODY))}, THROTTLED_BODY)
+
+
+class ThrottleTable(object):
+
+    def __init__(self, rate=10.0, burst=40, max_clients=4096, idle=60.0,
+                 clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_clients = max_clients
+        self.idle = idle
+        self._clock = clock
+        self._lock = threading.Lock()
+
+        # IP address: [tokens, last seen, throttled]
+        self._buckets = OrderedDict()
+
+        # Counters for metrics().
+        self.throttled = 0
+        self.episodes = 0
+        self.evicted = 0
+
+    # allow(): Takes a token from clientip's bucket.  Returns False if there
+    # wasn't one.
+    def allow(self, clientip):
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.pop(clientip, None)
+            if bucket is None:
+                bucket = [self.burst, now, False]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            self._expire(now)
+            self._buckets[clientip] = bucket
+
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                bucket[2] = False
+                return True
+            if not bucket[2]:
+                bucket[2] = True
+                self.episodes += 1
+            self.throttled += 1
+            return False
+
+    # _expire(): Drops clients that haven't been seen for idle seconds, and
+    # the least recently seen ones if the table is full.
+    def _expire(self, now):
+        cutoff = now - self.idle
+        while self._buckets:
+            clientip, bucket = next(self._buckets.iteritems())
+            if bucket[1] >= cutoff and len(self._buckets) < self.max_clients:
+                break
+            del self._buckets[clientip]
+            if bucket[1] >= cutoff:
+                self.evicted += 1
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def metrics(self):
+        with self._lock:
+            throttled_clients = sum(1 for bucket in self._buckets.values() if bucket[2])
+        return {'clients': len(self._buckets),
+                'throttled_clients': throttled_clients,
+                'throttled_requests': self.throttled,
+                'throttle_episodes': self.episodes,
+                'evicted': self.evicted}
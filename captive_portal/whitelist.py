@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# whitelist.py
+# The captive portal daemon's in-process view of who has clicked through.
+# ArpTable is an index of the kernel's ARP cache by IP address, so finding a
+# client's MAC address doesn't mean forking arp | grep | grep | awk.
+# WhitelistManager ties that to a whitelist backend session (see
+# whitelist_backends.py) and remembers which MAC addresses the backend has
+# confirmed are whitelisted, so clicking OK twice doesn't add a second rule.  Given a
+# WhitelistStore (whitelist_store.py) it also records every change on disk and
+# puts the whole whitelist back with one script when the daemon restarts.
+# Given a ConntrackBackend (conntrack.py) it flushes the hijacked connections
+# of every client it whitelists, so they stop landing on the portal.
+
+# Modules.
+import logging
+import threading
+import time
+
+# Where the kernel keeps the ARP cache.
+ARP_CACHE = '/proc/net/arp'
+
+# What an ARP entry that hasn't been resolved yet looks like.
+INCOMPLETE = '00:00:00:00:00:00'
+
+
+# Index of /proc/net/arp by IP address.  It's reread when asked about an IP
+# address it doesn't know, or when it's older than max_age seconds.
+class ArpTable(object):
+
+    def __init__(self, path=ARP_CACHE, max_age=30.0, injected_open=open,
+                 clock=time.time):
+        self.path = path
+        self.max_age = max_age
+        self._open = injected_open
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._index = {}
+        self._refreshed = None
+
+    # refresh(): Rereads the ARP cache.  Returns the number of entries in it,
+    # or None if it couldn't be read.
+    def refresh(self):
+        try:
+            arp = self._open(self.path, 'r')
+        except IOError:
+            logging.error("Unable to read ARP cache %s.", self.path)
+            return None
+
+        # IP address, HW type, Flags, HW address, Mask, Device
+        index = {}
+        for line in arp.readlines()[1:]:
+            fields = line.split()
+            if len(fields) >= 4 and fields[3] != INCOMPLETE:
+                index[fields[0]] = fields[3].lower()
+        arp.close()
+
+        with self._lock:
+            self._index = index
+            self._refreshed = self._clock()
+        return len(index)
+
+    # lookup(): Takes the IP address of a client and returns its MAC address,
+    # or None if the kernel doesn't know it.
+    def lookup(self, clientip):
+        if self._refreshed is None or self._clock() - self._refreshed > self.max_age:
+            self.refresh()
+            return self._index.get(clientip)
+        mac = self._index.get(clientip)
+        if mac is None:
+            self.refresh()
+            mac = self._index.get(clientip)
+        return mac
+
+    def macs(self):
+        return dict(self._index)
+
+
+class WhitelistManager(object):
+
+    def __init__(self, backend, arptable=None, store=None, conntrack=None):
+        self.backend = backend
+        self.arptable = arptable or ArpTable()
+        self.store = store
+        self.conntrack = conntrack
+        self.session = backend.open_session()
+        self._lock = threading.Lock()
+        self._whitelisted = set()
+
+    # restore(): Whitelists everyone the store remembers with a single script,
+    # and no one else, even if the store is empty.  Returns the number of
+    # clients restored.
+    def restore(self):
+        if self.store is None:
+            return 0
+        macs = sorted(self.store.load())
+        with self._lock:
+            if self.session.send(self.backend.restore_script(macs)):
+                logging.error("Unable to restore %d whitelisted clients.", len(macs))
+                return 0
+            self._whitelisted.update(macs)
+        logging.debug("Restored %d whitelisted clients.", len(macs))
+        return len(macs)
+
+    # add(): Whitelists a client by IP address.  Returns the client's MAC
+    # address, or None if it couldn't be found or the backend failed.
+    def add(self, clientip):
+        return self.add_many([clientip]).get(clientip)
+
+    # add_many(): Whitelists a batch of clients by IP address with a single
+    # script sent to the backend.  Returns a dict of IP address: MAC address
+    # for every client that is whitelisted afterwards.  Their DNATed
+    # connections are flushed once the backend has confirmed the whitelist
+    # has them (never before, or conntrack would just DNAT them to the portal
+    # again), including those of clients that were already whitelisted and
+    # clicked again because they were still being sent to the portal.
+    def add_many(self, clientips):
+        found = {}
+        for clientip in clientips:
+            mac = self.arptable.lookup(clientip)
+            if mac is None:
+                logging.error("Client %s isn't in the ARP cache, can't whitelist it.", clientip)
+            else:
+                found[clientip] = mac
+
+        with self._lock:
+            new = sorted(set(found.values()) - self._whitelisted)
+            # send() returns once the backend has applied the whole script or
+            # given up on it.
+            if new and self.session.send(self.backend.add_script(new)):
+                for clientip, mac in found.items():
+                    if mac in new:
+                        del found[clientip]
+            elif new:
+                self._whitelisted.update(new)
+                if self.store is not None:
+                    self.store.added(new)
+        if self.conntrack is not None and found:
+            self.conntrack.flush(sorted(found))
+        for clientip, mac in found.items():
+            logging.debug("Whitelisted client %s (%s).", clientip, mac)
+        return found
+
+    # remove(): Takes a client out of the whitelist by MAC address.  Returns
+    # True if it was in there.
+    def remove(self, mac):
+        mac = mac.lower()
+        with self._lock:
+            if mac not in self._whitelisted:
+                return False
+            self._whitelisted.discard(mac)
+            self.session.send(self.backend.remove_script([mac]))
+            if self.store is not None:
+                self.store.removed([mac])
+        return True
+
+    # reconcile(): Forgets the clients that were taken out of the kernel
+    # behind the manager's back (captive-portal.sh remove, from
+    # mop_up_dead_clients.py), so that they're whitelisted again when they
+    # click.  It costs one listing of the backend, so it's run now and then by
+    # the whitelist queue's worker rather than for every request.  Returns the
+    # number of clients forgotten.
+    def reconcile(self):
+        before = self.whitelisted()
+        listed = self.backend.listed()
+        if listed is None:
+            return 0
+        with self._lock:
+            # Anyone whitelisted since the listing was taken isn't in before.
+            gone = sorted((before - listed) & self._whitelisted)
+            if not gone:
+                return 0
+            self._whitelisted.difference_update(gone)
+            if self.store is not None:
+                self.store.removed(gone)
+        logging.debug("Clients no longer whitelisted in the kernel: %s", ', '.join(gone))
+        return len(gone)
+
+    def is_whitelisted(self, mac):
+        return mac in self._whitelisted
+
+    # is_client_whitelisted(): Same thing, by the client's IP address.
+    def is_client_whitelisted(self, clientip):
+        mac = self.arptable.lookup(clientip)
+        return mac is not None and mac in self._whitelisted
+
+    def whitelisted(self):
+        return set(self._whitelisted)
+
+    def close(self):
+        self.session.close()
+        if self.store is not None:
+            self.store.close()
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# whitelist_backends.py
+# The different ways the captive portal can tell the kernel that a client's
+# MAC address has clicked through.
+#
+#    shell    - The original approach: captive-portal.sh inserts one
+#               '-m mac --mac-source X -j RETURN' rule per client at the top of
+#               the mangle 'internet' chain.  Every packet from the client
+#               network is matched against every rule, one at a time.
+#    ipset    - Client MACs live in a hash:mac IP set that a single rule in
+#               the 'internet' chain matches against.  Requires ipset v6 or
+#               later.
+#    nftables - Client MACs live in a native nftables set.  iptables rules
+#               can't reference nftables sets, so a chain hooked in right
+#               after the mangle table clears mark 99 for whitelisted clients
+#               instead; the NAT and filter rules that act on the mark never
+#               see it.
+#
+# All of them take MAC addresses.  Besides running one command per client,
+# every backend can open a Session, which pipes a whole batch of commands into
+# one iptables-restore, ipset restore or nft -f run, so whitelisting a batch of
+# clients costs one fork, and waits for it to exit, so the daemon knows
+# whether the kernel took them before it counts them as whitelisted.
+
+# Modules.
+import logging
+import os
+import re
+import subprocess
+import threading
+
+IPTABLES = '/usr/sbin/iptables'
+IPTABLES_RESTORE = '/usr/sbin/iptables-restore'
+IPSET = '/usr/sbin/ipset'
+NFT = '/usr/sbin/nft'
+CAPTIVE_PORTAL_SH = '/usr/local/sbin/captive-portal.sh'
+
+# Pull (packets, MAC address) pairs out of what each backend lists.
+IPTABLES_COUNTER = re.compile(r'^\s*(\d+)\s+\d+\s+RETURN\b.*\bMAC ([0-9A-Fa-f:]{17})', re.M)
+IPSET_COUNTER = re.compile(r'^([0-9A-Fa-f:]{17}) packets (\d+)', re.M)
+NFT_COUNTER = re.compile(r'([0-9a-f:]{17}) counter packets (\d+)')
+
+# Name of the IP set/nftables set holding whitelisted MAC addresses.
+WHITELIST_SET = 'byzantium-whitelist'
+NFT_TABLE = 'byzantium'
+
+# Priority of the nftables chain that unmarks whitelisted clients: one after
+# the iptables mangle table (-150), before NAT (-100).
+NFT_PRIORITY = -149
+
+
+# Session runs the backend's batch command once for every script sent to it,
+# with the script on its stdin.  None of them says anything on stdout when a
+# command in the middle of a script has been applied, so waiting for the exit
+# status is the only way to know the whole script was; iptables-restore, ipset
+# restore and nft -f all stop at the first command that fails and exit
+# non-zero.  Scripts are run one at a time.
+class Session(object):
+
+    def __init__(self, command, test=False, popen=subprocess.Popen):
+        self.command = command
+        self.test = test
+        self.popen = popen
+        self._lock = threading.Lock()
+
+    # send(): Runs the command on a script.  Returns 0 if the kernel took all
+    # of it, or the command's exit status (1 if it couldn't be run at all).
+    def send(self, script):
+        if self.test:
+            logging.debug("Script that would be sent to %s:\n%s", self.command[0], script)
+            return 0
+        with self._lock:
+            devnull = open(os.devnull, 'w')
+            try:
+                process = self.popen(self.command, stdin=subprocess.PIPE, stdout=devnull,
+                                     stderr=subprocess.PIPE, close_fds=True)
+                errors = process.communicate(script)[1]
+            except (IOError, OSError), e:
+                logging.error("Unable to run whitelist backend %s: %s", self.command[0], e)
+                return 1
+            finally:
+                devnull.close()
+        if process.returncode:
+            logging.error("Whitelist backend %s failed with status %d: %s", self.command[0],
+                          process.returncode, (errors or '').strip())
+        return process.returncode
+
+    # close(): Nothing is kept running between scripts.
+    def close(self):
+        pass
+
+
+class WhitelistBackend(object):
+
+    name = None
+
+    def __init__(self, test=False, runner=subprocess.call, reader=None):
+        self.test = test
+        self.runner = runner
+        self.reader = reader or read_command
+
+    # run(): Executes one command and returns its exit code.  In test mode the
+    # command is only logged.
+    def run(self, command):
+        if self.test:
+            logging.debug("Command that would be executed:\n%s", ' '.join(command))
+            return 0
+        return self.runner(command)
+
+    # setup(): Creates whatever the backend needs in the kernel.  Called after
+    # captive-portal.sh has initialized the 'internet' chain.  Returns the exit
+    # code of the first command that failed, or 0.
+    def setup(self):
+        return 0
+
+    def _run_all(self, commands):
+        for command in commands:
+            status = self.run(command)
+            if status:
+                return status
+        return 0
+
+    # add()/remove(): Whitelist or un-whitelist a client's MAC address.
+    # Return the exit code of the command that did it.
+    def add(self, mac):
+        raise NotImplementedError
+
+    def remove(self, mac):
+        raise NotImplementedError
+
+    # contains(): Returns True if the MAC address is whitelisted.
+    def contains(self, mac):
+        raise NotImplementedError
+
+    # packet_counts(): Returns a dict of MAC address: packets the kernel has
+    # counted for every whitelisted client, for the idle client reaper.
+    def packet_counts(self):
+        if self.test:
+            return {}
+        return self._parse_counts(self.reader(self.list_command))
+
+    # listed(): Returns the set of whitelisted MAC addresses, from the same
+    # listing as packet_counts(), or None if it couldn't be read.
+    def listed(self):
+        if self.test:
+            return None
+        listing = self.reader(self.list_command)
+        if not listing:
+            return None
+        return set(self._parse_counts(listing))
+
+    list_command = None
+
+    def _parse_counts(self, listing):
+        raise NotImplementedError
+
+    # session_command is what's run by open_session(); add_script() and
+    # remove_script() return the text that whitelists or un-whitelists a list
+    # of MAC addresses when piped into it.
+    session_command = None
+
+    def open_session(self):
+        return Session(self.session_command, test=self.test)
+
+    def add_script(self, macs):
+        raise NotImplementedError
+
+    def remove_script(self, macs):
+        raise NotImplementedError
+
+    # restore_script(): Returns the text that whitelists exactly macs, all at
+    # once, when the daemon starts back up, replacing whatever the kernel
+    # kept from the last run rather than adding to it.
+    def restore_script(self, macs):
+        return self.add_script(macs)
+
+
+class ShellBackend(WhitelistBackend):
+
+    name = 'shell'
+
+    def add(self, mac):
+        return self.run([CAPTIVE_PORTAL_SH, 'add', mac])
+
+    def remove(self, mac):
+        return self.run([CAPTIVE_PORTAL_SH, 'remove', mac])
+
+    def contains(self, mac):
+        return self.run([IPTABLES, '-t', 'mangle', '-C', 'internet', '-m',
+                         'mac', '--mac-source', mac, '-j', 'RETURN']) == 0
+
+    list_command = [IPTABLES, '-t', 'mangle', '-L', 'internet', '-n', '-v', '-x']
+
+    def _parse_counts(self, listing):
+        return dict((mac.lower(), int(packets))
+                    for packets, mac in IPTABLES_COUNTER.findall(listing))
+
+    # --noflush leaves the rest of the mangle table alone.
+    session_command = [IPTABLES_RESTORE, '--noflush']
+
+    def _script(self, action, macs):
+        rules = ['-%s internet -m mac --mac-source %s -j RETURN\n' % (action, mac)
+                 for mac in macs]
+        return '*mangle\n' + ''.join(rules) + 'COMMIT\n'
+
+    def add_script(self, macs):
+        return self._script('I', macs)
+
+    def remove_script(self, macs):
+        return self._script('D', macs)
+
+    # captive-portal.sh leaves the 'internet' chain alone when it already
+    # exists, so the rules from the last run are still in it.  Flushing it
+    # and putting back the MARK rule that ends it in the same COMMIT means
+    # a restart doesn't stack another copy of every client's rule on top.
+    def restore_script(self, macs):
+        rules = ['-A internet -m mac --mac-source %s -j RETURN\n' % mac for mac in macs]
+        return ('*mangle\n-F internet\n' + ''.join(rules) +
+                '-A internet -j MARK --set-mark 99\nCOMMIT\n')
+
+
+class IpsetBackend(WhitelistBackend):
+
+    name = 'ipset'
+
+    def _rule(self, action):
+        return [IPTABLES, '-t', 'mangle', action, 'internet', '-m', 'set',
+                '--match-set', WHITELIST_SET, 'src', '-j', 'RETURN']
+
+    # The set and the rule that matches it survive a restart of the daemon,
+    # so the rule is only inserted if -C doesn't find it already there.
+    def setup(self):
+        # 'counters' keeps per-client packet counts for the idle reaper.
+        status = self.run([IPSET, 'create', WHITELIST_SET, 'hash:mac', 'counters', '-exist'])
+        if status or self.run(self._rule('-C')) == 0:
+            return status
+        return self.run(self._rule('-I'))
+
+    def add(self, mac):
+        return self.run([IPSET, 'add', WHITELIST_SET, mac, '-exist'])
+
+    def remove(self, mac):
+        return self.run([IPSET, 'del', WHITELIST_SET, mac, '-exist'])
+
+    def contains(self, mac):
+        return self.run([IPSET, '-q', 'test', WHITELIST_SET, mac]) == 0
+
+    list_command = [IPSET, 'list', WHITELIST_SET]
+
+    def _parse_counts(self, listing):
+        return dict((mac.lower(), int(packets))
+                    for mac, packets in IPSET_COUNTER.findall(listing))
+
+    # 'ipset restore' reads one command per line and gives up on the first
+    # one that fails, where 'ipset -' would carry on.
+    session_command = [IPSET, 'restore']
+
+    def add_script(self, macs):
+        return ''.join(['add %s %s -exist\n' % (WHITELIST_SET, mac) for mac in macs])
+
+    def remove_script(self, macs):
+        return ''.join(['del %s %s -exist\n' % (WHITELIST_SET, mac) for mac in macs])
+
+    # Fills a scratch set and swaps it with the live one, so packets see
+    # either the old set or the whole restored one.
+    def restore_script(self, macs):
+        scratch = WHITELIST_SET + '-restore'
+        return ('create %s hash:mac counters -exist\n' % scratch +
+                'flush %s\n' % scratch +
+                ''.join(['add %s %s -exist\n' % (scratch, mac) for mac in macs]) +
+                'swap %s %s\n' % (scratch, WHITELIST_SET) +
+                'destroy %s\n' % scratch)
+
+
+class NftablesBackend(WhitelistBackend):
+
+    name = 'nftables'
+
+    # 'add' does nothing to a table, set or chain that already exists, but
+    # 'add rule' always appends, so the chain is flushed in the same
+    # transaction as the rule goes in.
+    def setup(self):
+        return self._run_all([
+            [NFT, 'add', 'table', 'inet', NFT_TABLE],
+            [NFT, 'add', 'set', 'inet', NFT_TABLE, WHITELIST_SET,
+             '{ type ether_addr; counter; }'],
+            [NFT, 'add', 'chain', 'inet', NFT_TABLE, 'prerouting',
+             '{ type filter hook prerouting priority %d; }' % NFT_PRIORITY],
+            [NFT, 'flush', 'chain', 'inet', NFT_TABLE, 'prerouting', ';',
+             'add', 'rule', 'inet', NFT_TABLE, 'prerouting', 'ether',
+             'saddr', '@' + WHITELIST_SET, 'meta', 'mark', 'set', '0'],
+            ])
+
+    def add(self, mac):
+        return self.run([NFT, 'add', 'element', 'inet', NFT_TABLE,
+                         WHITELIST_SET, '{ %s }' % mac])
+
+    def remove(self, mac):
+        return self.run([NFT, 'delete', 'element', 'inet', NFT_TABLE,
+                         WHITELIST_SET, '{ %s }' % mac])
+
+    def contains(self, mac):
+        return self.run([NFT, 'get', 'element', 'inet', NFT_TABLE,
+                         WHITELIST_SET, '{ %s }' % mac]) == 0
+
+    list_command = [NFT, 'list', 'set', 'inet', NFT_TABLE, WHITELIST_SET]
+
+    def _parse_counts(self, listing):
+        return dict((mac, int(packets)) for mac, packets in NFT_COUNTER.findall(listing))
+
+    # 'nft -f -' applies the whole script as one transaction, or none of it.
+    session_command = [NFT, '-f', '-']
+
+    def _script(self, action, macs):
+        return '%s element inet %s %s { %s }\n' % (action, NFT_TABLE, WHITELIST_SET,
+                                                    ', '.join(macs))
+
+    def add_script(self, macs):
+        return self._script('add', macs)
+
+    def remove_script(self, macs):
+        return self._script('delete', macs)
+
+    def restore_script(self, macs):
+        flush = 'flush set inet %s %s' % (NFT_TABLE, WHITELIST_SET)
+        if not macs:
+            return flush + '\n'
+        return '%s; %s' % (flush, self._script('add', macs))
+
+
+BACKENDS = {
+    ShellBackend.name: ShellBackend,
+    IpsetBackend.name: IpsetBackend,
+    NftablesBackend.name: NftablesBackend,
+    }
+
+
+# read_command(): Runs a command and returns what it printed, or '' if it
+# couldn't be run.
+def read_command(command):
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, close_fds=True)
+    except OSError, e:
+        logging.error("Unable to run %s: %s", command[0], e)
+        return ''
+    return process.communicate()[0]
+
+
+# make_backend(): Returns an instance of the backend called name.
+def make_backend(name, test=False, runner=subprocess.call, reader=None):
+    return BACKENDS[name](test=test, runner=runner, reader=reader)
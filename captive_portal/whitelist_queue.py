@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# whitelist_queue.py
+# Takes whitelisting off of the web server's request threads.  The accept
+# handler drops the client's IP address into the queue and sends the redirect
+# right away; a worker thread drains the queue in batches and whitelists each
+# batch with a single script sent to the backend (one iptables-restore COMMIT
+# or one set update).  A client that clicks more than once while it's waiting
+# is only queued once.  Every reconcile_interval seconds the worker also has
+# the manager forget clients that something else took out of the kernel
+# (WhitelistManager.reconcile()), so that nothing on the request path has to
+# ask the backend.
+
+# Modules.
+from collections import OrderedDict
+
+import logging
+import threading
+import time
+
+
+class WhitelistQueue(object):
+
+    def __init__(self, manager, batch_size=64, linger=0.02, reconcile_interval=60,
+                 clock=time.time):
+        self.manager = manager
+        self.batch_size = batch_size
+        self.linger = linger
+        self.reconcile_interval = reconcile_interval
+        self._clock = clock
+        self._next_reconcile = clock() + reconcile_interval
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+        # IP address: time it was queued.
+        self._pending = OrderedDict()
+
+        # Counters for metrics().
+        self.queued = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.applied = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = 0.0
+        self.reconciled = 0
+
+    # put(): Queues a client for whitelisting.  Returns straight away.
+    def put(self, clientip):
+        with self._condition:
+            if clientip in self._pending:
+                self.coalesced += 1
+                return
+            self._pending[clientip] = self._clock()
+            self.queued += 1
+            self._condition.notify()
+
+    def depth(self):
+        return len(self._pending)
+
+    # _take(): Waits for something to show up in the queue, lingers a moment
+    # so that a room full of people clicking at once ends up in one batch, and
+    # returns up to batch_size entries.  Returns an empty list when stopped.
+    def _take(self):
+        with self._condition:
+            while self._running and not self._pending:
+                self._condition.wait(1.0)
+            if not self._pending:
+                return []
+        if self.linger and len(self._pending) < self.batch_size:
+            time.sleep(self.linger)
+        with self._condition:
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False))
+            return batch
+
+    # drain(): Whitelists one batch.  Returns the number of clients in it.
+    def drain(self):
+        batch = self._take()
+        if batch:
+            self._apply(batch)
+        return len(batch)
+
+    def _apply(self, batch):
+        try:
+            whitelisted = self.manager.add_many([clientip for clientip, _ in batch])
+        except Exception:
+            logging.exception("Whitelisting a batch of %d clients failed.", len(batch))
+            whitelisted = {}
+
+        now = self._clock()
+        with self._condition:
+            self.batches += 1
+            for clientip, queued in batch:
+                if clientip not in whitelisted:
+                    self.failed += 1
+                    continue
+                latency = now - queued
+                self.applied += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+                self.latency_last = latency
+        logging.debug("Whitelisted %d of %d queued clients.", len(whitelisted), len(batch))
+
+    # reconcile(): Has the manager reconcile its whitelist with the backend's
+    # if reconcile_interval has passed since the last time.  drain() never
+    # waits for more than a second, so the worker gets here often enough.
+    def reconcile(self):
+        if not self.reconcile_interval or self._clock() < self._next_reconcile:
+            return
+        self._next_reconcile = self._clock() + self.reconcile_interval
+        try:
+            self.reconciled += self.manager.reconcile()
+        except Exception:
+            logging.exception("Reconciling the whitelist failed.")
+
+    def _run(self):
+        while self._running or self._pending:
+            self.drain()
+            self.reconcile()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='whitelist-queue')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # stop(): Whitelists whatever is still queued, then stops the worker.
+    def stop(self):
+        if self._thread is None:
+            return
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        self._thread = None
+
+    def metrics(self):
+        mean = 0.0
+        if self.applied:
+            mean = self.latency_total / self.applied
+        return {'depth': self.depth(),
+                'queued': self.queued,
+                'coalesced': self.coalesced,
+                'batches': self.batches,
+                'applied': self.applied,
+                'failed': self.failed,
+                'reconciled': self.reconciled,
+                'apply_latency_ms': {'last': round(self.latency_last * 1000, 3),
+                                     'mean': round(mean * 1000, 3),
+                                     'max': round(self.latency_max * 1000, 3)}}
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# whitelist_store.py
+# Keeps the set of whitelisted MAC addresses on disk, so restarting the
+# captive portal (which NetworkConfiguration.set_ip() does every time) doesn't
+# bounce every client back to the splash page.
+#
+# The set is stored as a snapshot, one MAC address per line, plus an
+# append-only journal of '+ <mac>' and '- <mac>' lines written since the
+# snapshot was taken.  Whitelisting a client appends one line to the journal.
+# Every snapshot_every journal lines the snapshot is rewritten (to a temporary
+# file that's renamed over the old one) and the journal is emptied.  A
+# journal line that was only partly written when the node went down is
+# ignored.
+
+# Modules.
+import logging
+import os
+import re
+
+MAC = re.compile('^[0-9a-f]{2}(:[0-9a-f]{2}){5}$')
+
+
+class WhitelistStore(object):
+
+    def __init__(self, path, snapshot_every=256):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.snapshot_every = snapshot_every
+        self._members = set()
+        self._journal = None
+        self._records = 0
+
+    def _read(self, path):
+        try:
+            with open(path, 'r') as lines:
+                return lines.readlines()
+        except IOError:
+            return []
+
+    # load(): Reads the snapshot and replays the journal over it.  Returns the
+    # set of MAC addresses that were whitelisted.
+    def load(self):
+        members = set()
+        for line in self._read(self.path):
+            mac = line.strip().lower()
+            if MAC.match(mac):
+                members.add(mac)
+
+        records = 0
+        for line in self._read(self.journal_path):
+            if not line.endswith('\n'):
+                logging.debug("Ignoring torn whitelist journal entry %r.", line)
+                continue
+            fields = line.split()
+            if len(fields) != 2 or not MAC.match(fields[1]):
+                continue
+            if fields[0] == '+':
+                members.add(fields[1])
+            elif fields[0] == '-':
+                members.discard(fields[1])
+            records += 1
+
+        self._members = members
+        self._records = records
+        logging.debug("Loaded %d whitelisted clients from %s.", len(members), self.path)
+        return set(members)
+
+    def _append(self, action, macs):
+        if self._journal is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._journal = open(self.journal_path, 'a')
+        self._journal.write(''.join(['%s %s\n' % (action, mac) for mac in macs]))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._records += len(macs)
+        if self._records >= self.snapshot_every:
+            self.snapshot()
+
+    # added()/removed(): Record that MAC addresses went into or came out of the
+    # whitelist.
+    def added(self, macs):
+        self._members.update(macs)
+        self._append('+', macs)
+
+    def removed(self, macs):
+        self._members.difference_update(macs)
+        self._append('-', macs)
+
+    # snapshot(): Writes the whole set out and empties the journal.  The
+    # snapshot is in place before the journal is truncated, and replaying a
+    # journal over a snapshot that already contains it changes nothing, so
+    # there's no point at which a crash loses a client.
+    def snapshot(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as snapshot:
+            snapshot.write(''.join(['%s\n' % mac for mac in sorted(self._members)]))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(temporary, self.path)
+
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_path, 'w')
+        self._records = 0
+        logging.debug("Wrote snapshot of %d whitelisted clients to %s.", len(self._members), self.path)
+
+    def close(self):
+        if self._journal is not None:
+            self.snapshot()
+            self._journal.close()
+            self._journal = None
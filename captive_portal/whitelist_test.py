@@ -0,0 +1,508 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# whitelist_test.py
+
+from flexmock import flexmock  # http://has207.github.com/flexmock
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import conntrack
+import idle_reaper
+import whitelist
+import whitelist_backends
+import whitelist_queue
+import whitelist_store
+
+ARP_CACHE = ['IP address       HW type     Flags       HW address            Mask     Device\n',
+             '10.0.0.2         0x1         0x2         AA:BB:CC:DD:EE:02     *        wlan0\n',
+             '10.0.0.3         0x1         0x0         00:00:00:00:00:00     *        wlan0\n']
+
+
+class RecordingRunner(object):
+
+    def __init__(self, status=0):
+        self.commands = []
+        self.status = status
+
+    def __call__(self, command):
+        self.commands.append(command)
+        return self.status
+
+
+class ArpTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.reads = 0
+
+    def _raise_ioerror(self, x, y):
+        raise IOError()
+
+    def _arp(self, x, y):
+        self.reads += 1
+        return flexmock(readlines=lambda: ARP_CACHE, close=lambda: None)
+
+    def _table(self, injected_open=None):
+        return whitelist.ArpTable(max_age=30, injected_open=injected_open or self._arp,
+                                  clock=lambda: self.now)
+
+    def test_finds_client(self):
+        self.assertEqual('aa:bb:cc:dd:ee:02', self._table().lookup('10.0.0.2'))
+
+    def test_incomplete_entry_is_none(self):
+        self.assertEqual(None, self._table().lookup('10.0.0.3'))
+
+    def test_hit_does_not_reread(self):
+        table = self._table()
+        table.lookup('10.0.0.2')
+        table.lookup('10.0.0.2')
+        self.assertEqual(1, self.reads)
+
+    def test_miss_rereads(self):
+        table = self._table()
+        table.lookup('10.0.0.2')
+        table.lookup('10.0.0.4')
+        self.assertEqual(2, self.reads)
+
+    def test_old_index_is_reread(self):
+        table = self._table()
+        table.lookup('10.0.0.2')
+        self.now += 60
+        table.lookup('10.0.0.2')
+        self.assertEqual(2, self.reads)
+
+    def test_returns_none_on_ioerror(self):
+        self.assertEqual(None, self._table(self._raise_ioerror).lookup('10.0.0.2'))
+
+
+class FakeSession(object):
+
+    def __init__(self, status=0):
+        self.scripts = []
+        self.status = status
+
+    def send(self, script):
+        self.scripts.append(script)
+        return self.status
+
+
+# Stands in for conntrack.ConntrackBackend.
+class FakeConntrack(object):
+
+    def __init__(self):
+        self.flushed = []
+
+    def flush(self, clientips):
+        self.flushed.append(list(clientips))
+        return len(clientips)
+
+
+class WhitelistManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = FakeSession()
+        backend = whitelist_backends.make_backend('ipset')
+        flexmock(backend).should_receive('open_session').and_return(self.session)
+        self.listed = set()
+        flexmock(backend).should_receive('listed').replace_with(lambda: self.listed)
+        arp = flexmock(lookup=lambda ip: {'10.0.0.2': 'aa:bb:cc:dd:ee:02'}.get(ip))
+        self.manager = whitelist.WhitelistManager(backend, arp)
+
+    def test_add_sends_one_script(self):
+        self.assertEqual('aa:bb:cc:dd:ee:02', self.manager.add('10.0.0.2'))
+        self.assertEqual(['add byzantium-whitelist aa:bb:cc:dd:ee:02 -exist\n'], self.session.scripts)
+        self.assertTrue(self.manager.is_whitelisted('aa:bb:cc:dd:ee:02'))
+
+    def test_second_click_is_a_noop(self):
+        self.manager.add('10.0.0.2')
+        self.manager.add('10.0.0.2')
+        self.assertEqual(1, len(self.session.scripts))
+
+    def test_client_removed_behind_its_back_is_whitelisted_again(self):
+        self.manager.add('10.0.0.2')
+        self.assertTrue(self.manager.is_client_whitelisted('10.0.0.2'))
+        self.assertEqual(1, self.manager.reconcile())
+        self.assertFalse(self.manager.is_client_whitelisted('10.0.0.2'))
+        self.assertEqual('aa:bb:cc:dd:ee:02', self.manager.add('10.0.0.2'))
+        self.assertEqual(2, len(self.session.scripts))
+
+    def test_reconcile_keeps_listed_clients(self):
+        self.manager.add('10.0.0.2')
+        self.listed = set(['aa:bb:cc:dd:ee:02'])
+        self.assertEqual(0, self.manager.reconcile())
+        self.listed = None
+        self.assertEqual(0, self.manager.reconcile())
+        self.assertTrue(self.manager.is_whitelisted('aa:bb:cc:dd:ee:02'))
+
+    def test_reconcile_forgets_clients_in_the_store_too(self):
+        self.manager.store = flexmock(added=lambda macs: None, removed=lambda macs: None)
+        self.manager.store.should_receive('removed').with_args(['aa:bb:cc:dd:ee:02']).once()
+        self.manager.add('10.0.0.2')
+        self.manager.reconcile()
+
+    def test_probes_dont_ask_the_backend(self):
+        self.manager.add('10.0.0.2')
+        flexmock(self.manager.backend).should_receive('listed').never()
+        flexmock(self.manager.backend).should_receive('contains').never()
+        self.assertTrue(self.manager.is_client_whitelisted('10.0.0.2'))
+
+    def test_unknown_client_is_not_whitelisted(self):
+        self.assertEqual(None, self.manager.add('10.0.0.9'))
+        self.assertEqual([], self.session.scripts)
+
+    def test_failed_backend_is_not_remembered(self):
+        self.session.status = 1
+        self.assertEqual(None, self.manager.add('10.0.0.2'))
+        self.assertFalse(self.manager.is_whitelisted('aa:bb:cc:dd:ee:02'))
+
+    def test_failed_backend_is_not_recorded(self):
+        self.manager.store = flexmock(added=lambda macs: None)
+        self.manager.store.should_receive('added').never()
+        self.session.status = 1
+        self.manager.add('10.0.0.2')
+
+    def test_add_many_sends_one_script_for_the_batch(self):
+        self.manager.arptable = flexmock(lookup=lambda ip: 'aa:bb:cc:dd:ee:' + ip.split('.')[-1].zfill(2))
+        found = self.manager.add_many(['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(2, len(found))
+        self.assertEqual(1, len(self.session.scripts))
+
+    def test_remove(self):
+        self.manager.add('10.0.0.2')
+        self.assertTrue(self.manager.remove('AA:BB:CC:DD:EE:02'))
+        self.assertFalse(self.manager.remove('aa:bb:cc:dd:ee:02'))
+        self.assertEqual(2, len(self.session.scripts))
+
+    def test_restore_sends_one_script(self):
+        self.manager.store = flexmock(load=lambda: set(['aa:bb:cc:dd:ee:03', 'aa:bb:cc:dd:ee:02']))
+        self.assertEqual(2, self.manager.restore())
+        self.assertEqual(1, len(self.session.scripts))
+        self.assertTrue(self.manager.is_whitelisted('aa:bb:cc:dd:ee:03'))
+
+    def test_restore_clears_the_backend_when_the_store_is_empty(self):
+        self.manager.store = flexmock(load=lambda: set())
+        self.assertEqual(0, self.manager.restore())
+        self.assertEqual(1, len(self.session.scripts))
+
+    def test_changes_are_recorded(self):
+        self.manager.store = flexmock(added=lambda macs: None, removed=lambda macs: None)
+        self.manager.store.should_receive('added').with_args(['aa:bb:cc:dd:ee:02']).once()
+        self.manager.store.should_receive('removed').with_args(['aa:bb:cc:dd:ee:02']).once()
+        self.manager.add('10.0.0.2')
+        self.manager.remove('aa:bb:cc:dd:ee:02')
+
+    def test_connections_are_flushed_after_the_backend_confirms(self):
+        events = []
+        self.manager.conntrack = flexmock(flush=lambda clientips: events.append(('flush', clientips)))
+        self.session.send = lambda script: events.append(('send', script)) or self.session.status
+        self.manager.add('10.0.0.2')
+        self.assertEqual(['send', 'flush'], [event for event, arg in events])
+
+    def test_failed_batch_is_not_flushed(self):
+        self.manager.conntrack = FakeConntrack()
+        self.manager.add('10.0.0.2')
+        self.session.status = 1
+        self.assertEqual({'10.0.0.2': 'aa:bb:cc:dd:ee:02'}, self.manager.add_many(['10.0.0.2', '10.0.0.3']))
+        self.assertEqual([['10.0.0.2'], ['10.0.0.2']], self.manager.conntrack.flushed)
+
+    def test_whitelisted_clients_connections_are_flushed(self):
+        self.manager.conntrack = FakeConntrack()
+        self.manager.add_many(['10.0.0.2', '10.0.0.9'])
+        self.manager.add('10.0.0.2')
+        self.assertEqual([['10.0.0.2'], ['10.0.0.2']], self.manager.conntrack.flushed)
+
+    def test_nothing_flushed_when_backend_fails(self):
+        self.manager.conntrack = FakeConntrack()
+        self.session.status = 1
+        self.manager.add('10.0.0.2')
+        self.assertEqual([], self.manager.conntrack.flushed)
+
+
+class IdleReaperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.counts = {'aa:bb:cc:dd:ee:02': 10, 'aa:bb:cc:dd:ee:03': 5}
+        backend = flexmock(packet_counts=lambda: dict(self.counts), remove=lambda mac: 0)
+        self.manager = flexmock(backend=backend, remove=lambda mac: True)
+        self.reaper = idle_reaper.IdleReaper(self.manager, max_idle=600, clock=lambda: self.now)
+
+    def test_idle_client_is_reaped(self):
+        self.reaper.check()
+        self.now += 601
+        self.counts['aa:bb:cc:dd:ee:02'] = 11
+        self.manager.should_receive('remove').with_args('aa:bb:cc:dd:ee:03').and_return(True).once()
+        self.assertEqual(1, self.reaper.check())
+
+    def test_client_unknown_to_manager_is_removed_from_backend(self):
+        self.reaper.check()
+        self.now += 601
+        self.manager.should_receive('remove').and_return(False)
+        self.manager.backend.should_receive('remove').twice()
+        self.assertEqual(2, self.reaper.check())
+
+    def test_gone_clients_are_forgotten(self):
+        self.reaper.check()
+        del self.counts['aa:bb:cc:dd:ee:03']
+        self.reaper.check()
+        self.assertEqual(1, self.reaper.metrics()['clients'])
+
+    def test_check_on_thread_runs_one_check_at_a_time(self):
+        started = threading.Event()
+        release = threading.Event()
+        threads = []
+        def packet_counts():
+            threads.append(threading.current_thread())
+            started.set()
+            release.wait(5)
+            return dict(self.counts)
+        self.manager.backend.packet_counts = packet_counts
+        self.reaper.check_on_thread()
+        self.assertTrue(started.wait(5))
+        self.reaper.check_on_thread()
+        release.set()
+        threads[0].join(5)
+        self.assertEqual(1, len(threads))
+        self.assertNotEqual(threading.current_thread(), threads[0])
+        self.assertEqual(1, self.reaper.checks)
+
+
+class WhitelistStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'whitelist.wlan0')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _store(self, snapshot_every=256):
+        store = whitelist_store.WhitelistStore(self.path, snapshot_every)
+        store.load()
+        return store
+
+    def test_journal_is_replayed(self):
+        store = self._store()
+        store.added(['aa:bb:cc:dd:ee:02', 'aa:bb:cc:dd:ee:03'])
+        store.removed(['aa:bb:cc:dd:ee:02'])
+        self.assertEqual(set(['aa:bb:cc:dd:ee:03']), self._store().load())
+
+    def test_snapshot_empties_journal(self):
+        store = self._store(snapshot_every=2)
+        store.added(['aa:bb:cc:dd:ee:02'])
+        store.added(['aa:bb:cc:dd:ee:03'])
+        self.assertEqual(0, os.path.getsize(self.path + '.journal'))
+        self.assertEqual(set(['aa:bb:cc:dd:ee:02', 'aa:bb:cc:dd:ee:03']), self._store().load())
+
+    def test_torn_journal_entry_is_ignored(self):
+        store = self._store()
+        store.added(['aa:bb:cc:dd:ee:02'])
+        with open(self.path + '.journal', 'a') as journal:
+            journal.write('+ aa:bb:cc:dd:e')
+        self.assertEqual(set(['aa:bb:cc:dd:ee:02']), self._store().load())
+
+    def test_missing_files_are_empty(self):
+        self.assertEqual(set(), self._store().load())
+
+
+class WhitelistQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.now = 1000.0
+        manager = flexmock(add_many=self._add_many)
+        self.queue = whitelist_queue.WhitelistQueue(manager, batch_size=2, linger=0,
+                                                    clock=lambda: self.now)
+
+    def _add_many(self, clientips):
+        self.batches.append(clientips)
+        return dict((ip, 'mac') for ip in clientips if ip != '10.0.0.9')
+
+    def test_duplicates_are_coalesced(self):
+        self.queue.put('10.0.0.2')
+        self.queue.put('10.0.0.2')
+        self.assertEqual(1, self.queue.depth())
+        self.assertEqual(1, self.queue.metrics()['coalesced'])
+
+    def test_reconciles_every_interval(self):
+        calls = []
+        self.queue.manager.reconcile = lambda: calls.append(self.now) or 1
+        self.queue.reconcile()
+        self.now += 60
+        self.queue.reconcile()
+        self.queue.reconcile()
+        self.assertEqual([1060.0], calls)
+        self.assertEqual(1, self.queue.metrics()['reconciled'])
+
+    def test_drains_in_batches(self):
+        for ip in ['10.0.0.2', '10.0.0.3', '10.0.0.4']:
+            self.queue.put(ip)
+        self.assertEqual(2, self.queue.drain())
+        self.assertEqual(1, self.queue.drain())
+        self.assertEqual([['10.0.0.2', '10.0.0.3'], ['10.0.0.4']], self.batches)
+
+    def test_metrics(self):
+        self.queue.put('10.0.0.2')
+        self.queue.put('10.0.0.9')
+        self.now += 0.5
+        self.queue.drain()
+        metrics = self.queue.metrics()
+        self.assertEqual((0, 1, 1, 1), (metrics['depth'], metrics['batches'], metrics['applied'], metrics['failed']))
+        self.assertEqual(500.0, metrics['apply_latency_ms']['max'])
+
+    def test_stop_drains_worker(self):
+        self.queue.start()
+        self.queue.put('10.0.0.2')
+        self.queue.stop()
+        self.assertEqual(0, self.queue.depth())
+        self.assertEqual([['10.0.0.2']], self.batches)
+
+
+class WhitelistBackendsTest(unittest.TestCase):
+
+    def test_shell_backend_passes_mac_to_script(self):
+        runner = RecordingRunner()
+        whitelist_backends.make_backend('shell', runner=runner).add('aa:bb:cc:dd:ee:02')
+        self.assertEqual([['/usr/local/sbin/captive-portal.sh', 'add', 'aa:bb:cc:dd:ee:02']], runner.commands)
+
+    def test_ipset_backend_matches_set_with_one_rule(self):
+        runner = RecordingRunner()
+        backend = whitelist_backends.make_backend('ipset', runner=runner)
+        backend.setup()
+        backend.add('aa:bb:cc:dd:ee:02')
+        backend.add('aa:bb:cc:dd:ee:03')
+        rules = [command for command in runner.commands if command[0].endswith('iptables')]
+        self.assertEqual(1, len(rules))
+        self.assertTrue('--match-set' in rules[0])
+
+    def test_ipset_setup_inserts_the_rule_once(self):
+        runner = RecordingRunner()
+        whitelist_backends.make_backend('ipset', runner=runner).setup()
+        self.assertEqual(['-C'], [command[3] for command in runner.commands[1:]])
+        commands = []
+        missing = lambda command: commands.append(command) or int(command[3] == '-C')
+        whitelist_backends.make_backend('ipset', runner=missing).setup()
+        self.assertEqual(['-C', '-I'], [command[3] for command in commands[1:]])
+
+    def test_nftables_setup_flushes_the_chain_with_the_rule(self):
+        runner = RecordingRunner()
+        whitelist_backends.make_backend('nftables', runner=runner).setup()
+        self.assertEqual(['flush', 'chain'], runner.commands[-1][1:3])
+        self.assertEqual(1, runner.commands[-1].count('add'))
+
+    def test_setup_stops_at_first_failure(self):
+        runner = RecordingRunner(status=2)
+        self.assertEqual(2, whitelist_backends.make_backend('nftables', runner=runner).setup())
+        self.assertEqual(1, len(runner.commands))
+
+    def test_listed_reads_the_backend_listing(self):
+        listing = 'Members:\naa:bb:cc:dd:ee:02 packets 3 bytes 180\n'
+        backend = whitelist_backends.make_backend('ipset', reader=lambda command: listing)
+        self.assertEqual(set(['aa:bb:cc:dd:ee:02']), backend.listed())
+        backend = whitelist_backends.make_backend('ipset', reader=lambda command: '')
+        self.assertEqual(None, backend.listed())
+
+    def test_contains_uses_exit_code(self):
+        self.assertTrue(whitelist_backends.make_backend('ipset', runner=RecordingRunner(0)).contains('aa:bb:cc:dd:ee:02'))
+        self.assertFalse(whitelist_backends.make_backend('ipset', runner=RecordingRunner(1)).contains('aa:bb:cc:dd:ee:02'))
+
+    def test_shell_session_script_is_one_iptables_restore_commit(self):
+        script = whitelist_backends.make_backend('shell').add_script(['aa:bb:cc:dd:ee:02'])
+        self.assertEqual('*mangle\n-I internet -m mac --mac-source aa:bb:cc:dd:ee:02 -j RETURN\nCOMMIT\n', script)
+
+    def test_shell_restore_replaces_the_chain(self):
+        script = whitelist_backends.make_backend('shell').restore_script(['aa:bb:cc:dd:ee:02'])
+        self.assertEqual('*mangle\n-F internet\n'
+                         '-A internet -m mac --mac-source aa:bb:cc:dd:ee:02 -j RETURN\n'
+                         '-A internet -j MARK --set-mark 99\n'
+                         'COMMIT\n', script)
+
+    def test_ipset_restore_swaps_in_a_scratch_set(self):
+        script = whitelist_backends.make_backend('ipset').restore_script(['aa:bb:cc:dd:ee:02'])
+        self.assertTrue('add byzantium-whitelist-restore aa:bb:cc:dd:ee:02 -exist\n' in script)
+        self.assertTrue(script.endswith('swap byzantium-whitelist-restore byzantium-whitelist\n'
+                                        'destroy byzantium-whitelist-restore\n'))
+
+    def test_nftables_restore_is_one_line(self):
+        script = whitelist_backends.make_backend('nftables').restore_script(['aa:bb:cc:dd:ee:02', 'aa:bb:cc:dd:ee:03'])
+        self.assertEqual(1, script.count('\n'))
+        self.assertEqual('flush set inet byzantium byzantium-whitelist\n',
+                         whitelist_backends.make_backend('nftables').restore_script([]))
+
+    def test_packet_counts(self):
+        listings = {
+            'shell': ('Chain internet (1 references)\n'
+                      '    pkts      bytes target     prot opt in     out     source               destination\n'
+                      '      17     2040 RETURN     all  --  *      *       0.0.0.0/0            0.0.0.0/0'
+                      '            MAC AA:BB:CC:DD:EE:02\n'
+                      '       0        0 MARK       all  --  *      *       0.0.0.0/0            0.0.0.0/0'
+                      '            MARK set 0x63\n'),
+            'ipset': ('Name: byzantium-whitelist\nType: hash:mac\nMembers:\n'
+                      'AA:BB:CC:DD:EE:02 packets 17 bytes 2040\n'),
+            'nftables': ('table inet byzantium {\n\tset byzantium-whitelist {\n\t\ttype ether_addr\n'
+                         '\t\telements = { aa:bb:cc:dd:ee:02 counter packets 17 bytes 2040 }\n\t}\n}\n'),
+            }
+        for name, listing in listings.items():
+            backend = whitelist_backends.make_backend(name, reader=lambda command: listing)
+            self.assertEqual({'aa:bb:cc:dd:ee:02': 17}, backend.packet_counts())
+
+    def test_session_returns_the_exit_status_of_each_script(self):
+        scripts = []
+        statuses = [0, 1]
+
+        def popen(command, **kwargs):
+            process = flexmock(returncode=None)
+
+            def communicate(script):
+                scripts.append(script)
+                process.returncode = statuses.pop(0)
+                return '', 'ipset v6.38: Syntax error\n' if process.returncode else ''
+            process.communicate = communicate
+            return process
+        session = whitelist_backends.Session(['/usr/sbin/ipset', 'restore'], popen=popen)
+        self.assertEqual(0, session.send('add x\n'))
+        self.assertEqual(1, session.send('add y\n'))
+        self.assertEqual(['add x\n', 'add y\n'], scripts)
+
+    def test_session_that_cannot_run_fails(self):
+        def popen(command, **kwargs):
+            raise OSError(2, 'No such file or directory')
+        self.assertEqual(1, whitelist_backends.Session(['/usr/sbin/nft', '-f', '-'], popen=popen).send('x\n'))
+
+    def test_test_mode_runs_nothing(self):
+        runner = RecordingRunner()
+        whitelist_backends.make_backend('nftables', test=True, runner=runner).add('aa:bb:cc:dd:ee:02')
+        self.assertEqual([], runner.commands)
+
+
+class ConntrackBackendTest(unittest.TestCase):
+
+    def test_deletes_only_dnated_entries_of_each_client(self):
+        runner = RecordingRunner()
+        backend = conntrack.ConntrackBackend(runner=runner)
+        self.assertEqual(2, backend.flush(['10.0.0.2', '10.0.0.3']))
+        self.assertEqual(['/usr/sbin/conntrack', '-D', '--dst-nat', '-s', '10.0.0.3'], runner.commands[1])
+
+    def test_nothing_to_delete_is_not_a_failure(self):
+        backend = conntrack.ConntrackBackend(runner=RecordingRunner(status=1))
+        self.assertEqual(0, backend.flush(['10.0.0.2']))
+        self.assertEqual(0, backend.metrics()['failed'])
+
+    def test_missing_conntrack_is_given_up_on(self):
+        def runner(command):
+            raise OSError(2, 'No such file or directory')
+        backend = conntrack.ConntrackBackend(runner=runner)
+        backend.flush(['10.0.0.2'])
+        self.assertFalse(backend.available)
+        self.assertEqual(0, backend.flush(['10.0.0.3']))
+        self.assertEqual(1, backend.metrics()['failed'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,6 +14,8 @@
 # For security reasons I see no reason to change this; if you want to admin a
 # Byzantium node remotely you'll have to use SSH port forwarding.
 
+# v0.3  - CSS, graphics and traffic graphs are served from memory with ETags
+#         and gzipped copies (static_assets.py) instead of tools.staticdir.
 # v0.2  - Split the network traffic graphs from the system status report.
 # v0.1  - Initial release.
 
@@ -26,6 +28,7 @@ import logging
 import os
 
 from status import Status
+import static_assets
 
 
 def parse_args():
@@ -82,6 +85,11 @@ def main():
     # Read in the name and location of the appserver's global config file.
     cherrypy.config.update(globalconfig)
 
+    # Index the static files once, and serve them out of memory from the
+    # sections of the app config that turn tools.static_assets on.
+    assets = static_assets.StaticIndex(args.filedir, ['css', 'graphics', 'graphs'])
+    cherrypy.tools.static_assets = static_assets.make_tool(assets)
+
     # Allocate the objects representing the URL tree.
     root = Status(templatelookup, args.test, args.filedir)
 
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# static_assets.py
+# Serves the CSS, images and scripts of the control panel and the captive
+# portal out of memory.  Every file is read once (and again when its mtime
+# changes), given a strong ETag, and gzipped ahead of time if it's worth it,
+# so a browser that already has a file gets a 304 without the file being
+# touched, and one that doesn't gets the smallest copy there is.  Airtime on
+# the mesh is scarcer than anything else the node has.
+#
+# Assets whose URL carries a version (a ?v=... query string, or a hex
+# fingerprint in the file name like style.3f2a9c1d.css) are sent with a year
+# long Cache-Control, since their URL changes when they do.  Everything else
+# is sent with no-cache, which makes browsers revalidate (and get a 304)
+# instead of downloading it again.
+#
+# Used by control_panel.py and captive_portal.py through make_tool(), and by
+# the captive portal's async engine directly.
+
+# Modules.
+import cherrypy
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import threading
+import time
+import urlparse
+from cStringIO import StringIO
+
+# File extensions that are served as static assets.  Templates and anything
+# else in the directories are left alone.
+STATIC_TYPES = {
+    '.css': 'text/css',
+    '.gif': 'image/gif',
+    '.ico': 'image/x-icon',
+    '.jpeg': 'image/jpeg',
+    '.jpg': 'image/jpeg',
+    '.js': 'application/javascript',
+    '.png': 'image/png',
+    '.svg': 'image/svg+xml',
+    '.ttf': 'font/ttf',
+    '.txt': 'text/plain',
+    '.woff': 'font/woff',
+    '.woff2': 'font/woff2',
+    }
+
+# Types that compress.  Images and fonts are compressed already.
+COMPRESSIBLE = set(['text/css', 'application/javascript', 'image/svg+xml',
+                    'text/plain', 'font/ttf'])
+
+# Files bigger than this aren't kept in memory or served.
+MAX_SIZE = 1024 * 1024
+
+VERSIONED_NAME = re.compile(r'\.[0-9a-f]{8,}\.[^./]+$')
+
+LONG_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+
+def gzip_bytes(data):
+    buf = StringIO()
+    compressor = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+    compressor.write(data)
+    compressor.close()
+    return buf.getvalue()
+
+
+# accepts_gzip(): Reads an Accept-Encoding header.
+def accepts_gzip(header):
+    if not header:
+        return False
+    for coding in header.split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in ('gzip', '*'):
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        return quality > 0
+    return False
+
+
+# etag_matches(): True if an If-None-Match header lists etag.
+def etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class Asset(object):
+
+    def __init__(self, path, mtime, data, content_type):
+        self.path = path
+        self.mtime = mtime
+        self.data = data
+        self.content_type = content_type
+        self.checked = 0
+        digest = hashlib.sha1(data).hexdigest()[:20]
+        self.etag = '"%s"' % digest
+
+        # The gzipped copy and its own ETag, if compressing it saves anything.
+        self.gzipped = None
+        self.gzip_etag = '"%s-gz"' % digest
+        if content_type in COMPRESSIBLE and len(data) > 256:
+            gzipped = gzip_bytes(data)
+            if len(gzipped) < len(data):
+                self.gzipped = gzipped
+
+
+class StaticIndex(object):
+
+    # root is the directory the URL tree is served out of.  directories are
+    # the subdirectories of it to serve (/css/... comes from <root>/css/...);
+    # None serves root itself.  Files are rechecked at most every
+    # check_interval seconds.
+    def __init__(self, root, directories=None, check_interval=5.0, clock=time.time):
+        self.root = root
+        self.directories = directories
+        self.check_interval = check_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._scanning = threading.Lock()
+        self._scanned = None
+
+        # URL path: Asset
+        self._assets = {}
+
+        # Counters for metrics().
+        self.hits = 0
+        self.not_modified = 0
+        self.gzipped = 0
+
+        self.scan()
+
+    def _files(self):
+        if self.directories is None:
+            tops = [self.root]
+        else:
+            tops = [os.path.join(self.root, directory) for directory in self.directories]
+        for top in tops:
+            for dirpath, dirnames, filenames in os.walk(top):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    if os.path.splitext(filename)[1].lower() in STATIC_TYPES:
+                        yield '/' + os.path.relpath(path, self.root).replace(os.sep, '/'), path
+
+    def _load(self, path):
+        try:
+            mtime = os.path.getmtime(path)
+            if os.path.getsize(path) > MAX_SIZE:
+                logging.debug("Not serving %s, it's too big.", path)
+                return None
+            with open(path, 'rb') as asset:
+                data = asset.read()
+        except (IOError, OSError):
+            return None
+        content_type = STATIC_TYPES.get(os.path.splitext(path)[1].lower())
+        if content_type is None:
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        asset = Asset(path, mtime, data, content_type)
+        asset.checked = self._clock()
+        return asset
+
+    # scan(): Indexes every asset under the served directories, reusing what's
+    # already loaded if it hasn't changed.
+    def scan(self):
+        assets = {}
+        for urlpath, path in self._files():
+            asset = self._assets.get(urlpath)
+            try:
+                unchanged = asset is not None and os.path.getmtime(path) == asset.mtime
+            except OSError:
+                continue
+            if not unchanged:
+                asset = self._load(path)
+            if asset is not None:
+                assets[urlpath] = asset
+        with self._lock:
+            self._assets = assets
+            self._scanned = self._clock()
+        logging.debug("Indexed %d static assets under %s.", len(assets), self.root)
+
+    # lookup(): Returns the Asset for a URL path, or None.  A file whose mtime
+    # has changed is reloaded; a path to an asset that isn't in the index
+    # causes a rescan, at most once every check_interval seconds and by one
+    # thread at a time; the others answer from the index as it is.
+    def lookup(self, urlpath):
+        now = self._clock()
+        asset = self._assets.get(urlpath)
+        if asset is None:
+            if os.path.splitext(urlpath)[1].lower() not in STATIC_TYPES:
+                return None
+            if now - self._scanned < self.check_interval:
+                return None
+            if not self._scanning.acquire(False):
+                return None
+            try:
+                # Another thread may have just finished a rescan.
+                if self._clock() - self._scanned >= self.check_interval:
+                    self.scan()
+            finally:
+                self._scanning.release()
+            return self._assets.get(urlpath)
+
+        if now - asset.checked >= self.check_interval:
+            asset.checked = now
+            try:
+                mtime = os.path.getmtime(asset.path)
+            except OSError:
+                with self._lock:
+                    self._assets.pop(urlpath, None)
+                return None
+            if mtime != asset.mtime:
+                reloaded = self._load(asset.path)
+                with self._lock:
+                    if reloaded is None:
+                        self._assets.pop(urlpath, None)
+                    else:
+                        self._assets[urlpath] = reloaded
+                asset = reloaded
+        return asset
+
+    # respond(): Returns (status, headers, body) for an asset, given the
+    # request's query string, If-None-Match and Accept-Encoding headers.
+    def respond(self, asset, query=None, if_none_match=None, accept_encoding=None):
+        versioned = (query and 'v' in urlparse.parse_qs(query)) or VERSIONED_NAME.search(asset.path)
+        use_gzip = asset.gzipped is not None and accepts_gzip(accept_encoding)
+        etag = asset.gzip_etag if use_gzip else asset.etag
+        headers = {'ETag': etag,
+                   'Cache-Control': LONG_CACHE if versioned else REVALIDATE,
+                   'Vary': 'Accept-Encoding'}
+
+        self.hits += 1
+        if etag_matches(if_none_match, asset.etag) or etag_matches(if_none_match, asset.gzip_etag):
+            self.not_modified += 1
+            return 304, headers, ''
+
+        headers['Content-Type'] = asset.content_type
+        body = asset.data
+        if use_gzip:
+            self.gzipped += 1
+            headers['Content-Encoding'] = 'gzip'
+            body = asset.gzipped
+        headers['Content-Length'] = str(len(body))
+        return 200, headers, body
+
+    def metrics(self):
+        return {'assets': len(self._assets),
+                'hits': self.hits,
+                'not_modified': self.not_modified,
+                'gzipped': self.gzipped}
+
+
+# make_tool(): Returns a CherryPy tool that answers requests for anything in
+# index before the handler runs.  Requests for anything else go on as usual.
+def make_tool(index):
+    def serve():
+        request = cherrypy.serving.request
+        asset = index.lookup(request.path_info)
+        if asset is None:
+            return False
+        status, headers, body = index.respond(asset, request.query_string,
+                                              request.headers.get('If-None-Match'),
+                                              request.headers.get('Accept-Encoding'))
+        response = cherrypy.serving.response
+        response.status = status
+        response.headers.update(headers)
+        response.body = body
+        request.handler = None
+        return True
+    return cherrypy.Tool('before_handler', serve)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# Project Byzantium: http://wiki.hacdc.org/index.php/Byzantium
+# License: GPLv3
+
+# static_assets_test.py
+
+import gzip
+import os
+import shutil
+import static_assets
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+CSS = 'body { margin: 0; padding: 0; }\n' * 40
+
+
+class StaticIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'css'))
+        self._write('css/style.css', CSS)
+        self._write('css/logo.png', '\x89PNG')
+        self._write('index.html', '<html></html>')
+        self.index = static_assets.StaticIndex(self.root, ['css'], clock=lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, name, data, mtime=None):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def test_only_static_files_are_indexed(self):
+        self.assertNotEqual(None, self.index.lookup('/css/style.css'))
+        self.assertEqual(None, self.index.lookup('/index.html'))
+
+    def test_gzipped_when_accepted(self):
+        asset = self.index.lookup('/css/style.css')
+        status, headers, body = self.index.respond(asset, accept_encoding='gzip, deflate')
+        self.assertEqual((200, 'gzip'), (status, headers['Content-Encoding']))
+        self.assertEqual(CSS, gzip.GzipFile(fileobj=StringIO(body)).read())
+
+    def test_identity_when_gzip_refused(self):
+        asset = self.index.lookup('/css/style.css')
+        status, headers, body = self.index.respond(asset, accept_encoding='gzip;q=0')
+        self.assertEqual(CSS, body)
+        self.assertFalse('Content-Encoding' in headers)
+
+    def test_images_are_not_gzipped(self):
+        asset = self.index.lookup('/css/logo.png')
+        self.assertEqual('\x89PNG', self.index.respond(asset, accept_encoding='gzip')[2])
+
+    def test_matching_etag_is_not_modified(self):
+        asset = self.index.lookup('/css/style.css')
+        etag = self.index.respond(asset)[1]['ETag']
+        status, headers, body = self.index.respond(asset, if_none_match='"x", ' + etag)
+        self.assertEqual((304, ''), (status, body))
+
+    def test_versioned_urls_are_cached_for_long(self):
+        asset = self.index.lookup('/css/style.css')
+        self.assertEqual('no-cache', self.index.respond(asset)[1]['Cache-Control'])
+        self.assertEqual(static_assets.LONG_CACHE, self.index.respond(asset, 'v=3')[1]['Cache-Control'])
+        self.assertEqual(static_assets.LONG_CACHE, self.index.respond(asset, 'a=1&v=3')[1]['Cache-Control'])
+        for query in ('nav=1', 'dev=x', 'preview=', 'v='):
+            self.assertEqual('no-cache', self.index.respond(asset, query)[1]['Cache-Control'])
+
+    def test_changed_file_is_reloaded(self):
+        etag = self.index.lookup('/css/style.css').etag
+        self._write('css/style.css', 'p { }\n', mtime=time_after(self.root))
+        self.now += 5
+        self.assertNotEqual(etag, self.index.lookup('/css/style.css').etag)
+
+    def test_new_file_is_found_after_rescan(self):
+        self._write('css/new.css', 'p { }\n')
+        self.assertEqual(None, self.index.lookup('/css/new.css'))
+        self.now += 5
+        self.assertNotEqual(None, self.index.lookup('/css/new.css'))
+
+
+    def test_one_rescan_at_a_time(self):
+        self._write('css/new.css', 'p { }\n')
+        self.now += 5
+        self.index._scanning.acquire()
+        try:
+            self.assertEqual(None, self.index.lookup('/css/new.css'))
+        finally:
+            self.index._scanning.release()
+        self.assertNotEqual(None, self.index.lookup('/css/new.css'))
+
+# time_after(): An mtime later than anything under root.
+def time_after(root):
+    return max(os.path.getmtime(os.path.join(dirpath, name))
+               for dirpath, _, names in os.walk(root) for name in names) + 60
+
+if __name__ == '__main__':
+    unittest.main()
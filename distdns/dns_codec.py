@@ -0,0 +1 @@
+../captive_portal/dns_codec.py
\ No newline at end of file
@@ -3,47 +3,45 @@
 
 ## {{{ http://code.activestate.com/recipes/491264/ (r4)
 import socket
+import sys
 
-class DNSQuery:
-    def __init__(self, data):
-        self.data=data
-        self.domain=''
+# dns_codec.py is a symlink to the captive portal's copy.
+import dns_codec
 
-        tipo = (ord(data[2]) >> 3) & 15   # Opcode bits
-        if tipo == 0:                     # Standard query
-            ini=12
-            lon=ord(data[ini])
-            while lon != 0:
-                self.domain+=data[ini+1:ini+lon+1]+'.'
-                ini+=lon+1
-                lon=ord(data[ini])
-
-    def response(self, ip):
-        packet=''
-        if self.domain:
-            packet+=self.data[:2] + "\x81\x80"
-            packet+=self.data[4:6] + self.data[4:6] + '\x00\x00\x00\x00'   # Questions and Answers Counts
-            packet+=self.data[12:]                                         # Original Domain Name Question
-            packet+='\xc0\x0c'                                             # Pointer to domain name
-            packet+='\x00\x01\x00\x01\x00\x00\x00\x3c\x00\x04'             # Response type, ttl and resource data length -> 4 bytes
-            packet+=str.join('',map(lambda x: chr(int(x)), ip.split('.'))) # 4bytes of IP
-        return packet
+# Answers A (and ANY) queries with ip, and anything else with no records.
+# Queries are read and checked by dns_codec, so one that's malformed is
+# dropped instead of taking the server down with it.
+def response(query, ip):
+    if query.opcode != dns_codec.OPCODE_QUERY:
+        return dns_codec.response(query, dns_codec.RCODE_NOTIMP).tostring()
+    encoder = dns_codec.response(query)
+    if query.qtype in (dns_codec.TYPE_A, dns_codec.TYPE_ANY) and query.qclass in (dns_codec.CLASS_IN,
+                                                                                dns_codec.CLASS_ANY):
+        encoder.answer(query.labels, dns_codec.TYPE_A, 60, socket.inet_aton(ip))  # ttl -> 60 s
+    if query.edns is not None:
+        encoder.opt(dns_codec.MAX_UDP)
+    return encoder.tostring()
 
 if __name__ == '__main__':
     ip='192.168.1.1'
+    port=53
+    if len(sys.argv) > 1:
+        port=int(sys.argv[1])                                              # For testing on an unprivileged port
     print 'DistDNS:: dom.query. 60 IN A %s' % ip
   
     udps = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udps.bind(('',53))
+    udps.bind(('',port))
   
     try:
         while 1:
             data, addr = udps.recvfrom(1024)
-            p=DNSQuery(data)
-            udps.sendto(p.response(ip), addr)
-            print 'Response: %s -> %s' % (p.domain, ip)
+            try:
+                query = dns_codec.parse_query(data)
+            except dns_codec.DNSError:
+                continue
+            udps.sendto(response(query, ip), addr)
+            print 'Response: %s -> %s' % (query.name, ip)
     except KeyboardInterrupt:
         print 'Finished'
         udps.close()
 ## end of http://code.activestate.com/recipes/491264/ }}}
-